@@ -1,4 +1,5 @@
 import io
+import hashlib
 import os
 import re
 import threading
@@ -275,6 +276,8 @@ class DriveClientApp(tkdnd.Tk if HAS_TKINTERDND2 else tk.Tk):
         }
 
         self.preview_image_tk: Optional[ImageTk.PhotoImage] = None
+        # ETag per listing query, so unchanged refreshes come back as 304
+        self.listing_etags: Dict[tuple, str] = {}
         
         # Sync variables
         self.sync_folder: Optional[Path] = None
@@ -299,8 +302,9 @@ class DriveClientApp(tkdnd.Tk if HAS_TKINTERDND2 else tk.Tk):
 
         self.filter_var = tk.StringVar(value="all")
         ttk.Label(top, text="Фільтр:").pack(side=tk.LEFT, padx=(16, 4))
-        ttk.Combobox(top, state="readonly", values=["all", "py", "jpg"], textvariable=self.filter_var, width=6,
-                     postcommand=self.refresh_files).pack(side=tk.LEFT)
+        self.filter_combo = ttk.Combobox(top, state="readonly", values=["all"], textvariable=self.filter_var, width=6,
+                                         postcommand=self.refresh_files)
+        self.filter_combo.pack(side=tk.LEFT)
 
         self.sort_var = tk.StringVar(value="uploader")
         self.order_var = tk.StringVar(value="asc")
@@ -310,9 +314,16 @@ class DriveClientApp(tkdnd.Tk if HAS_TKINTERDND2 else tk.Tk):
         ttk.Combobox(top, state="readonly", values=["asc", "desc"], textvariable=self.order_var, width=6,
                      postcommand=self.refresh_files).pack(side=tk.LEFT, padx=(4, 0))
 
+        self.search_var = tk.StringVar()
+        ttk.Label(top, text="Пошук:").pack(side=tk.LEFT, padx=(16, 4))
+        search_entry = ttk.Entry(top, textvariable=self.search_var, width=16)
+        search_entry.pack(side=tk.LEFT)
+        search_entry.bind("<Return>", lambda _e: self.refresh_files())
+
         actions = ttk.Frame(self)
         actions.pack(fill=tk.X, padx=8, pady=(0, 6))
         ttk.Button(actions, text="Завантажити файл", command=self.upload_file_dialog).pack(side=tk.LEFT)
+        ttk.Button(actions, text="Архів…", command=self.upload_archive_dialog).pack(side=tk.LEFT, padx=(6, 0))
         ttk.Button(actions, text="Вивантажити", command=self.download_selected).pack(side=tk.LEFT, padx=6)
         ttk.Button(actions, text="Видалити", command=self.delete_selected).pack(side=tk.LEFT)
         
@@ -422,9 +433,19 @@ class DriveClientApp(tkdnd.Tk if HAS_TKINTERDND2 else tk.Tk):
             "sort_by": self.sort_var.get(),
             "order": self.order_var.get(),
         }
+        if self.search_var.get().strip():
+            params["name_contains"] = self.search_var.get().strip()
+        cache_key = (self.session.token, tuple(sorted(params.items())))
+        headers = self.auth_headers()
+        if cache_key in self.listing_etags:
+            headers["If-None-Match"] = self.listing_etags[cache_key]
         try:
-            r = requests.get(f"{API_URL}/files", headers=self.auth_headers(), params=params, timeout=10)
+            r = requests.get(f"{API_URL}/files", headers=headers, params=params, timeout=10)
+            if r.status_code == 304:
+                return  # the tree already shows this listing
             r.raise_for_status()
+            if r.headers.get("ETag"):
+                self.listing_etags = {cache_key: r.headers["ETag"]}
             items = r.json()
             for i in self.tree.get_children():
                 self.tree.delete(i)
@@ -433,9 +454,18 @@ class DriveClientApp(tkdnd.Tk if HAS_TKINTERDND2 else tk.Tk):
                 node = self.tree.insert('', tk.END, values=values)
                 # Store id in tags instead of trying to set non-existent column
                 self.tree.item(node, tags=(str(it["id"]),))
+            self.refresh_facets()
         except Exception as e:
             messagebox.showerror("Помилка", str(e))
 
+    def refresh_facets(self) -> None:
+        """Fill the filter combobox with the extensions the user actually has."""
+        r = requests.get(f"{API_URL}/files/stats", headers=self.auth_headers(), timeout=10)
+        if not r.ok:
+            return
+        stats = r.json()
+        self.filter_combo["values"] = ["all"] + [f["extension"].lstrip(".") for f in stats["extensions"]]
+
     def _get_selected_id(self) -> Optional[int]:
         sel = self.tree.selection()
         if not sel:
@@ -460,6 +490,26 @@ class DriveClientApp(tkdnd.Tk if HAS_TKINTERDND2 else tk.Tk):
         for path in paths:
             self._upload_file(Path(path))
 
+    def upload_archive_dialog(self) -> None:
+        """Send a ZIP/tar in one request; the server unpacks it into separate files and folders."""
+        path = filedialog.askopenfilename(title="Виберіть архів",
+                                          filetypes=[("Архіви", "*.zip *.tar *.tar.gz *.tgz *.tar.bz2 *.tar.xz")])
+        if not path or not self.session.token:
+            return
+        try:
+            with open(path, 'rb') as fh:
+                r = requests.post(f"{API_URL}/files/archive", headers=self.auth_headers(), data=fh,
+                                  params={"folder": Path(path).name.split(".")[0]})
+            report = r.json()
+            self.refresh_files()
+            summary = f"Файлів: {report.get('files', 0)}, пропущено: {report.get('skipped', 0)}, помилок: {report.get('errors', 0)}"
+            if r.ok:
+                messagebox.showinfo("Архів", summary)
+            else:
+                messagebox.showerror("Помилка", f"{report.get('message')}\n{summary}")
+        except Exception as e:
+            messagebox.showerror("Помилка", str(e))
+
     def _on_drop_files(self, event):  # type: ignore[no-redef]
         files = self.tk.splitlist(event.data)  # type: ignore[attr-defined]
         for f in files:
@@ -471,8 +521,18 @@ class DriveClientApp(tkdnd.Tk if HAS_TKINTERDND2 else tk.Tk):
         if not self.session.token:
             return
         try:
+            digest = hashlib.sha256()
             with open(path, 'rb') as fh:
-                r = requests.post(f"{API_URL}/files", headers=self.auth_headers(), files={"file": (path.name, fh)})
+                for chunk in iter(lambda: fh.read(1024 * 1024), b""):
+                    digest.update(chunk)
+            r = requests.post(f"{API_URL}/files/check", headers=self.auth_headers(),
+                              json={"name": path.name, "size": path.stat().st_size, "sha256": digest.hexdigest()})
+            if r.ok and r.json().get("status") == "upload":
+                # the server does not have this content yet: send the body
+                with open(path, 'rb') as fh:
+                    r = requests.post(f"{API_URL}/files", headers=self.auth_headers(),
+                                      files={"file": (path.name, fh)},
+                                      data={"upload_token": r.json()["upload_token"]})
             if r.status_code in (200, 201):
                 self.refresh_files()
             else:
@@ -537,12 +597,21 @@ class DriveClientApp(tkdnd.Tk if HAS_TKINTERDND2 else tk.Tk):
                 # Apply syntax highlighting
                 self.syntax_highlighter.highlight_python(content)
                 self.preview_text.configure(state=tk.NORMAL)
-            elif extension == '.jpg':
-                r = requests.get(f"{API_URL}/files/{fid}/preview", headers=self.auth_headers(), timeout=10)
+            elif extension in ('.docx', '.pdf'):
+                # first page of the text the server extracted; the document itself stays remote
+                r = requests.get(f"{API_URL}/files/{fid}/preview", headers=self.auth_headers(),
+                                 params={"page": 1}, timeout=60)
                 r.raise_for_status()
+                data = r.json()
+                self.preview_label.configure(image='')
+                self.preview_text.configure(state=tk.NORMAL)
                 self.preview_text.delete('1.0', tk.END)
-                img = Image.open(io.BytesIO(r.content))
-                img.thumbnail((400, 400))
+                self.preview_text.insert('1.0', data.get('content', ''))
+                if data.get('pages', 1) > 1:
+                    self.preview_text.insert(tk.END, f"\n\n… сторінка 1 з {data['pages']}")
+            elif extension == '.jpg':
+                self.preview_text.delete('1.0', tk.END)
+                img = self._load_preview_image(fid, (400, 400))
                 self.preview_image_tk = ImageTk.PhotoImage(img)
                 self.preview_label.configure(image=self.preview_image_tk)
             else:
@@ -551,6 +620,34 @@ class DriveClientApp(tkdnd.Tk if HAS_TKINTERDND2 else tk.Tk):
         except Exception as e:
             messagebox.showerror("Помилка", str(e))
 
+    def _load_preview_image(self, fid: int, box: tuple) -> Image.Image:
+        """Fetch just enough of the image to fill ``box``.
+
+        Uses the server's tile pyramid: only the tiles of the largest level that
+        fits the box are downloaded, so a 100 MP photo costs a few small JPEGs.
+        """
+        r = requests.get(f"{API_URL}/files/{fid}/tiles", headers=self.auth_headers(), timeout=60)
+        if not r.ok:
+            r = requests.get(f"{API_URL}/files/{fid}/preview", headers=self.auth_headers(), timeout=10)
+            r.raise_for_status()
+            img = Image.open(io.BytesIO(r.content))
+            img.thumbnail(box)
+            return img
+
+        manifest = r.json()
+        level = manifest["max_level"]
+        while level > 0 and (manifest["levels"][level]["width"] > box[0] or manifest["levels"][level]["height"] > box[1]):
+            level -= 1
+        size = manifest["levels"][level]
+        ts = manifest["tile_size"]
+        img = Image.new("RGB", (size["width"], size["height"]))
+        for x in range((size["width"] + ts - 1) // ts):
+            for y in range((size["height"] + ts - 1) // ts):
+                t = requests.get(f"{API_URL}/files/{fid}/tiles/{level}/{x}_{y}.jpg", headers=self.auth_headers(), timeout=10)
+                t.raise_for_status()
+                img.paste(Image.open(io.BytesIO(t.content)), (x * ts, y * ts))
+        return img
+
     # Sync methods
     def select_sync_folder(self):
         """Select folder for synchronization"""
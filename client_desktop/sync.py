@@ -1,69 +1,156 @@
 import time
+import base64
 import hashlib
+import json
+import threading
 from pathlib import Path
-from typing import Optional, List, Dict, Any
+from typing import Optional, List, Dict, Any, Iterator, Tuple
 import os
 
 import requests
 
+from .syncstate import STATE_FILE, SyncState
+
+
+def token_subject(token: str) -> str:
+    """The ``sub`` claim of a JWT, read without verifying it (it only names the local state)."""
+    try:
+        payload = token.split(".")[1]
+        return str(json.loads(base64.urlsafe_b64decode(payload + "=" * (-len(payload) % 4)))["sub"])
+    except (IndexError, KeyError, ValueError):
+        return ""
+
 
 class FolderSync:
-    def __init__(self, api_url: str, token: str, local_folder: Path) -> None:
+    def __init__(self, api_url: str, token: str, local_folder: Path, state_path: Optional[Path] = None) -> None:
         self.api_url = api_url.rstrip('/')
         self.token = token
         self.local_folder = local_folder
         self.last_sync_time = 0
-        self.file_hashes = {}  # Track file hashes to detect changes
+        self.state_path = state_path or local_folder / STATE_FILE
+        self._state: Optional[SyncState] = None
+        self.remote_etag: Optional[str] = None
+        self.remote_files: Dict[str, Any] = {}
+        self.uploaded_ids = set()  # our own uploads, so their change events are not downloaded back
+        self.last_event_id: Optional[int] = None
+
+    @property
+    def state(self) -> SyncState:
+        """Per-file sync state (``client_desktop.syncstate``), opened on first use."""
+        if self._state is None:
+            self._state = SyncState(self.state_path, f"{self.api_url} {token_subject(self.token)}")
+        return self._state
+
+    def remember(self, local_path: Path, digest: str, remote_file: Dict[str, Any]) -> None:
+        """Record ``local_path`` as in sync with ``remote_file``."""
+        key = local_path.relative_to(self.local_folder).as_posix()
+        self.state.record(key, local_path.stat(), digest, remote_file.get("id"), remote_file.get("updated_at"))
 
     def headers(self):
         return {"Authorization": f"Bearer {self.token}"}
 
+    @staticmethod
+    def remote_key(folder: str, name: str) -> str:
+        """Relative path of a remote file, e.g. folder ``/a/b/`` + ``x.py`` -> ``a/b/x.py``."""
+        return (folder or "/").lstrip("/") + name
+
     def get_file_hash(self, file_path: Path) -> str:
-        """Calculate MD5 hash of file content"""
-        hash_md5 = hashlib.md5()
+        """Calculate SHA-256 of file content (the server's content hash)"""
+        digest = hashlib.sha256()
         try:
             with open(file_path, "rb") as f:
-                for chunk in iter(lambda: f.read(4096), b""):
-                    hash_md5.update(chunk)
-            return hash_md5.hexdigest()
+                for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                    digest.update(chunk)
+            return digest.hexdigest()
         except Exception:
             return ""
 
     def get_remote_files(self) -> Dict[str, Any]:
         """Get list of remote files from server"""
+        headers = self.headers()
+        if self.remote_etag:
+            headers["If-None-Match"] = self.remote_etag
         try:
-            response = requests.get(f"{self.api_url}/files", headers=self.headers())
+            # only what syncing needs: no disk paths, hashes or user names
+            response = requests.get(f"{self.api_url}/files", headers=headers,
+                                    params={"fields": "id,name,folder,updated_at"})
+            if response.status_code == 304:
+                return self.remote_files
             if response.ok:
                 files = response.json()
-                return {file['name']: file for file in files}
+                self.remote_files = {self.remote_key(file.get('folder', '/'), file['name']): file for file in files}
+                self.remote_etag = response.headers.get("ETag")
+                return self.remote_files
         except Exception as e:
             print(f"Error fetching remote files: {e}")
         return {}
 
-    def upload_file(self, file_path: Path) -> bool:
-        """Upload a single file to server"""
+    def lookup(self, file_id: int) -> Optional[Dict[str, Any]]:
+        """The server's current ``id``, ``name``, ``folder`` and ``updated_at`` of one file, or None if it is gone."""
+        response = requests.post(f"{self.api_url}/files/lookup", headers=self.headers(),
+                                 json={"ids": [file_id], "fields": ["id", "name", "folder", "updated_at"]})
+        response.raise_for_status()
+        files = response.json()["files"]
+        return files[0] if files else None
+
+    def upload_file(self, file_path: Path, digest: Optional[str] = None) -> Optional[Dict[str, Any]]:
+        """Upload a single file to server, sending the body only if the server lacks the content.
+
+        Returns the server's entry for the file, or None on failure.
+        """
         try:
+            size = file_path.stat().st_size
+            digest = digest or self.get_file_hash(file_path)
+            try:
+                folder = file_path.parent.relative_to(self.local_folder).as_posix()
+            except ValueError:
+                folder = ""
+            folder = "" if folder == "." else folder
+            check = requests.post(
+                f"{self.api_url}/files/check",
+                headers=self.headers(),
+                json={"name": file_path.name, "size": size, "sha256": digest, "folder": folder},
+            )
+            if not check.ok:
+                return None
+            result = check.json()
+            if result["status"] != "upload":
+                self.uploaded_ids.add(result["file"]["id"])
+                return result["file"]
             with open(file_path, 'rb') as f:
                 response = requests.post(
                     f"{self.api_url}/files", 
                     headers=self.headers(), 
-                    files={"file": (file_path.name, f)}
+                    files={"file": (file_path.name, f)},
+                    data={"upload_token": result["upload_token"], "folder": folder},
                 )
-                return response.ok
+                if not response.ok:
+                    return None
+                entry = response.json()
+                self.uploaded_ids.add(entry.get("id"))
+                return entry
         except Exception as e:
             print(f"Error uploading {file_path.name}: {e}")
-            return False
+            return None
 
     def download_file(self, remote_file: Dict[str, Any], local_path: Path) -> bool:
-        """Download a file from server"""
+        """Download a file from server and record it as synced.
+
+        Written to a temporary name first: an interrupted download never
+        leaves a partial file that would look like a local edit.
+        """
         try:
             response = requests.get(
                 f"{self.api_url}/files/{remote_file['id']}/download", 
                 headers=self.headers()
             )
             if response.ok:
-                with open(local_path, 'wb') as f:
+                local_path.parent.mkdir(parents=True, exist_ok=True)
+                tmp = local_path.with_name(f".{local_path.name}.part")
+                with open(tmp, 'wb') as f:
                     f.write(response.content)
+                os.replace(tmp, local_path)
+                self.remember(local_path, hashlib.sha256(response.content).hexdigest(), remote_file)
                 return True
         except Exception as e:
             print(f"Error downloading {remote_file['name']}: {e}")
@@ -82,29 +169,35 @@ class FolderSync:
             print(f"Local folder {self.local_folder} does not exist")
             return results
 
-        # Get remote files to check for conflicts
-        remote_files = self.get_remote_files()
-        
-        for path in self.local_folder.glob("*"):
+        # Subfolders are mirrored as server folders; files are keyed by relative path
+        for path in self.local_folder.rglob("*"):
             if not path.is_file():
                 continue
             if path.suffix.lower() not in {".py", ".jpg"}:
                 continue
-                
-            # Check if file has changed
+            key = path.relative_to(self.local_folder).as_posix()
+
+            # Same size, mtime and inode as at the last sync: unchanged, not read again
+            st = path.stat()
+            if self.state.unchanged(key, st):
+                results['skipped'] += 1
+                continue
             current_hash = self.get_file_hash(path)
-            if path.name in self.file_hashes and self.file_hashes[path.name] == current_hash:
+            known = self.state.get(key)
+            if known is not None and known.sha256 == current_hash:
+                self.state.record(key, st, current_hash, known.remote_id, known.remote_updated_at)  # only touched
                 results['skipped'] += 1
                 continue
-                
+
             # Upload file
-            if self.upload_file(path):
-                self.file_hashes[path.name] = current_hash
+            entry = self.upload_file(path, current_hash)
+            if entry:
+                self.state.record(key, st, current_hash, entry.get("id"), entry.get("updated_at"))
                 results['uploaded'] += 1
-                results['files'].append(f"✅ Завантажено: {path.name}")
+                results['files'].append(f"✅ Завантажено: {key}")
             else:
                 results['errors'] += 1
-                results['files'].append(f"❌ Помилка: {path.name}")
+                results['files'].append(f"❌ Помилка: {key}")
         
         return results
 
@@ -125,9 +218,16 @@ class FolderSync:
         
         for name, remote_file in remote_files.items():
             local_path = self.local_folder / name
-            
-            # Skip if file already exists and is newer
-            if local_path.exists():
+
+            known = self.state.get(name)
+            if (known is not None and known.remote_id == remote_file.get('id')
+                    and known.remote_updated_at == remote_file.get('updated_at') and local_path.exists()):
+                # the remote file has not changed since the last sync; a local edit is left for the upload
+                results['skipped'] += 1
+                continue
+
+            # Without sync state: skip if file already exists and is newer
+            if known is None and local_path.exists():
                 local_mtime = local_path.stat().st_mtime
                 # Convert remote timestamp to local time
                 try:
@@ -187,15 +287,80 @@ class FolderSync:
         else:
             return {"error": f"Unknown sync mode: {mode}"}
 
-    def run_watch(self, interval_seconds: int = 5, mode: str = "upload_only"):
-        """Run continuous sync in background"""
+    def iter_events(self, since: Optional[int] = None, retry_seconds: int = 5) -> Iterator[Tuple[str, Dict[str, Any]]]:
+        """Yield ``(kind, event)`` from the server's change feed, reconnecting after errors.
+
+        Reconnects resume from the last seen id via ``Last-Event-ID``.
+        """
+        last_id = since
         while True:
+            self.last_event_id = last_id
+            headers = self.headers()
+            headers["Accept"] = "text/event-stream"
+            if last_id is not None:
+                headers["Last-Event-ID"] = str(last_id)
             try:
-                results = self.sync_once(mode)
-                if results.get('uploaded', 0) > 0 or results.get('downloaded', 0) > 0:
-                    print(f"Sync completed: {results}")
+                with requests.get(f"{self.api_url}/files/events", headers=headers, stream=True, timeout=(10, 60)) as response:
+                    response.raise_for_status()
+                    kind, data = None, {}
+                    for line in response.iter_lines(chunk_size=None, decode_unicode=True):
+                        if line.startswith("id:"):
+                            last_id = int(line[3:].strip())
+                        elif line.startswith("event:"):
+                            kind = line[6:].strip()
+                        elif line.startswith("data:"):
+                            data = json.loads(line[5:].strip() or "{}")
+                        elif line == "" and kind:
+                            self.last_event_id = last_id
+                            yield kind, data
+                            kind, data = None, {}
+            except Exception as e:
+                print(f"Event stream error: {e}")
+            time.sleep(retry_seconds)
+
+    def follow_remote_changes(self) -> None:
+        """Download exactly the files the server reports as new.
+
+        The feed position is kept in the sync state, so after a restart the
+        feed resumes with the first event not handled yet.
+        """
+        since = self.state.get_meta("last_event_id")
+        for kind, event in self.iter_events(since=int(since) if since else None):
+            try:
+                if kind in ("reset", "bulk"):
+                    # Missed events or a bulk import: fall back to one full comparison
+                    self.sync_download_only()
+                elif kind in ("created", "updated") and event.get("file_id") not in self.uploaded_ids:
+                    # recorded with its updated_at, so a later full comparison knows the file is current
+                    remote_file = self.lookup(event["file_id"])
+                    if remote_file is not None:  # else deleted since; its own event follows
+                        key = self.remote_key(remote_file.get("folder", "/"), remote_file["name"])
+                        if self.download_file(remote_file, self.local_folder / key):
+                            print(f"Sync downloaded: {key}")
             except Exception as e:
                 print(f"Sync error: {e}")
-            time.sleep(interval_seconds)
+            if self.last_event_id is not None:
+                self.state.set_meta("last_event_id", str(self.last_event_id))
 
+    def run_watch(self, interval_seconds: int = 5, mode: str = "upload_only"):
+        """Run continuous sync in background.
 
+        Remote changes are pushed by the server and handled as they arrive;
+        only the local folder is re-checked every ``interval_seconds``.
+        """
+        try:
+            self.sync_once(mode)
+        except Exception as e:
+            print(f"Sync error: {e}")
+        if mode in ("download_only", "bidirectional"):
+            threading.Thread(target=self.follow_remote_changes, daemon=True).start()
+        while True:
+            time.sleep(interval_seconds)
+            if mode not in ("upload_only", "bidirectional"):
+                continue
+            try:
+                results = self.sync_upload_only()
+                if results.get('uploaded', 0) > 0:
+                    print(f"Sync completed: {results}")
+            except Exception as e:
+                print(f"Sync error: {e}")
@@ -0,0 +1,85 @@
+"""Per-file state of a synced folder, kept across restarts.
+
+One SQLite file (by default ``<folder>/.minidrive-sync.db``) holds a row per
+synced file: its relative path, the size, mtime and inode it had when it was
+last synced, its SHA-256, the remote file id and ``updated_at``, and when
+the sync happened. A file whose size, mtime and inode still match its row is
+unchanged and is not read again, so restarting the client on a large folder
+costs one ``stat`` per file. Every row is committed as soon as its transfer
+finishes: an interrupted sync resumes with the files that were not done yet.
+
+The state belongs to one account on one server; opened for another, it
+starts empty.
+"""
+import os
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import NamedTuple, Optional
+
+STATE_FILE = ".minidrive-sync.db"
+
+
+class FileState(NamedTuple):
+    path: str
+    size: int
+    mtime_ns: int
+    inode: int
+    sha256: str
+    remote_id: Optional[int]
+    remote_updated_at: Optional[str]
+    synced_at: float
+
+
+class SyncState:
+    def __init__(self, db_path: Path, owner: str) -> None:
+        db_path.parent.mkdir(parents=True, exist_ok=True)
+        # the watcher and the change-feed thread share one connection
+        self._conn = sqlite3.connect(db_path, timeout=30, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock, self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, size INTEGER NOT NULL, "
+                "mtime_ns INTEGER NOT NULL, inode INTEGER NOT NULL, sha256 TEXT NOT NULL, remote_id INTEGER, "
+                "remote_updated_at TEXT, synced_at REAL NOT NULL)"
+            )
+            self._conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+            row = self._conn.execute("SELECT value FROM meta WHERE key = 'owner'").fetchone()
+            if row is None or row[0] != owner:
+                self._conn.execute("DELETE FROM files")
+                self._conn.execute("DELETE FROM meta")
+                self._conn.execute("INSERT INTO meta VALUES ('owner', ?)", (owner,))
+
+    def get(self, path: str) -> Optional[FileState]:
+        with self._lock:
+            row = self._conn.execute("SELECT * FROM files WHERE path = ?", (path,)).fetchone()
+        return FileState(*row) if row else None
+
+    def unchanged(self, path: str, st: os.stat_result) -> Optional[FileState]:
+        """The row for ``path`` if the file still has the size, mtime and inode recorded in it."""
+        state = self.get(path)
+        if state is None or (state.size, state.mtime_ns, state.inode) != (st.st_size, st.st_mtime_ns, st.st_ino):
+            return None
+        return state
+
+    def record(self, path: str, st: os.stat_result, sha256: str, remote_id: Optional[int] = None,
+               remote_updated_at: Optional[str] = None) -> None:
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (path, st.st_size, st.st_mtime_ns, st.st_ino, sha256, remote_id, remote_updated_at, time.time()),
+            )
+
+    def get_meta(self, key: str) -> Optional[str]:
+        with self._lock:
+            row = self._conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def set_meta(self, key: str, value: str) -> None:
+        with self._lock, self._conn:
+            self._conn.execute("INSERT OR REPLACE INTO meta VALUES (?, ?)", (key, value))
+
+    def close(self) -> None:
+        self._conn.close()
@@ -45,6 +45,7 @@ TPL = """
         .file-list { display: grid; gap: 10px; }
         .file-item { display: flex; align-items: center; justify-content: space-between; padding: 15px; background: #f8f9fa; border-radius: 4px; border: 1px solid #e9ecef; }
         .file-info { flex: 1; }
+        .file-thumb { width: 64px; height: 64px; margin-right: 15px; flex: none; background-repeat: no-repeat; }
         .file-name { font-weight: bold; color: #333; }
         .file-meta { color: #666; font-size: 0.9em; margin-top: 5px; }
         .file-actions { display: flex; gap: 10px; }
@@ -53,6 +54,10 @@ TPL = """
         .preview-content { max-height: 400px; overflow-y: auto; }
         .preview-text { background: white; padding: 15px; border-radius: 4px; font-family: monospace; white-space: pre-wrap; }
         .preview-image { max-width: 100%; max-height: 400px; border-radius: 4px; box-shadow: 0 2px 8px rgba(0,0,0,0.1); }
+        .tile-toolbar { display: flex; gap: 10px; margin-bottom: 10px; align-items: center; }
+        .tile-viewport { position: relative; height: 380px; overflow: auto; background: #222; border-radius: 4px; cursor: grab; }
+        .tile-layer { position: relative; }
+        .tile-layer img { position: absolute; display: block; }
         
         /* Syntax highlighting styles */
         .preview-content pre {
@@ -138,13 +143,12 @@ TPL = """
                 <button class="btn" onclick="refreshFiles()">🔄 Оновити</button>
                 <select id="filter-type" onchange="refreshFiles()">
                     <option value="all">Всі файли</option>
-                    <option value="py">Python (.py)</option>
-                    <option value="jpg">Зображення (.jpg)</option>
     </select>
                 <select id="sort-order" onchange="refreshFiles()">
                     <option value="asc">Сортування: А-Я</option>
                     <option value="desc">Сортування: Я-А</option>
     </select>
+                <input type="search" id="name-search" placeholder="🔍 Пошук за назвою" onchange="refreshFiles()">
             </div>
 
             <!-- Sync Section -->
@@ -185,16 +189,40 @@ TPL = """
 
     <script>
         let currentFiles = [];
+
+        function refreshStats() {
+            fetch('/api/files/stats')
+                .then(response => response.json())
+                .then(stats => renderFacets(stats))
+                .catch(error => console.error('Error loading stats:', error));
+        }
+
+        function renderFacets(stats) {
+            const select = document.getElementById('filter-type');
+            const current = select.value;
+            select.innerHTML = `<option value="all">Всі файли (${stats.total.count})</option>`;
+            stats.extensions.forEach(facet => {
+                const value = facet.extension.replace(/^\./, '');
+                const option = document.createElement('option');
+                option.value = value;
+                option.textContent = `${facet.extension} (${facet.count})`;
+                select.appendChild(option);
+            });
+            select.value = Array.from(select.options).some(o => o.value === current) ? current : 'all';
+        }
         
         function refreshFiles() {
             const filterType = document.getElementById('filter-type').value;
             const sortOrder = document.getElementById('sort-order').value;
+            const search = encodeURIComponent(document.getElementById('name-search').value.trim());
             
-            fetch(`/api/files?type=${filterType}&order=${sortOrder}`)
+            fetch(`/api/files?type=${filterType}&order=${sortOrder}&name_contains=${search}`)
                 .then(response => response.json())
                 .then(files => {
                     currentFiles = files;
                     renderFiles(files);
+                    loadThumbnails(files);
+                    refreshStats();
                 })
                 .catch(error => {
                     console.error('Error:', error);
@@ -215,6 +243,7 @@ TPL = """
                 const fileItem = document.createElement('div');
                 fileItem.className = 'file-item';
                 fileItem.innerHTML = `
+                    ${THUMB_EXTENSIONS.includes(file.extension) ? `<div class="file-thumb" data-thumb="${file.id}"></div>` : ''}
                     <div class="file-info">
                         <div class="file-name">${escapeHtml(file.name)}</div>
                         <div class="file-meta">
@@ -232,8 +261,66 @@ TPL = """
             });
         }
 
+        // One request and one image (a sprite sheet) for all thumbnails in the list
+        const THUMB_EXTENSIONS = ['.jpg', '.jpeg', '.png'];
+        let thumbSheetUrl = null;
+
+        function loadThumbnails(files) {
+            const ids = files.filter(f => THUMB_EXTENSIONS.includes(f.extension)).map(f => f.id).slice(0, 500);
+            if (ids.length === 0) return;
+            fetch('/api/files/thumbnails', {
+                method: 'POST',
+                headers: { 'Content-Type': 'application/json' },
+                body: JSON.stringify({ ids: ids, size: 64 })
+            })
+                .then(response => response.ok ? response.json() : Promise.reject(response.status))
+                .then(sheet => fetch(sheet.image).then(r => r.blob()).then(blob => {
+                    if (thumbSheetUrl) URL.revokeObjectURL(thumbSheetUrl);
+                    thumbSheetUrl = URL.createObjectURL(blob);
+                    sheet.thumbnails.forEach(cell => {
+                        const el = document.querySelector(`[data-thumb="${cell.id}"]`);
+                        if (!el) return;
+                        el.style.backgroundImage = `url(${thumbSheetUrl})`;
+                        el.style.backgroundPosition = `-${cell.x}px -${cell.y}px`;
+                        el.style.width = `${cell.width}px`;
+                        el.style.height = `${cell.height}px`;
+                    });
+                }))
+                .catch(error => console.error('Thumbnails:', error));
+        }
+
         function canPreview(extension) {
-            return extension === '.py' || extension === '.jpg';
+            return extension === '.py' || extension === '.jpg' || DOCUMENT_EXTENSIONS.includes(extension);
+        }
+
+        // Text extracted on the server, shown a page at a time
+        const DOCUMENT_EXTENSIONS = ['.docx', '.pdf'];
+
+        function showDocumentPreview(fileId, page) {
+            const previewSection = document.getElementById('preview-section');
+            const previewContent = document.getElementById('preview-content');
+            fetch(`/api/files/${fileId}/preview?page=${page}`)
+                .then(response => {
+                    if (!response.ok) {
+                        throw new Error(`HTTP error! status: ${response.status}`);
+                    }
+                    return response.json();
+                })
+                .then(data => {
+                    const pager = data.pages > 1 ? `
+                        <div class="tile-toolbar">
+                            <button class="btn" ${data.page <= 1 ? 'disabled' : ''} onclick="showDocumentPreview(${fileId}, ${data.page - 1})">◀</button>
+                            <span style="color: #666;">${data.page} / ${data.pages}</span>
+                            <button class="btn" ${data.page >= data.pages ? 'disabled' : ''} onclick="showDocumentPreview(${fileId}, ${data.page + 1})">▶</button>
+                        </div>` : '';
+                    previewContent.innerHTML = pager + `<div class="preview-text">${escapeHtml(data.content || data.summary || '')}</div>`;
+                    previewSection.classList.remove('hidden');
+                    previewSection.scrollIntoView({ behavior: 'smooth' });
+                })
+                .catch(error => {
+                    console.error('Error loading preview:', error);
+                    alert('Помилка завантаження превʼю: ' + error.message);
+                });
         }
 
         function previewFile(fileId) {
@@ -272,8 +359,119 @@ TPL = """
                         alert('Помилка завантаження превʼю: ' + error.message);
                     });
             } else if (file.extension === '.jpg') {
-                // For JPG files, display image directly
+                showImagePreview(fileId);
+            } else if (DOCUMENT_EXTENSIONS.includes(file.extension)) {
+                showDocumentPreview(fileId, 1);
+            }
+        }
+
+        // Images larger than this are shown through the tile pyramid instead of the original
+        const TILED_MIN_SIDE = 2048;
+        let tileViewer = null;
+
+        function showImagePreview(fileId) {
+            const previewContent = document.getElementById('preview-content');
+            const showWhole = () => {
+                tileViewer = null;
                 previewContent.innerHTML = `<img src="/api/files/${fileId}/preview" class="preview-image" alt="Preview" onload="document.getElementById('preview-section').classList.remove('hidden'); document.getElementById('preview-section').scrollIntoView({ behavior: 'smooth' });">`;
+            };
+            fetch(`/api/files/${fileId}/tiles`)
+                .then(response => response.ok ? response.json() : null)
+                .then(manifest => {
+                    if (!manifest || Math.max(manifest.width, manifest.height) <= TILED_MIN_SIDE) {
+                        showWhole();
+                        return;
+                    }
+                    openTileViewer(fileId, manifest);
+                })
+                .catch(showWhole);
+        }
+
+        function openTileViewer(fileId, manifest) {
+            const previewSection = document.getElementById('preview-section');
+            const previewContent = document.getElementById('preview-content');
+            previewContent.innerHTML = `
+                <div class="tile-toolbar">
+                    <button class="btn" onclick="tileZoom(1)">➕</button>
+                    <button class="btn" onclick="tileZoom(-1)">➖</button>
+                    <span id="tile-info" style="color: #666;"></span>
+                </div>
+                <div class="tile-viewport" id="tile-viewport"><div class="tile-layer" id="tile-layer"></div></div>`;
+            previewSection.classList.remove('hidden');
+
+            const viewport = document.getElementById('tile-viewport');
+            // Start at the largest level that fits the viewport
+            let level = manifest.max_level;
+            while (level > 0 && (manifest.levels[level].width > viewport.clientWidth || manifest.levels[level].height > viewport.clientHeight)) {
+                level--;
+            }
+            tileViewer = { fileId, manifest, level, loaded: new Set() };
+            setTileLevel(level, 0.5, 0.5);
+
+            viewport.addEventListener('scroll', renderVisibleTiles);
+            let drag = null;
+            viewport.addEventListener('mousedown', e => { drag = { x: e.clientX, y: e.clientY, left: viewport.scrollLeft, top: viewport.scrollTop }; e.preventDefault(); });
+            window.addEventListener('mouseup', () => { drag = null; });
+            viewport.addEventListener('mousemove', e => {
+                if (!drag) return;
+                viewport.scrollLeft = drag.left - (e.clientX - drag.x);
+                viewport.scrollTop = drag.top - (e.clientY - drag.y);
+            });
+            previewSection.scrollIntoView({ behavior: 'smooth' });
+        }
+
+        function tileZoom(step) {
+            if (!tileViewer) return;
+            const viewport = document.getElementById('tile-viewport');
+            const size = tileViewer.manifest.levels[tileViewer.level];
+            // keep the point in the middle of the viewport where it is
+            const cx = (viewport.scrollLeft + viewport.clientWidth / 2) / size.width;
+            const cy = (viewport.scrollTop + viewport.clientHeight / 2) / size.height;
+            const level = Math.min(tileViewer.manifest.max_level, Math.max(0, tileViewer.level + step));
+            if (level !== tileViewer.level) {
+                setTileLevel(level, cx, cy);
+            }
+        }
+
+        function setTileLevel(level, cx, cy) {
+            const viewport = document.getElementById('tile-viewport');
+            const layer = document.getElementById('tile-layer');
+            const size = tileViewer.manifest.levels[level];
+            tileViewer.level = level;
+            tileViewer.loaded = new Set();
+            layer.innerHTML = '';
+            layer.style.width = `${size.width}px`;
+            layer.style.height = `${size.height}px`;
+            viewport.scrollLeft = cx * size.width - viewport.clientWidth / 2;
+            viewport.scrollTop = cy * size.height - viewport.clientHeight / 2;
+            document.getElementById('tile-info').textContent =
+                `${size.width}×${size.height} з ${tileViewer.manifest.width}×${tileViewer.manifest.height}`;
+            renderVisibleTiles();
+        }
+
+        function renderVisibleTiles() {
+            if (!tileViewer) return;
+            const viewport = document.getElementById('tile-viewport');
+            const layer = document.getElementById('tile-layer');
+            const { fileId, manifest, level, loaded } = tileViewer;
+            const ts = manifest.tile_size;
+            const size = manifest.levels[level];
+            const x0 = Math.max(0, Math.floor(viewport.scrollLeft / ts));
+            const y0 = Math.max(0, Math.floor(viewport.scrollTop / ts));
+            const x1 = Math.min(Math.ceil(size.width / ts) - 1, Math.floor((viewport.scrollLeft + viewport.clientWidth) / ts));
+            const y1 = Math.min(Math.ceil(size.height / ts) - 1, Math.floor((viewport.scrollTop + viewport.clientHeight) / ts));
+            for (let x = x0; x <= x1; x++) {
+                for (let y = y0; y <= y1; y++) {
+                    const key = `${x}_${y}`;
+                    if (loaded.has(key)) continue;
+                    loaded.add(key);
+                    const img = document.createElement('img');
+                    img.src = `/api/files/${fileId}/tiles/${level}/${key}.jpg`;
+                    img.style.left = `${x * ts}px`;
+                    img.style.top = `${y * ts}px`;
+                    img.draggable = false;
+                    layer.appendChild(img);
+                }
             }
         }
 
@@ -465,6 +663,11 @@ TPL = """
 
 TOKEN = None
 
+# Last listing per query: (ETag, files). Revalidated against the API with If-None-Match.
+LISTING_CACHE = {}
+# What the file list renders; the API leaves out the rest (disk paths, hashes, ...)
+LISTING_FIELDS = "id,name,extension,uploader,created_at"
+
 @app.route("/", methods=["GET"])
 def index():
     return render_template_string(TPL, token=TOKEN)
@@ -496,6 +699,7 @@ def register():
 def logout():
     global TOKEN
     TOKEN = None
+    LISTING_CACHE.clear()
     flash("Ви вийшли з системи", "success")
     return redirect("/")
 
@@ -508,11 +712,42 @@ def api_get_files():
     
     ftype = request.args.get("type", "all")
     order = request.args.get("order", "desc")
+    search = request.args.get("name_contains", "")
     
-    r = requests.get(f"{API_URL}/files", headers={"Authorization": f"Bearer {TOKEN}"}, params={"type": ftype, "sort_by": "uploader", "order": order})
+    cache_key = (TOKEN, ftype, order, search)
+    headers = {"Authorization": f"Bearer {TOKEN}"}
+    cached = LISTING_CACHE.get(cache_key)
+    if cached:
+        headers["If-None-Match"] = cached[0]
+    r = requests.get(f"{API_URL}/files", headers=headers, params={"type": ftype, "sort_by": "uploader", "order": order, "name_contains": search,
+                                                                "fields": LISTING_FIELDS})
+    if r.status_code == 304 and cached:
+        etag, files = cached
+    elif r.ok:
+        etag, files = r.headers.get("ETag"), r.json()
+        if etag:
+            LISTING_CACHE[cache_key] = (etag, files)
+    else:
+        return jsonify({"error": "Failed to fetch files"}), 500
+
+    if etag and etag in request.headers.get("If-None-Match", ""):
+        return "", 304, {"ETag": etag}
+    response = jsonify(files)
+    if etag:
+        response.headers["ETag"] = etag
+        response.headers["Cache-Control"] = "private, no-cache"
+    return response
+
+
+@app.route("/api/files/stats", methods=["GET"])
+def api_get_stats():
+    if not TOKEN:
+        return jsonify({"error": "Unauthorized"}), 401
+
+    r = requests.get(f"{API_URL}/files/stats", headers={"Authorization": f"Bearer {TOKEN}"})
     if r.ok:
         return jsonify(r.json())
-    return jsonify({"error": "Failed to fetch files"}), 500
+    return jsonify({"error": "Failed to fetch stats"}), 500
 
 
 @app.route("/api/files", methods=["POST"])
@@ -536,13 +771,26 @@ def api_upload_file():
     return jsonify({"error": "Upload failed"}), 500
 
 
+@app.route("/api/files/thumbnails", methods=["POST"])
+def api_thumbnails():
+    if not TOKEN:
+        return jsonify({"error": "Unauthorized"}), 401
+
+    r = requests.post(f"{API_URL}/files/thumbnails", headers={"Authorization": f"Bearer {TOKEN}"},
+                      json=request.get_json(silent=True) or {})
+    if r.ok:
+        return jsonify(r.json())
+    return jsonify({"error": f"Server error: {r.status_code}"}), r.status_code
+
+
 @app.route("/api/files/<int:file_id>/preview", methods=["GET"])
 def api_preview_file(file_id):
     if not TOKEN:
         return jsonify({"error": "Unauthorized"}), 401
     
     try:
-        r = requests.get(f"{API_URL}/files/{file_id}/preview", headers={"Authorization": f"Bearer {TOKEN}"})
+        r = requests.get(f"{API_URL}/files/{file_id}/preview", headers={"Authorization": f"Bearer {TOKEN}"},
+                         params=request.args)
         print(f"Server response status: {r.status_code}")
         print(f"Server response headers: {r.headers}")
         
@@ -571,6 +819,29 @@ def api_preview_file(file_id):
         return jsonify({"error": f"Request failed: {str(e)}"}), 500
 
 
+@app.route("/api/files/<int:file_id>/tiles", methods=["GET"])
+def api_tile_manifest(file_id):
+    if not TOKEN:
+        return jsonify({"error": "Unauthorized"}), 401
+
+    r = requests.get(f"{API_URL}/files/{file_id}/tiles", headers={"Authorization": f"Bearer {TOKEN}"})
+    if r.ok:
+        return jsonify(r.json())
+    return jsonify({"error": f"Server error: {r.status_code}"}), r.status_code
+
+
+@app.route("/api/files/<int:file_id>/tiles/<int:level>/<int:x>_<int:y>.jpg", methods=["GET"])
+def api_tile_image(file_id, level, x, y):
+    if not TOKEN:
+        return jsonify({"error": "Unauthorized"}), 401
+
+    r = requests.get(f"{API_URL}/files/{file_id}/tiles/{level}/{x}_{y}.jpg", headers={"Authorization": f"Bearer {TOKEN}"})
+    if r.ok:
+        from flask import Response
+        return Response(r.content, mimetype="image/jpeg", headers={"Cache-Control": "private, max-age=86400"})
+    return jsonify({"error": f"Server error: {r.status_code}"}), r.status_code
+
+
 @app.route("/api/files/<int:file_id>/download", methods=["GET"])
 def api_download_file(file_id):
     if not TOKEN:
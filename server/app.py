@@ -1,9 +1,15 @@
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
+import base64
+import io
+import json
+import math
 import os
+import threading
 from pathlib import Path
 from typing import Optional
 
-from flask import Flask, jsonify, request, send_file
+from flask import Flask, Response, jsonify, request, send_file
 from flask_cors import CORS
 from flask_jwt_extended import (
     JWTManager,
@@ -11,14 +17,23 @@ from flask_jwt_extended import (
     get_jwt_identity,
     jwt_required,
 )
+from itsdangerous import BadSignature, URLSafeTimedSerializer
 from werkzeug.utils import secure_filename
+from PIL import Image
 import unicodedata
 import re
+import hashlib
+import hmac
+import secrets
 
-from sqlalchemy import create_engine, select, func
+from sqlalchemy import select, func, or_
 from sqlalchemy.orm import sessionmaker, scoped_session
 
-from .models import Base, User, FileEntry
+from . import (
+    archive, blobs, bytecache, collection, events, extract, folders, profiling, reaper, search, sqlstats, storage,
+    thumbs, tiles,
+)
+from .models import User, FileEntry, Folder, create_db_engine, init_db
 
 
 def secure_filename_unicode(filename):
@@ -43,7 +58,45 @@ def secure_filename_unicode(filename):
     return safe_chars
 
 
-def create_app() -> Flask:
+def listing_etag(user_id: int, version: int, args) -> str:
+    """ETag for ``GET /files``: owner, collection version and the normalised query string."""
+    query = "&".join(f"{k}={v}" for k, v in sorted(args.items(multi=True)))
+    digest = hashlib.sha1(query.encode("utf-8")).hexdigest()[:16]
+    return f"{user_id}-{version}-{digest}"
+
+
+PREVIEW_PAGE_SIZE = 200  # lines per page of a text preview
+PREVIEW_MAX_PAGE_SIZE = 5000
+UPLOAD_TOKEN_MAX_AGE = 3600  # seconds between /files/check and the upload it allows
+
+
+def start_background_jobs(app: Flask) -> None:
+    """Start the reaper thread and, if the volume set changed, the rebalancer.
+
+    Every worker process starts them, but only the worker holding
+    ``<CACHE_ROOT>/.reaper.lock`` (or the rebalance lock) does the work.
+    """
+    session_factory = app.extensions["db_session"].session_factory
+    store = app.extensions["storage"]
+    if app.config["REAPER_INTERVAL"] > 0:
+        reaper.start_reaper(
+            session_factory, app.config["REAPER_INTERVAL"], app.config["CACHE_ROOT"],
+            event_retention=timedelta(hours=app.config["EVENTS_RETENTION_HOURS"]), storage=store,
+            lock_path=os.path.join(app.config["CACHE_ROOT"], ".reaper.lock"),
+        )
+    if store.needs_rebalance():
+        storage.start_rebalancer(store, session_factory)
+
+
+def create_app(init_schema: bool = True, background_jobs: bool = True) -> Flask:
+    """Build the API application.
+
+    ``init_schema=False`` is used by the production launcher (``server.serve``),
+    which creates the schema once in the master process before forking workers.
+    ``background_jobs=False`` keeps maintenance commands from starting the
+    in-process reaper thread (see ``start_background_jobs``); the launcher
+    also uses it when it builds the app in the master, before forking.
+    """
     app = Flask(__name__)
     CORS(app)
     app.config["JWT_SECRET_KEY"] = os.environ.get("JWT_SECRET_KEY", "dev-secret")
@@ -51,20 +104,88 @@ def create_app() -> Flask:
     app.config["SQLALCHEMY_DATABASE_URI"] = os.environ.get(
         "DATABASE_URL", f"sqlite:///{Path(__file__).parent / 'app.db'}"
     )
+    app.config["CACHE_ROOT"] = os.environ.get("CACHE_ROOT", str(Path(__file__).parent / "cache"))
+    app.config["REAPER_INTERVAL"] = float(os.environ.get("REAPER_INTERVAL", "60"))  # 0 disables
+    app.config["EVENTS_POLL_INTERVAL"] = float(os.environ.get("EVENTS_POLL_INTERVAL", "0.5"))
+    app.config["EVENTS_RETENTION_HOURS"] = float(os.environ.get("EVENTS_RETENTION_HOURS", "24"))
+    # open SSE streams / waiting long polls per process; each holds a worker thread
+    app.config["EVENTS_MAX_WAITERS"] = int(os.environ.get("EVENTS_MAX_WAITERS", str(events.MAX_WAITERS)))
+    app.config["PROFILE_SECRET"] = os.environ.get("PROFILE_SECRET")
+    app.config["PROFILE_SAMPLE_RATE"] = float(os.environ.get("PROFILE_SAMPLE_RATE", "0"))
+    app.config["PROFILE_DIR"] = os.environ.get("PROFILE_DIR", str(Path(__file__).parent / "profiles"))
+    app.config["PROFILE_MODE"] = os.environ.get("PROFILE_MODE", "sample")
+    app.config["PROFILE_INTERVAL_MS"] = float(os.environ.get("PROFILE_INTERVAL_MS", "2"))
+    app.config["PROFILE_TRACEMALLOC"] = os.environ.get("PROFILE_TRACEMALLOC") == "1"
+    app.config["MEMORY_CACHE_MB"] = float(os.environ.get("MEMORY_CACHE_MB", "64"))  # 0 disables
+    app.config["MEMORY_CACHE_MAX_ENTRY_KB"] = float(os.environ.get("MEMORY_CACHE_MAX_ENTRY_KB", "256"))
+    app.config["SQL_STATS"] = os.environ.get("SQL_STATS") == "1"
+    app.config["SQL_SLOW_MS"] = float(os.environ.get("SQL_SLOW_MS", "0"))  # 0 disables
+    app.config["SQL_EXPLAIN"] = os.environ.get("SQL_EXPLAIN") == "1"
+    # zip-bomb limits for POST /files/archive
+    app.config["ARCHIVE_MAX_FILES"] = int(os.environ.get("ARCHIVE_MAX_FILES", "10000"))
+    app.config["ARCHIVE_MAX_MB"] = float(os.environ.get("ARCHIVE_MAX_MB", "2048"))
+    app.config["ARCHIVE_MAX_ENTRY_MB"] = float(os.environ.get("ARCHIVE_MAX_ENTRY_MB", "512"))
+    app.config["ARCHIVE_MAX_RATIO"] = float(os.environ.get("ARCHIVE_MAX_RATIO", "100"))
+    app.config["ARCHIVE_BATCH"] = int(os.environ.get("ARCHIVE_BATCH", "500"))
+    app.config["STORAGE_VOLUMES"] = os.environ.get("STORAGE_VOLUMES", "")  # os.pathsep-separated; see server.storage
+    app.config["STORAGE_REPLICAS"] = int(os.environ.get("STORAGE_REPLICAS", "2"))
+    app.config["STORAGE_PACK_MAX_KB"] = float(os.environ.get("STORAGE_PACK_MAX_KB", "0"))  # 0: one file per blob
+    app.config["THUMB_WORKERS"] = int(os.environ.get("THUMB_WORKERS", "4"))  # threads rendering thumbnails
+    app.config["LOOKUP_MAX_IDS"] = int(os.environ.get("LOOKUP_MAX_IDS", "1000"))
+    app.config["SHARD_SECRET"] = os.environ.get("SHARD_SECRET", "")  # set behind server.shards' router
     app.config["JSON_AS_ASCII"] = False  # Enable Unicode support in JSON responses
 
     jwt = JWTManager(app)
 
     # SQLAlchemy (core) engine + session
-    engine = create_engine(app.config["SQLALCHEMY_DATABASE_URI"], future=True)
-    Base.metadata.create_all(engine)
+    engine = create_db_engine(app.config["SQLALCHEMY_DATABASE_URI"])
+    if init_schema:
+        init_db(engine)
     SessionLocal = scoped_session(sessionmaker(bind=engine, autoflush=False, autocommit=False, future=True))
+    app.extensions["db_engine"] = engine
+    app.extensions["db_session"] = SessionLocal
+    search.probe(engine)
+    sqlstats.install(app, engine)
 
     Path(app.config["UPLOAD_ROOT"]).mkdir(parents=True, exist_ok=True)
+    store = storage.StoragePool.from_config(app.config)
+    store.prepare()
+    app.extensions["storage"] = store
 
     def get_db():
         return SessionLocal()
 
+    def read_blob(disk_path: str) -> bytes:
+        with store.open(disk_path) as f:
+            return f.read()
+
+    def get_owned_entry(db, file_id: int, user_id: int) -> Optional[FileEntry]:
+        """The live (not tombstoned) entry ``file_id`` if it belongs to ``user_id``."""
+        entry = db.get(FileEntry, file_id)
+        if entry is None or entry.owner_id != user_id or entry.deleted_at is not None:
+            return None
+        return entry
+
+    if background_jobs:
+        start_background_jobs(app)
+
+    broker = events.EventBroker(SessionLocal.session_factory, app.config["EVENTS_POLL_INTERVAL"])
+    app.extensions["event_broker"] = broker
+    feed_slots = threading.BoundedSemaphore(max(app.config["EVENTS_MAX_WAITERS"], 1))
+
+    profiling.install(app)
+
+    memory_cache = bytecache.ByteCache(
+        int(app.config["MEMORY_CACHE_MB"] * 1024 * 1024), int(app.config["MEMORY_CACHE_MAX_ENTRY_KB"] * 1024)
+    )
+    app.extensions["memory_cache"] = memory_cache
+    thumb_workers = ThreadPoolExecutor(max_workers=app.config["THUMB_WORKERS"], thread_name_prefix="thumbs")
+
+    @app.teardown_appcontext
+    def remove_session(_exc):
+        # scoped_session is thread-local; drop it so gthread workers don't leak sessions
+        SessionLocal.remove()
+
     @app.post("/auth/register")
     def register():
         data = request.get_json(force=True)
@@ -79,6 +200,13 @@ def create_app() -> Flask:
             if exists is not None:
                 return jsonify({"message": "user already exists"}), 409
             user = User(username=username)
+            assigned = request.headers.get("X-Shard-User-Id")
+            if assigned is not None:
+                # ids are global across shards: the router allocates them
+                secret = request.headers.get("X-Shard-Secret", "")
+                if not app.config["SHARD_SECRET"] or not hmac.compare_digest(secret, app.config["SHARD_SECRET"]):
+                    return jsonify({"message": "forbidden"}), 403
+                user.id = int(assigned)
             user.set_password(password)
             db.add(user)
             db.commit()
@@ -105,79 +233,375 @@ def create_app() -> Flask:
     @jwt_required()
     def list_files():
         user_id = int(get_jwt_identity())
-        # filters: type in [all, py, jpg]
-        ftype = (request.args.get("type") or "all").lower()
+        # filters: type is "all" or any extension, with or without the leading dot
+        ftype = (request.args.get("type") or "all").lower().lstrip(".")
         sort_by = (request.args.get("sort_by") or "created_at").lower()
         order = (request.args.get("order") or "desc").lower()
 
         db = get_db()
         try:
-            stmt = select(FileEntry).where(FileEntry.owner_id == user_id)
-            if ftype in {"py", "jpg"}:
-                stmt = stmt.where(FileEntry.extension == f".{ftype}")
+            # The ETag depends only on the owner's collection version and the query,
+            # so an unchanged listing is answered without reading ``files``.
+            version = collection.current_version(db, user_id)
+            etag = listing_etag(user_id, version, request.args)
+            if request.if_none_match.contains_weak(etag):
+                response = app.response_class(status=304)
+                response.set_etag(etag, weak=True)
+                return response
 
-            if sort_by == "uploader":
-                # join with user for uploader name
-                stmt = stmt.join(User, User.id == FileEntry.uploader_id).order_by(
-                    (User.username.asc() if order == "asc" else User.username.desc())
-                )
+            try:
+                fields = collection.parse_fields(request.args.get("fields"))
+            except ValueError as e:
+                return jsonify({"message": str(e)}), 400
+            folder_path = None
+            if "folder" in request.args:
+                try:
+                    folder_path = folders.normalize(request.args["folder"])
+                except folders.FolderError as e:
+                    return jsonify({"message": str(e)}), 400
+            stmt = collection.listing_statement(
+                db, user_id, ftype=ftype, sort_by=sort_by, order=order, folder_path=folder_path,
+                name_contains=request.args.get("name_contains"), name_prefix=request.args.get("name_prefix"),
+                fields=fields,
+            )
+            if fields is None:
+                response = jsonify([r.to_dict() for r in db.execute(stmt).scalars()])
             else:
-                # default by updated_at
-                stmt = stmt.order_by(FileEntry.updated_at.asc() if order == "asc" else FileEntry.updated_at.desc())
-
-            rows = db.execute(stmt).scalars().all()
-            return jsonify([r.to_dict() for r in rows])
+                # only the requested columns are read, and no ORM objects are built
+                response = jsonify([collection.field_dict(r, fields) for r in db.execute(stmt)])
+            response.set_etag(etag, weak=True)
+            response.headers["Cache-Control"] = "private, no-cache"
+            return response
         finally:
             db.close()
 
-    @app.post("/files")
+    @app.post("/files/lookup")
     @jwt_required()
-    def upload_file():
+    def lookup_files():
+        """Metadata of several files in one query: ``{"ids": [...], "fields": "id,name"}``.
+
+        Files in the answer keep the order of ``ids``; ids that are unknown,
+        deleted or not the caller's are listed in ``missing``.
+        """
         user_id = int(get_jwt_identity())
-        if "file" not in request.files:
-            return jsonify({"message": "no file field"}), 400
-        file = request.files["file"]
-        if file.filename == "":
-            return jsonify({"message": "empty filename"}), 400
+        data = request.get_json(silent=True) or {}
+        ids = data.get("ids")
+        if not isinstance(ids, list) or not all(isinstance(i, int) and not isinstance(i, bool) for i in ids):
+            return jsonify({"message": "ids must be a list of file ids"}), 400
+        ids = list(dict.fromkeys(ids))
+        if len(ids) > app.config["LOOKUP_MAX_IDS"]:
+            return jsonify({"message": f"at most {app.config['LOOKUP_MAX_IDS']} ids per request"}), 400
+        try:
+            fields = collection.parse_fields(data.get("fields"))
+        except ValueError as e:
+            return jsonify({"message": str(e)}), 400
 
-        filename = secure_filename_unicode(file.filename)
-        extension = Path(filename).suffix.lower()
+        db = get_db()
+        try:
+            found = collection.lookup(db, user_id, ids, fields) if ids else {}
+            return jsonify({"files": [found[i] for i in ids if i in found],
+                            "missing": [i for i in ids if i not in found]})
+        finally:
+            db.close()
 
+    @app.get("/files/stats")
+    @jwt_required()
+    def files_stats():
+        """Per-extension and per-uploader counts and bytes, read from the maintained aggregates."""
+        user_id = int(get_jwt_identity())
         db = get_db()
         try:
-            user_folder = Path(app.config["UPLOAD_ROOT"]) / str(user_id)
-            user_folder.mkdir(parents=True, exist_ok=True)
-            disk_path = user_folder / filename
-            file.save(disk_path)
+            return jsonify(collection.read_stats(db, user_id))
+        finally:
+            db.close()
+
+    @app.get("/cache/stats")
+    @jwt_required()
+    def cache_stats():
+        """Hit ratio and memory use of this worker's in-memory byte cache."""
+        return jsonify(memory_cache.stats())
+
+    @app.get("/files/events")
+    @jwt_required()
+    def file_events():
+        """Change feed as server-sent events (``Accept: text/event-stream``) or a JSON long poll.
+
+        ``since`` / ``Last-Event-ID`` is the last event id the client has seen;
+        without it the feed starts at the current position. ``wait`` bounds
+        the long poll in seconds (0-60). ``reset`` means the client fell behind the
+        retention window and must re-list.
+
+        A stream or a waiting poll holds a worker thread for as long as it is
+        open, so at most ``EVENTS_MAX_WAITERS`` are served per process; past
+        that the answer is 503 with ``Retry-After``. ``server.serve`` sizes
+        its threads for them.
+        """
+        user_id = int(get_jwt_identity())
+        since = request.headers.get("Last-Event-ID") or request.args.get("since")
+        try:
+            since = int(since) if since else None
+            wait = float(request.args.get("wait", 25))
+        except ValueError:
+            return jsonify({"message": "since and wait must be numbers"}), 400
+        if (since is not None and since < 0) or not math.isfinite(wait):
+            return jsonify({"message": "since and wait must be numbers"}), 400
+        wait = min(max(wait, 0.0), 60.0)
+        as_stream = request.accept_mimetypes.best_match(["application/json", "text/event-stream"]) == "text/event-stream"
+
+        holds_thread = as_stream or wait > 0
+        if holds_thread and not feed_slots.acquire(blocking=False):
+            response = jsonify({"message": "too many open change feeds, retry later"})
+            response.headers["Retry-After"] = "5"
+            return response, 503
+        released = []
+
+        def release():
+            if holds_thread and not released:
+                released.append(True)
+                feed_slots.release()
+
+        try:
+            db = get_db()
+            try:
+                latest = events.latest_id(db, user_id)
+                since = latest if since is None else since
+                sub = broker.subscribe(user_id, since)
+                backlog = events.replay(db, user_id, since)
+            finally:
+                db.close()
+        except BaseException:
+            release()
+            raise
+        if backlog is None:
+            sub.last_id = latest
+        elif backlog:
+            sub.last_id = backlog[-1]["id"]
 
-            now = datetime.utcnow()
+        if not as_stream:
+            try:
+                if backlog is None:
+                    return jsonify({"reset": True, "events": [], "last_id": latest})
+                got = backlog or sub.get(wait)
+                return jsonify({"events": got, "last_id": got[-1]["id"] if got else since})
+            finally:
+                broker.unsubscribe(sub)
+                release()
+
+        def sse(event):
+            return f"id: {event['id']}\nevent: {event['kind']}\ndata: {json.dumps(event, ensure_ascii=False)}\n\n"
+
+        def stream():
+            try:
+                yield ": open\n\n"  # servers send the headers with the first chunk; do not wait 15 s for it
+                if backlog is None:
+                    yield f"id: {latest}\nevent: reset\ndata: {{}}\n\n"
+                pending = backlog or []
+                while pending:
+                    for event in pending:
+                        yield sse(event)
+                    if len(pending) < events.POLL_BATCH:
+                        break
+                    with app.extensions["db_session"].session_factory() as catchup:
+                        pending = events.replay(catchup, user_id, sub.last_id) or []
+                    if pending:
+                        sub.last_id = pending[-1]["id"]
+                while True:
+                    got = sub.get(15)
+                    if not got:
+                        yield ": keep-alive\n\n"
+                    for event in got:
+                        yield sse(event)
+            finally:
+                broker.unsubscribe(sub)
+
+        response = Response(stream(), mimetype="text/event-stream",
+                            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+        @response.call_on_close
+        def closed():
+            # also runs when the client went away before the generator started
+            broker.unsubscribe(sub)
+            release()
+
+        return response
+
+    upload_tokens = URLSafeTimedSerializer(app.config["JWT_SECRET_KEY"], salt="upload-token")
+
+    def add_entry(db, user_id: int, filename: str, disk_path: Path, size: int, digest: Optional[str],
+                  owner_id: Optional[int] = None, folder_path: str = folders.ROOT) -> FileEntry:
+        """Insert the row for a blob just written at ``disk_path``.
+
+        If a live row already names ``disk_path`` the blob was overwritten:
+        that row is updated instead (same id), so no row keeps describing
+        content the server no longer holds. Further rows at the path, left
+        by re-uploads before this, are tombstoned.
+        """
+        now = datetime.utcnow()
+        superseded = db.execute(
+            select(FileEntry).where(FileEntry.disk_path == str(disk_path), FileEntry.deleted_at.is_(None))
+            .order_by(FileEntry.id)
+        ).scalars().all()
+        if superseded:
+            entry = superseded[0]
+            for stale in superseded[1:]:
+                stale.deleted_at = now
+                collection.record_removed(db, stale)
+            before = collection.snapshot(entry)
+            entry.size = size
+            entry.content_hash = digest
+            entry.editor_id = user_id
+            entry.updated_at = now
+            collection.record_replaced(db, before, entry)
+        else:
             entry = FileEntry(
-                owner_id=user_id,
+                owner_id=owner_id or user_id,
+                folder_path=folder_path,
                 uploader_id=user_id,
                 editor_id=user_id,
                 name=filename,
-                extension=extension,
+                extension=Path(filename).suffix.lower(),
                 disk_path=str(disk_path),
+                size=size,
+                content_hash=digest,
                 created_at=now,
                 updated_at=now,
             )
             db.add(entry)
-            db.commit()
-            db.refresh(entry)
+            collection.record_added(db, entry)
+        db.commit()
+        db.refresh(entry)
+        return entry
+
+    @app.post("/files/check")
+    @jwt_required()
+    def check_upload():
+        """Hash-first upload: ``{"name", "size", "sha256"[, "folder"]}`` before sending any bytes.
+
+        ``exists``  an identical live file with this name is already in the folder (200)
+        ``linked``  the owner already has this content elsewhere; a new entry shares
+                    the blob and no body needs to be sent (201)
+        ``upload``  send the body to ``POST /files`` with the returned ``upload_token``
+
+        Only the caller's own files are matched, so a hash never reveals
+        whether another user stores some content.
+        """
+        user_id = int(get_jwt_identity())
+        data = request.get_json(silent=True) or {}
+        name = (data.get("name") or "").strip()
+        digest = (data.get("sha256") or "").lower()
+        size = data.get("size")
+        if not name or not isinstance(size, int) or size < 0 or not re.fullmatch(r"[0-9a-f]{64}", digest):
+            return jsonify({"message": "name, size and sha256 are required"}), 400
+        filename = secure_filename_unicode(name)
+        try:
+            folder_path = folders.normalize(data.get("folder"))
+        except folders.FolderError as e:
+            return jsonify({"message": str(e)}), 400
+
+        db = get_db()
+        try:
+            candidates = db.execute(
+                select(FileEntry).where(
+                    FileEntry.owner_id == user_id,
+                    FileEntry.content_hash == digest,
+                    FileEntry.size == size,
+                    FileEntry.deleted_at.is_(None),
+                )
+            ).scalars().all()
+            candidates = [c for c in candidates if store.exists(c.disk_path)]
+            for candidate in candidates:
+                if candidate.name == filename and candidate.folder_path == folder_path:
+                    return jsonify({"status": "exists", "file": candidate.to_dict()})
+            if candidates:
+                folder = folders.ensure(db, user_id, folder_path)
+                disk_path = folders.blob_dir(app.config["UPLOAD_ROOT"], user_id, folder) / filename
+                store.clone(candidates[0].disk_path, disk_path)
+                entry = add_entry(db, user_id, filename, disk_path, size, digest, folder_path=folder_path)
+                return jsonify({"status": "linked", "file": entry.to_dict()}), 201
+        finally:
+            db.close()
+        token = upload_tokens.dumps({"user_id": user_id, "sha256": digest, "size": size})
+        return jsonify({"status": "upload", "upload_token": token})
+
+    @app.post("/files")
+    @jwt_required()
+    def upload_file():
+        user_id = int(get_jwt_identity())
+        if "file" not in request.files:
+            return jsonify({"message": "no file field"}), 400
+        file = request.files["file"]
+        if file.filename == "":
+            return jsonify({"message": "empty filename"}), 400
+
+        expected = None
+        if request.form.get("upload_token"):
+            try:
+                expected = upload_tokens.loads(request.form["upload_token"], max_age=UPLOAD_TOKEN_MAX_AGE)
+            except BadSignature:
+                return jsonify({"message": "invalid or expired upload token"}), 400
+            if expected.get("user_id") != user_id:
+                return jsonify({"message": "invalid or expired upload token"}), 400
+
+        filename = secure_filename_unicode(file.filename)
+        try:
+            folder_path = folders.normalize(request.form.get("folder"))
+        except folders.FolderError as e:
+            return jsonify({"message": str(e)}), 400
+
+        db = get_db()
+        try:
+            folder = folders.ensure(db, user_id, folder_path)
+            disk_path = folders.blob_dir(app.config["UPLOAD_ROOT"], user_id, folder) / filename
+            try:
+                size, digest = store.write_stream(file.stream, disk_path, expected and expected["sha256"])
+            except blobs.DigestMismatch:
+                return jsonify({"message": "content does not match the checked hash"}), 400
+            entry = add_entry(db, user_id, filename, disk_path, size, digest, folder_path=folder_path)
             return jsonify(entry.to_dict()), 201
         finally:
             db.close()
 
+    @app.post("/files/archive")
+    @jwt_required()
+    def upload_archive():
+        """Upload a ZIP or tar archive as the raw body; each entry becomes a file (``?folder=`` is the base).
+
+        201 with per-entry results; 400 if the body is not a readable archive
+        and 413 if a zip-bomb limit stopped extraction. In both error cases the
+        entries extracted before that point are kept and listed.
+        """
+        user_id = int(get_jwt_identity())
+        try:
+            base = folders.normalize(request.args.get("folder"))
+        except folders.FolderError as e:
+            return jsonify({"message": str(e)}), 400
+        limits = archive.Limits(
+            max_files=app.config["ARCHIVE_MAX_FILES"],
+            max_bytes=int(app.config["ARCHIVE_MAX_MB"] * 1024 * 1024),
+            max_entry_bytes=int(app.config["ARCHIVE_MAX_ENTRY_MB"] * 1024 * 1024),
+            max_ratio=app.config["ARCHIVE_MAX_RATIO"],
+        )
+        db = get_db()
+        try:
+            report = archive.import_archive(db, store, user_id, request.stream, base, limits,
+                                            batch_size=app.config["ARCHIVE_BATCH"])
+        finally:
+            db.close()
+        if "error" in report:
+            report["message"] = report["error"]
+            return jsonify(report), 413 if report["limit"] else 400
+        return jsonify(report), 201
+
     @app.get("/files/<int:file_id>/download")
     @jwt_required()
     def download_file(file_id: int):
         user_id = int(get_jwt_identity())
         db = get_db()
         try:
-            entry = db.get(FileEntry, file_id)
-            if entry is None or entry.owner_id != user_id:
+            entry = get_owned_entry(db, file_id, user_id)
+            if entry is None:
                 return jsonify({"message": "not found"}), 404
-            return send_file(entry.disk_path, as_attachment=True, download_name=entry.name)
+            return send_file(store.source(entry.disk_path), as_attachment=True, download_name=entry.name)
         finally:
             db.close()
 
@@ -187,45 +611,435 @@ def create_app() -> Flask:
         user_id = int(get_jwt_identity())
         db = get_db()
         try:
-            entry = db.get(FileEntry, file_id)
-            if entry is None or entry.owner_id != user_id:
+            entry = get_owned_entry(db, file_id, user_id)
+            if entry is None:
                 return jsonify({"message": "not found"}), 404
-            try:
-                if os.path.exists(entry.disk_path):
-                    os.remove(entry.disk_path)
-            except Exception:
-                # Ignore disk errors on delete, keep DB consistent with user action
-                pass
-            db.delete(entry)
+            # Tombstone only; server.reaper removes the blob and the row in the background
+            entry.deleted_at = datetime.utcnow()
+            collection.record_removed(db, entry)
             db.commit()
             return jsonify({"message": "deleted"})
         finally:
             db.close()
 
+    def _transfer_target(db, user_id: int, entry: FileEntry):
+        """``(owner_id, folder_path, filename, disk_path)`` named by a copy/move body
+        (``name``, ``folder``, ``to_user``), or an error."""
+        data = request.get_json(silent=True) or {}
+        owner_id = user_id
+        if data.get("to_user"):
+            owner_id = db.execute(
+                select(User.id).where(func.lower(User.username) == str(data["to_user"]).strip().lower())
+            ).scalar()
+            if owner_id is None:
+                return None, (jsonify({"message": "no such user"}), 404)
+        filename = secure_filename_unicode(data["name"]) if data.get("name") else entry.name
+        try:
+            folder_path = folders.normalize(data["folder"]) if "folder" in data else entry.folder_path
+        except folders.FolderError as e:
+            return None, (jsonify({"message": str(e)}), 400)
+        if (owner_id, folder_path, filename) == (entry.owner_id, entry.folder_path, entry.name):
+            return None, (jsonify({"message": "source and destination are the same"}), 400)
+        folder = folders.ensure(db, owner_id, folder_path)
+        disk_path = folders.blob_dir(app.config["UPLOAD_ROOT"], owner_id, folder) / filename
+        taken = db.execute(
+            select(FileEntry.id).where(
+                or_(
+                    FileEntry.disk_path == str(disk_path),
+                    (FileEntry.owner_id == owner_id) & (FileEntry.folder_path == folder_path)
+                    & (FileEntry.name == filename),
+                ),
+                FileEntry.deleted_at.is_(None),
+                FileEntry.id != entry.id,
+            ).limit(1)
+        ).scalar()
+        if taken is not None:
+            return None, (jsonify({"message": "a file with this name already exists"}), 409)
+        return (owner_id, folder_path, filename, disk_path), None
+
+    @app.post("/files/<int:file_id>/copy")
+    @jwt_required()
+    def copy_file(file_id: int):
+        """Duplicate a file on the server (optionally renamed or into ``to_user``'s files).
+
+        The bytes are never read by Python: see ``blobs.clone_file``.
+        """
+        user_id = int(get_jwt_identity())
+        db = get_db()
+        try:
+            entry = get_owned_entry(db, file_id, user_id)
+            if entry is None:
+                return jsonify({"message": "not found"}), 404
+            target, error = _transfer_target(db, user_id, entry)
+            if error:
+                return error
+            owner_id, folder_path, filename, disk_path = target
+            try:
+                method = store.clone(entry.disk_path, disk_path)
+            except OSError:
+                return jsonify({"message": "cannot copy file"}), 500
+            copy = add_entry(db, user_id, filename, disk_path, entry.size, entry.content_hash,
+                             owner_id=owner_id, folder_path=folder_path)
+            return jsonify(copy.to_dict() | {"method": method}), 201
+        finally:
+            db.close()
+
+    @app.post("/files/<int:file_id>/move")
+    @jwt_required()
+    def move_file(file_id: int):
+        """Rename a file or hand it to ``to_user``; only metadata and a directory entry change."""
+        user_id = int(get_jwt_identity())
+        db = get_db()
+        try:
+            entry = get_owned_entry(db, file_id, user_id)
+            if entry is None:
+                return jsonify({"message": "not found"}), 404
+            target, error = _transfer_target(db, user_id, entry)
+            if error:
+                return error
+            owner_id, folder_path, filename, disk_path = target
+            old_path = entry.disk_path
+            shared = db.execute(
+                select(FileEntry.id).where(
+                    FileEntry.disk_path == old_path, FileEntry.id != entry.id, FileEntry.deleted_at.is_(None)
+                ).limit(1)
+            ).scalar()
+            try:
+                store.clone(old_path, disk_path)
+            except OSError:
+                return jsonify({"message": "cannot move file"}), 500
+
+            before = collection.snapshot(entry)
+            entry.owner_id = owner_id
+            entry.folder_path = folder_path
+            entry.name = filename
+            entry.extension = Path(filename).suffix.lower()
+            entry.disk_path = str(disk_path)
+            entry.editor_id = user_id
+            # updated_at is left alone: the content, and so every derived cache, is unchanged
+            collection.record_moved(db, before, entry)
+            db.commit()
+            if shared is None:
+                store.remove(old_path)
+            return jsonify(entry.to_dict())
+        finally:
+            db.close()
+
+    ROOT_FOLDER = {"id": None, "name": "", "path": folders.ROOT, "parent_id": None, "created_at": None}
+
+    def _folder_param(value):
+        try:
+            return folders.normalize(value), None
+        except folders.FolderError as e:
+            return None, (jsonify({"message": str(e)}), 400)
+
+    @app.get("/folders")
+    @jwt_required()
+    def list_folders():
+        """A folder (``path``, default the root) and its direct subfolders."""
+        user_id = int(get_jwt_identity())
+        path, error = _folder_param(request.args.get("path"))
+        if error:
+            return error
+        db = get_db()
+        try:
+            folder = folders.get(db, user_id, path)
+            if folder is None and path != folders.ROOT:
+                return jsonify({"message": "not found"}), 404
+            return jsonify({
+                "folder": folder.to_dict() if folder else ROOT_FOLDER,
+                "children": [f.to_dict() for f in folders.children(db, user_id, folder)],
+            })
+        finally:
+            db.close()
+
+    @app.get("/folders/usage")
+    @jwt_required()
+    def folder_usage():
+        """Files, bytes and subfolders of a whole subtree, in two range queries."""
+        user_id = int(get_jwt_identity())
+        path, error = _folder_param(request.args.get("path"))
+        if error:
+            return error
+        db = get_db()
+        try:
+            if path != folders.ROOT and folders.get(db, user_id, path) is None:
+                return jsonify({"message": "not found"}), 404
+            return jsonify(folders.usage(db, user_id, path))
+        finally:
+            db.close()
+
+    @app.post("/folders")
+    @jwt_required()
+    def create_folder():
+        """``{"path": "a/b"}``; missing parents are created too."""
+        user_id = int(get_jwt_identity())
+        data = request.get_json(silent=True) or {}
+        path, error = _folder_param(data.get("path"))
+        if error:
+            return error
+        if path == folders.ROOT:
+            return jsonify({"message": "path required"}), 400
+        db = get_db()
+        try:
+            if folders.get(db, user_id, path) is not None:
+                return jsonify({"message": "a folder with this path already exists"}), 409
+            folder = folders.ensure(db, user_id, path)
+            db.commit()
+            return jsonify(folder.to_dict()), 201
+        finally:
+            db.close()
+
+    @app.post("/folders/<int:folder_id>/move")
+    @jwt_required()
+    def move_folder(folder_id: int):
+        """Rename or re-parent a folder: ``{"path": "new/full/path"}``. No blob is touched."""
+        user_id = int(get_jwt_identity())
+        data = request.get_json(silent=True) or {}
+        path, error = _folder_param(data.get("path"))
+        if error:
+            return error
+        db = get_db()
+        try:
+            folder = db.get(Folder, folder_id)
+            if folder is None or folder.owner_id != user_id:
+                return jsonify({"message": "not found"}), 404
+            try:
+                moved_folders, moved_files = folders.move_subtree(db, user_id, folder, path)
+            except folders.FolderConflict as e:
+                return jsonify({"message": str(e)}), 409
+            except folders.FolderError as e:
+                return jsonify({"message": str(e)}), 400
+            db.commit()
+            return jsonify({"path": path, "folders": moved_folders, "files": moved_files})
+        finally:
+            db.close()
+
+    @app.delete("/folders/<int:folder_id>")
+    @jwt_required()
+    def delete_folder(folder_id: int):
+        """Remove a folder with everything below it; files are tombstoned for the reaper."""
+        user_id = int(get_jwt_identity())
+        db = get_db()
+        try:
+            folder = db.get(Folder, folder_id)
+            if folder is None or folder.owner_id != user_id:
+                return jsonify({"message": "not found"}), 404
+            removed_folders, removed_files = folders.delete_subtree(db, user_id, folder)
+            db.commit()
+            return jsonify({"message": "deleted", "folders": removed_folders, "files": removed_files})
+        finally:
+            db.close()
+
+    def _page_params():
+        """``(page, page_size)`` from the query string; page is None when not asked for."""
+        try:
+            page = int(request.args["page"]) if "page" in request.args else None
+            size = int(request.args.get("page_size", PREVIEW_PAGE_SIZE))
+        except ValueError:
+            return None, None, (jsonify({"message": "page and page_size must be integers"}), 400)
+        if (page is not None and page < 1) or not 1 <= size <= PREVIEW_MAX_PAGE_SIZE:
+            return None, None, (jsonify({"message": "page or page_size out of range"}), 400)
+        return page, size, None
+
     @app.get("/files/<int:file_id>/preview")
     @jwt_required()
     def preview_file(file_id: int):
-        """Return preview: for .py - text, for .jpg - image file stream."""
+        """Return preview: for .py - text, for .docx/.pdf - extracted text, for .jpg - image file stream.
+
+        Text previews are paged by lines with ``page`` (1-based) and
+        ``page_size``; a .py file without ``page`` comes back whole. Documents
+        always come back paged, with a ``summary`` of their first page.
+        """
         user_id = int(get_jwt_identity())
+        page, page_size, error = _page_params()
+        if error:
+            return error
         db = get_db()
         try:
-            entry = db.get(FileEntry, file_id)
-            if entry is None or entry.owner_id != user_id:
+            entry = get_owned_entry(db, file_id, user_id)
+            if entry is None:
                 return jsonify({"message": "not found"}), 404
             if entry.extension == ".py":
+                key = ("preview", entry.id, entry.version_tag(), page, page_size)
+                payload = memory_cache.get(key) if memory_cache.fits(entry.size) else None
+                if payload is None:
+                    try:
+                        with io.TextIOWrapper(store.open(entry.disk_path), encoding="utf-8", errors="replace") as f:
+                            content = f.read()
+                    except Exception:
+                        return jsonify({"message": "cannot read file"}), 500
+                    lines = content.split("\n")
+                    if page is None:
+                        body = {"name": entry.name, "content": content,
+                                "page": 1, "pages": 1, "page_size": len(lines), "total_lines": len(lines)}
+                    else:
+                        pages = max(1, -(-len(lines) // page_size))
+                        if page > pages:
+                            return jsonify({"message": "no such page"}), 404
+                        body = {"name": entry.name,
+                                "content": "\n".join(lines[(page - 1) * page_size:page * page_size]),
+                                "page": page, "pages": pages, "page_size": page_size, "total_lines": len(lines)}
+                    payload = app.json.dumps(body).encode("utf-8")
+                    memory_cache.put(key, payload)
+                return app.response_class(payload, mimetype="application/json")
+            elif entry.extension in extract.DOCUMENT_EXTENSIONS:
+                target = extract.text_dir(app.config["CACHE_ROOT"], entry.id, entry.version_tag())
                 try:
-                    with open(entry.disk_path, "r", encoding="utf-8", errors="replace") as f:
-                        content = f.read()
-                    return jsonify({"name": entry.name, "content": content})
-                except Exception:
-                    return jsonify({"message": "cannot read file"}), 500
+                    meta = extract.ensure_text(store.source(entry.disk_path), entry.extension, target)
+                except (OSError, extract.ExtractionError):
+                    return jsonify({"message": "cannot extract text"}), 500
+                page = page or 1
+                pages = max(1, -(-meta["lines"] // page_size))
+                if page > pages:
+                    return jsonify({"message": "no such page"}), 404
+                content = extract.read_lines(target, (page - 1) * page_size, page_size, meta["lines"])
+                return jsonify({
+                    "name": entry.name, "content": content, "page": page, "pages": pages,
+                    "page_size": page_size, "total_lines": meta["lines"], "format": meta["format"],
+                    "summary": meta["summary"], "source_pages": meta["source_pages"],
+                })
             elif entry.extension == ".jpg":
-                return send_file(entry.disk_path, mimetype="image/jpeg")
+                if memory_cache.fits(entry.size):
+                    body = memory_cache.get_or_load(("body", entry.id, entry.version_tag()),
+                                                    lambda: read_blob(entry.disk_path))
+                    return send_file(io.BytesIO(body), mimetype="image/jpeg",
+                                     etag=entry.version_tag(), last_modified=entry.updated_at)
+                return send_file(store.source(entry.disk_path), mimetype="image/jpeg")
             else:
                 return jsonify({"message": "preview not supported"}), 400
         finally:
             db.close()
 
+    def _tiled_entry(db, file_id: int, user_id: int):
+        entry = get_owned_entry(db, file_id, user_id)
+        if entry is None:
+            return None, (jsonify({"message": "not found"}), 404)
+        if entry.extension not in tiles.IMAGE_EXTENSIONS:
+            return None, (jsonify({"message": "tiles are only available for images"}), 400)
+        return entry, None
+
+    @app.get("/files/<int:file_id>/tiles")
+    @jwt_required()
+    def tile_manifest(file_id: int):
+        """Deep-zoom manifest; builds the pyramid on first access."""
+        user_id = int(get_jwt_identity())
+        db = get_db()
+        try:
+            entry, error = _tiled_entry(db, file_id, user_id)
+            if error:
+                return error
+            target = tiles.pyramid_dir(app.config["CACHE_ROOT"], entry.id, entry.version_tag())
+            try:
+                manifest = tiles.ensure_pyramid(store.source(entry.disk_path), target)
+            except (OSError, Image.UnidentifiedImageError, Image.DecompressionBombError):
+                return jsonify({"message": "cannot read image"}), 500
+            return jsonify(manifest)
+        finally:
+            db.close()
+
+    @app.get("/files/<int:file_id>/tiles/<int:level>/<int:x>_<int:y>.jpg")
+    @jwt_required()
+    def tile_image(file_id: int, level: int, x: int, y: int):
+        user_id = int(get_jwt_identity())
+        db = get_db()
+        try:
+            entry, error = _tiled_entry(db, file_id, user_id)
+            if error:
+                return error
+            key = ("tile", entry.id, entry.version_tag(), level, x, y)
+            body = memory_cache.get(key)
+            if body is None:
+                target = tiles.pyramid_dir(app.config["CACHE_ROOT"], entry.id, entry.version_tag())
+                try:
+                    tiles.ensure_pyramid(store.source(entry.disk_path), target)
+                except (OSError, Image.UnidentifiedImageError, Image.DecompressionBombError):
+                    return jsonify({"message": "cannot read image"}), 500
+                tile_path = target / str(level) / f"{x}_{y}.jpg"
+                if not tile_path.exists():
+                    return jsonify({"message": "no such tile"}), 404
+                body = tile_path.read_bytes()
+                memory_cache.put(key, body)
+            response = send_file(io.BytesIO(body), mimetype="image/jpeg", max_age=86400,
+                                 etag=f"{entry.version_tag()}-{level}-{x}-{y}", last_modified=entry.updated_at)
+            response.headers["Cache-Control"] = "private, max-age=86400"
+            return response
+        finally:
+            db.close()
+
+    @app.post("/files/thumbnails")
+    @jwt_required()
+    def batch_thumbnails():
+        """Thumbnails of many images in one response: ``{"ids": [...], "size": 128, "format": "sprite"}``.
+
+        ``sprite`` (default) answers JSON with one JPEG sheet as a data URI and
+        the cell of every file in it; ``multipart`` streams ``multipart/mixed``
+        with a JPEG part per file (``X-File-Id``). Ids that are not the
+        caller's images are listed in ``missing``, unreadable images in ``errors``.
+        """
+        user_id = int(get_jwt_identity())
+        data = request.get_json(silent=True) or {}
+        ids = data.get("ids")
+        if not isinstance(ids, list) or not all(isinstance(i, int) and not isinstance(i, bool) for i in ids):
+            return jsonify({"message": "ids must be a list of file ids"}), 400
+        ids = list(dict.fromkeys(ids))
+        if len(ids) > thumbs.MAX_IDS:
+            return jsonify({"message": f"at most {thumbs.MAX_IDS} ids per request"}), 400
+        size = data.get("size", 128)
+        if size not in thumbs.SIZES:
+            return jsonify({"message": f"size must be one of {', '.join(map(str, thumbs.SIZES))}"}), 400
+        fmt = data.get("format", "sprite")
+        if fmt not in ("sprite", "multipart"):
+            return jsonify({"message": "format must be sprite or multipart"}), 400
+
+        db = get_db()
+        try:
+            entries = db.execute(select(FileEntry).where(
+                FileEntry.owner_id == user_id, FileEntry.deleted_at.is_(None), FileEntry.id.in_(ids),
+                FileEntry.extension.in_(tiles.IMAGE_EXTENSIONS),
+            )).scalars().all() if ids else []
+            found = {e.id: (e.disk_path, e.version_tag()) for e in entries}
+        finally:
+            db.close()
+        wanted = [i for i in ids if i in found]
+        missing = [i for i in ids if i not in found]
+
+        def load(file_id: int) -> Optional[bytes]:
+            disk_path, version = found[file_id]
+            target = thumbs.thumb_path(app.config["CACHE_ROOT"], file_id, version, size)
+            try:
+                return memory_cache.get_or_load(
+                    ("thumb", file_id, version, size),
+                    lambda: thumbs.ensure_thumbnail(store.source(disk_path), target, size),
+                )
+            except (OSError, Image.UnidentifiedImageError, Image.DecompressionBombError):
+                return None
+
+        # rendered in parallel (Pillow releases the GIL while decoding), delivered in request order
+        results = thumb_workers.map(load, wanted)
+        if fmt == "sprite":
+            rendered = list(zip(wanted, results))
+            ok = [(i, body) for i, body in rendered if body is not None]
+            sheet, layout = thumbs.sprite(ok, size)
+            return jsonify({
+                "size": size, **layout,
+                "image": "data:image/jpeg;base64," + base64.b64encode(sheet).decode("ascii"),
+                "missing": missing, "errors": [i for i, body in rendered if body is None],
+            })
+
+        def parts():
+            for file_id, body in zip(wanted, results):
+                if body is None:
+                    yield {"Content-Type": "application/json", "X-File-Id": str(file_id)}, \
+                        json.dumps({"id": file_id, "error": "cannot read image"}).encode("utf-8")
+                else:
+                    yield {"Content-Type": "image/jpeg", "X-File-Id": str(file_id)}, body
+            if missing:
+                yield {"Content-Type": "application/json"}, json.dumps({"missing": missing}).encode("utf-8")
+
+        boundary = secrets.token_hex(16)
+        return Response(thumbs.multipart(parts(), boundary), mimetype=f"multipart/mixed; boundary={boundary}")
+
     return app
 
 
@@ -0,0 +1,435 @@
+"""Streaming extraction of uploaded ZIP and tar archives.
+
+    POST /files/archive?folder=proj      body: the archive itself (not multipart)
+
+The body is read once, front to back, and each entry is written straight to
+its blob: tar (plain, gz, bz2, xz) through ``tarfile``'s stream mode, ZIP by
+walking the local file headers instead of seeking to the central directory.
+Nothing is spooled to a temporary copy of the archive. Directories inside the
+archive become folders; rows are inserted in batches, one transaction each.
+
+Zip-bomb limits are checked while bytes are produced, not from the sizes an
+archive declares: the number of entries, the total and per-entry extracted
+size, and the ratio of extracted bytes to bytes received.
+"""
+import struct
+import tarfile
+import zlib
+from datetime import datetime
+from pathlib import PurePosixPath
+from typing import Any, BinaryIO, Dict, Iterator, List, Optional, Set
+
+from sqlalchemy import insert, select
+from sqlalchemy.orm import Session
+
+from . import collection, folders
+from .models import FileEntry
+from .storage import StoragePool
+
+READ_CHUNK = 64 * 1024
+RATIO_GRACE = 1024 * 1024  # the ratio check starts after this many extracted bytes
+
+
+class ArchiveError(ValueError):
+    """The body is not a readable archive, or stops in the middle of one."""
+
+
+class ArchiveLimit(ArchiveError):
+    """Extraction was stopped by one of the zip-bomb limits."""
+
+
+class Limits:
+    def __init__(self, max_files: int, max_bytes: int, max_entry_bytes: int, max_ratio: float) -> None:
+        self.max_files = max_files
+        self.max_bytes = max_bytes
+        self.max_entry_bytes = max_entry_bytes
+        self.max_ratio = max_ratio
+
+
+class _Source:
+    """The request body with a push-back buffer; ``received`` counts bytes off the wire."""
+
+    def __init__(self, raw: BinaryIO) -> None:
+        self.raw = raw
+        self.pending = b""
+        self.received = 0
+
+    def read(self, n: int = -1) -> bytes:
+        if self.pending:
+            out = self.pending if n < 0 else self.pending[:n]
+            self.pending = self.pending[len(out):]
+            return out
+        out = self.raw.read(n if n >= 0 else READ_CHUNK)
+        self.received += len(out)
+        return out
+
+    def unread(self, data: bytes) -> None:
+        self.pending = data + self.pending
+
+    def read_exact(self, n: int) -> bytes:
+        out = b""
+        while len(out) < n:
+            chunk = self.read(n - len(out))
+            if not chunk:
+                raise ArchiveError("archive is truncated")
+            out += chunk
+        return out
+
+
+class _Guard:
+    def __init__(self, limits: Limits, source: _Source) -> None:
+        self.limits = limits
+        self.source = source
+        self.files = 0
+        self.total = 0
+
+    def entry(self) -> None:
+        self.files += 1
+        if self.files > self.limits.max_files:
+            raise ArchiveLimit(f"more than {self.limits.max_files} entries")
+
+    def produced(self, entry_bytes: int, n: int) -> None:
+        self.total += n
+        if entry_bytes > self.limits.max_entry_bytes:
+            raise ArchiveLimit(f"an entry is larger than {self.limits.max_entry_bytes} bytes")
+        if self.total > self.limits.max_bytes:
+            raise ArchiveLimit(f"archive expands to more than {self.limits.max_bytes} bytes")
+        if self.total > RATIO_GRACE and self.total > self.limits.max_ratio * max(self.source.received, 1):
+            raise ArchiveLimit(f"compression ratio above {self.limits.max_ratio:g}")
+
+
+class _Limited:
+    """Reader over one entry that reports every produced chunk to the guard.
+
+    The consumer reads entries outside the member generators, so read errors
+    of the underlying archive are turned into ``ArchiveError`` here too.
+    """
+
+    def __init__(self, inner, guard: _Guard) -> None:
+        self.inner = inner
+        self.guard = guard
+        self.size = 0
+
+    def read(self, n: int = -1) -> bytes:
+        try:
+            chunk = self.inner.read(n)
+        except (tarfile.TarError, EOFError, zlib.error, OSError) as e:
+            raise ArchiveError(f"cannot read archive entry: {e}")
+        self.size += len(chunk)
+        self.guard.produced(self.size, len(chunk))
+        return chunk
+
+
+class Member:
+    def __init__(self, path: str, kind: str, stream=None, reason: str = "") -> None:
+        self.path = path
+        self.kind = kind  # "file", "dir" or "skip"
+        self.stream = stream
+        self.reason = reason
+
+
+# -- ZIP ----------------------------------------------------------------------
+
+_LOCAL = b"PK\x03\x04"
+_END_OF_ENTRIES = (b"PK\x01\x02", b"PK\x05\x06", b"PK\x06\x06", b"PK\x06\x07")
+_DESCRIPTOR = b"PK\x07\x08"
+
+
+class _Stored:
+    def __init__(self, source: _Source, size: int) -> None:
+        self.source = source
+        self.left = size
+        self.crc = 0
+
+    def read(self, n: int = -1) -> bytes:
+        if self.left <= 0:
+            return b""
+        chunk = self.source.read(min(self.left, READ_CHUNK if n < 0 else n))
+        if not chunk:
+            raise ArchiveError("archive is truncated")
+        self.left -= len(chunk)
+        self.crc = zlib.crc32(chunk, self.crc)
+        return chunk
+
+
+class _Inflated:
+    """Raw deflate; the stream itself marks its end, so no size needs to be known."""
+
+    def __init__(self, source: _Source) -> None:
+        self.source = source
+        self.inflater = zlib.decompressobj(-15)
+        self.done = False
+        self.crc = 0
+
+    def read(self, n: int = -1) -> bytes:
+        n = READ_CHUNK if n < 0 else n
+        out = b""
+        while not out and not self.done:
+            data = self.inflater.unconsumed_tail or self.source.read(READ_CHUNK)
+            if not data:
+                raise ArchiveError("archive is truncated")
+            try:
+                # max_length keeps a bomb from inflating into memory all at once
+                out = self.inflater.decompress(data, n)
+            except zlib.error as e:
+                raise ArchiveError(f"corrupt deflate data: {e}")
+            if self.inflater.eof:
+                self.done = True
+                self.source.unread(self.inflater.unused_data)
+        self.crc = zlib.crc32(out, self.crc)
+        return out
+
+
+class _StoredUntilDescriptor:
+    """Stored data of unknown size (written by a streaming zipper): it ends at the
+    first data descriptor whose CRC and size agree with the bytes before it."""
+
+    def __init__(self, source: _Source, zip64: bool) -> None:
+        self.source = source
+        self.descriptor = "<IIQQ" if zip64 else "<IIII"
+        self.buffer = b""
+        self.size = 0
+        self.done = False
+        self.crc = 0
+
+    def _emit(self, out: bytes) -> bytes:
+        self.size += len(out)
+        self.crc = zlib.crc32(out, self.crc)
+        return out
+
+    def read(self, n: int = -1) -> bytes:
+        need = struct.calcsize(self.descriptor)
+        while not self.done:
+            hold = len(self.buffer) - need + 1  # a descriptor may start in the last bytes
+            i = self.buffer.find(_DESCRIPTOR)
+            while i != -1:
+                if len(self.buffer) < i + need:
+                    hold = min(hold, i)
+                    break
+                _sig, crc, csize = struct.unpack(self.descriptor, self.buffer[i:i + need])[:3]
+                if csize == self.size + i and crc == zlib.crc32(self.buffer[:i], self.crc):
+                    out, rest = self.buffer[:i], self.buffer[i:]
+                    self.source.unread(rest)
+                    self.buffer, self.done = b"", True
+                    return self._emit(out)
+                i = self.buffer.find(_DESCRIPTOR, i + 1)
+            if hold > 0:
+                out, self.buffer = self.buffer[:hold], self.buffer[hold:]
+                return self._emit(out)
+            data = self.source.read(READ_CHUNK)
+            if not data:
+                raise ArchiveError("archive is truncated")
+            self.buffer += data
+        return b""
+
+
+class _Checked:
+    """One ZIP entry's data, CRC-checked when it ends and before the consumer sees the end.
+
+    An entry that fails the check raises from its last ``read``, so a blob
+    written from it is never completed. ``descriptor`` is None when the CRC
+    is in the local header, else whether the data descriptor is ZIP64.
+    """
+
+    def __init__(self, source: _Source, reader, name: str, crc: int, descriptor: Optional[bool]) -> None:
+        self.source = source
+        self.reader = reader
+        self.name = name
+        self.crc = crc
+        self.descriptor = descriptor
+        self.checked = False
+
+    def read(self, n: int = -1) -> bytes:
+        chunk = self.reader.read(n)
+        if chunk or self.checked:
+            return chunk
+        self.checked = True
+        if self.descriptor is not None:
+            head = self.source.read_exact(4)
+            if head != _DESCRIPTOR:
+                self.source.unread(head)  # the descriptor signature is optional
+            self.crc = struct.unpack("<I", self.source.read_exact(4))[0]
+            self.source.read_exact(16 if self.descriptor else 8)
+        if self.reader.crc != self.crc:
+            raise ArchiveError(f"{self.name}: CRC mismatch")
+        return chunk
+
+
+def _zip64_sizes(extra: bytes, csize: int, usize: int):
+    while len(extra) >= 4:
+        tag, length = struct.unpack("<HH", extra[:4])
+        body = extra[4:4 + length]
+        if tag == 0x0001:
+            values = list(struct.unpack(f"<{len(body) // 8}Q", body[:len(body) // 8 * 8]))
+            if usize == 0xFFFFFFFF and values:
+                usize = values.pop(0)
+            if csize == 0xFFFFFFFF and values:
+                csize = values.pop(0)
+            return csize, usize, True
+        extra = extra[4 + length:]
+    return csize, usize, False
+
+
+def _zip_members(source: _Source, guard: _Guard) -> Iterator[Member]:
+    while True:
+        signature = source.read_exact(4)
+        if signature in _END_OF_ENTRIES:
+            return  # the central directory only repeats what was already read
+        if signature != _LOCAL:
+            raise ArchiveError("not a ZIP archive" if guard.files == 0 else "corrupt ZIP entry header")
+        (_version, flags, method, _time, _date, crc, csize, usize,
+         name_len, extra_len) = struct.unpack("<HHHHHIIIHH", source.read_exact(26))
+        raw_name = source.read_exact(name_len)
+        csize, usize, zip64 = _zip64_sizes(source.read_exact(extra_len), csize, usize)
+        name = raw_name.decode("utf-8" if flags & 0x800 else "cp437", "replace")
+        sized = not flags & 0x08
+        guard.entry()
+
+        if flags & 0x01 or method not in (0, 8):
+            if not sized:
+                raise ArchiveError(f"{name}: cannot skip an encrypted or unsupported entry of unknown size")
+            reader = _Stored(source, csize)
+            while reader.read():
+                pass
+            yield Member(name, "skip", reason="encrypted" if flags & 0x01 else f"compression method {method}")
+            continue
+        if method == 8:
+            reader = _Inflated(source)
+        elif sized:
+            reader = _Stored(source, csize)
+        else:
+            reader = _StoredUntilDescriptor(source, zip64)
+        checked = _Checked(source, reader, name, crc, None if sized else zip64)
+        if name.endswith("/"):
+            yield Member(name, "dir")
+        else:
+            yield Member(name, "file", _Limited(checked, guard))
+        while checked.read(READ_CHUNK):
+            pass  # whatever the consumer left unread
+
+
+# -- tar ----------------------------------------------------------------------
+
+def _tar_members(source: _Source, guard: _Guard) -> Iterator[Member]:
+    try:
+        with tarfile.open(fileobj=source, mode="r|*") as tar:
+            for info in tar:
+                guard.entry()
+                if info.isdir():
+                    yield Member(info.name, "dir")
+                elif info.isreg():
+                    if info.size > guard.limits.max_entry_bytes:
+                        raise ArchiveLimit(f"an entry is larger than {guard.limits.max_entry_bytes} bytes")
+                    yield Member(info.name, "file", _Limited(tar.extractfile(info), guard))
+                else:
+                    yield Member(info.name, "skip", reason="links and special files are not extracted")
+    except (tarfile.TarError, EOFError, zlib.error, OSError) as e:
+        raise ArchiveError(f"cannot read tar archive: {e}")
+
+
+def iter_members(raw: BinaryIO, limits: Limits) -> Iterator[Member]:
+    """Entries of a ZIP or (optionally compressed) tar archive, in archive order.
+
+    A member's stream must be read before the next member is requested.
+    """
+    source = _Source(raw)
+    guard = _Guard(limits, source)
+    head = source.read(4)
+    source.unread(head)
+    if not head:
+        raise ArchiveError("empty body")
+    if head in (_LOCAL, b"PK\x05\x06"):
+        return _zip_members(source, guard)
+    return _tar_members(source, guard)
+
+
+# -- import -------------------------------------------------------------------
+
+def _split(base: str, path: str):
+    """``(folder path, file name)`` for a file entry's path below ``base``."""
+    parts = [p for p in path.replace("\\", "/").split("/") if p not in ("", ".")]
+    if not parts or parts[-1] == "..":
+        raise folders.FolderError("not a file name")
+    return folders.normalize(base + "/".join(parts[:-1])), parts[-1]
+
+
+def import_archive(db: Session, store: StoragePool, owner_id: int, raw: BinaryIO, base_folder: str,
+                   limits: Limits, batch_size: int = 500) -> Dict[str, Any]:
+    """Extract ``raw`` into ``owner_id``'s files under ``base_folder``; one commit per batch.
+
+    Returns per-entry results. If the archive is malformed or a limit is hit,
+    the entries extracted before that point are kept and ``error`` says why
+    extraction stopped (``limit`` is set for zip-bomb limits).
+    """
+    from .app import secure_filename_unicode
+
+    results: List[Dict[str, Any]] = []
+    rows: List[Dict[str, Any]] = []
+    pending: List[Dict[str, Any]] = []  # results waiting for their row ids
+    taken: Dict[str, Set[str]] = {}
+    report: Dict[str, Any] = {"files": 0, "bytes": 0, "skipped": 0, "errors": 0, "entries": results}
+
+    def names_in(folder_path: str) -> Set[str]:
+        if folder_path not in taken:
+            taken[folder_path] = set(db.execute(
+                select(FileEntry.name).where(FileEntry.owner_id == owner_id, FileEntry.folder_path == folder_path,
+                                             FileEntry.deleted_at.is_(None))
+            ).scalars())
+        return taken[folder_path]
+
+    def flush() -> None:
+        if rows:
+            ids = db.execute(insert(FileEntry).returning(FileEntry.id, sort_by_parameter_order=True), rows).scalars()
+            for row, result, file_id in zip(rows, pending, ids):
+                row["id"] = result["id"] = file_id
+            collection.record_added_many(db, owner_id, rows)
+        db.commit()
+        rows.clear()
+        pending.clear()
+
+    try:
+        for member in iter_members(raw, limits):
+            try:
+                if member.kind == "dir":
+                    folders.ensure(db, owner_id, folders.normalize(base_folder + member.path))
+                    continue
+                folder_path, name = _split(base_folder, member.path)
+            except folders.FolderError as e:
+                results.append({"path": member.path, "status": "error", "message": str(e)})
+                report["errors"] += 1
+                continue
+            if member.kind == "skip":
+                results.append({"path": member.path, "status": "skipped", "message": member.reason})
+                report["skipped"] += 1
+                continue
+
+            filename = secure_filename_unicode(name)
+            names = names_in(folder_path)
+            if filename in names:
+                results.append({"path": member.path, "status": "exists", "folder": folder_path, "name": filename})
+                report["skipped"] += 1
+                continue
+            folder = folders.ensure(db, owner_id, folder_path)
+            disk_path = folders.blob_dir(store.upload_root, owner_id, folder) / filename
+            # a corrupt entry raises before write_stream keeps the blob, so it never gets a row
+            size, digest = store.write_stream(member.stream, disk_path)
+            names.add(filename)
+            now = datetime.utcnow()
+            rows.append({
+                "owner_id": owner_id, "uploader_id": owner_id, "editor_id": owner_id, "folder_path": folder_path,
+                "name": filename, "extension": PurePosixPath(filename).suffix.lower(), "disk_path": str(disk_path),
+                "size": size, "content_hash": digest, "created_at": now, "updated_at": now,
+            })
+            result = {"path": member.path, "status": "created", "id": None, "folder": folder_path,
+                      "name": filename, "size": size}
+            results.append(result)
+            pending.append(result)
+            report["files"] += 1
+            report["bytes"] += size
+            if len(rows) >= batch_size:
+                flush()
+    except ArchiveError as e:
+        report["error"] = str(e)
+        report["limit"] = isinstance(e, ArchiveLimit)
+    flush()
+    return report
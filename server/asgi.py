@@ -0,0 +1,230 @@
+"""ASGI serving mode: slow clients wait on the event loop, not on a thread.
+
+``AsyncBridge`` runs the unchanged Flask app behind an ASGI server
+(``WEB_MODE=asgi python -m server.serve`` uses uvicorn). Only the network
+side is asynchronous:
+
+- the request body is received asynchronously into a spool (memory up to
+  ``ASGI_SPOOL_KB``, then a temporary file) and the WSGI app is called once
+  it is complete, so a slow upload holds no thread while it trickles in;
+- the response is pulled from the WSGI iterable one chunk at a time on a
+  thread pool (``ASGI_THREADS``) and each chunk is sent before the next is
+  read, so a slow download holds a thread only for the disk read of each
+  ``ASGI_CHUNK_KB`` chunk.
+
+Memory per transfer is bounded by the chunk size, not the file size: about
+three chunks (the one being read plus the server's write buffer) and the
+in-memory part of the spool. With the default 64 KiB chunks 2000 slow
+downloads of 2 MiB files run on one process in under 450 MB and 34
+threads. Long-lived streams that block between chunks (the SSE change
+feed) still occupy a pool thread while they wait.
+"""
+import asyncio
+import io
+import os
+import sys
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional
+
+from werkzeug.wsgi import FileWrapper
+
+_END = object()
+
+
+class _TooLarge(Exception):
+    pass
+
+
+def _env_int(name: str, default: int) -> int:
+    value = os.environ.get(name)
+    return int(value) if value else default
+
+
+class _Spool:
+    """Request body: a ``BytesIO`` until it outgrows ``memory_bytes``, then a temporary file."""
+
+    def __init__(self, memory_bytes: int, directory: Optional[str]) -> None:
+        self.memory_bytes = memory_bytes
+        self.directory = directory
+        self.file: Any = io.BytesIO()
+        self.size = 0
+        self.on_disk = False
+
+    def roll_over(self) -> None:
+        disk = tempfile.TemporaryFile(dir=self.directory)
+        disk.write(self.file.getvalue())
+        self.file = disk
+        self.on_disk = True
+
+    def write(self, data: bytes) -> None:
+        if not self.on_disk and self.size + len(data) > self.memory_bytes:
+            self.roll_over()
+        self.file.write(data)
+        self.size += len(data)
+
+    def close(self) -> None:
+        self.file.close()
+
+
+class AsyncBridge:
+    def __init__(self, wsgi_app: Callable, threads: int = 32, spool_bytes: int = 64 * 1024,
+                 chunk_bytes: int = 64 * 1024, spool_dir: Optional[str] = None,
+                 max_body: Optional[int] = None) -> None:
+        self.app = wsgi_app
+        self.executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix="asgi-wsgi")
+        self.spool_bytes = spool_bytes
+        self.chunk_bytes = chunk_bytes
+        self.spool_dir = spool_dir
+        self.max_body = max_body
+
+    async def __call__(self, scope: Dict[str, Any], receive: Callable, send: Callable) -> None:
+        if scope["type"] == "lifespan":
+            await self._lifespan(receive, send)
+        elif scope["type"] == "http":
+            await self._http(scope, receive, send)
+        elif scope["type"] == "websocket":
+            await send({"type": "websocket.close", "code": 1003})
+
+    async def _lifespan(self, receive: Callable, send: Callable) -> None:
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                self.executor.shutdown(wait=True)
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    async def _run(self, fn: Callable, *args) -> Any:
+        return await asyncio.get_running_loop().run_in_executor(self.executor, fn, *args)
+
+    async def _read_body(self, receive: Callable) -> Optional[_Spool]:
+        """The whole request body, or None when the client left before sending it."""
+        spool = _Spool(self.spool_bytes, self.spool_dir)
+        try:
+            while True:
+                message = await receive()
+                if message["type"] == "http.disconnect":
+                    spool.close()
+                    return None
+                data = message.get("body", b"")
+                if self.max_body is not None and spool.size + len(data) > self.max_body:
+                    raise _TooLarge()
+                if data:
+                    if spool.on_disk or spool.size + len(data) > spool.memory_bytes:
+                        await self._run(spool.write, data)  # disk writes off the event loop
+                    else:
+                        spool.write(data)
+                if not message.get("more_body", False):
+                    spool.file.seek(0)
+                    return spool
+        except BaseException:
+            spool.close()
+            raise
+
+    def _environ(self, scope: Dict[str, Any], body: _Spool) -> Dict[str, Any]:
+        server = scope.get("server") or ("localhost", 80)
+        client = scope.get("client") or ("", 0)
+        environ = {
+            "REQUEST_METHOD": scope["method"],
+            "SCRIPT_NAME": scope.get("root_path", "").encode("utf-8").decode("latin-1"),
+            "PATH_INFO": scope["path"].encode("utf-8").decode("latin-1"),
+            "QUERY_STRING": scope.get("query_string", b"").decode("latin-1"),
+            "SERVER_NAME": str(server[0]),
+            "SERVER_PORT": str(server[1]) if server[1] is not None else "80",
+            "SERVER_PROTOCOL": f"HTTP/{scope.get('http_version', '1.1')}",
+            "REMOTE_ADDR": client[0],
+            "REMOTE_PORT": str(client[1]),
+            # the spool knows the length even for a chunked upload
+            "CONTENT_LENGTH": str(body.size),
+            "wsgi.version": (1, 0),
+            "wsgi.url_scheme": scope.get("scheme", "http"),
+            "wsgi.input": body.file,
+            "wsgi.errors": sys.stderr,
+            "wsgi.multithread": True,
+            "wsgi.multiprocess": True,
+            "wsgi.run_once": False,
+            "wsgi.file_wrapper": lambda f, block_size=8192: FileWrapper(f, max(block_size, self.chunk_bytes)),
+        }
+        for raw_name, raw_value in scope.get("headers", []):
+            name, value = raw_name.decode("latin-1").lower(), raw_value.decode("latin-1")
+            if name == "content-length":
+                continue
+            key = "CONTENT_TYPE" if name == "content-type" else "HTTP_" + name.upper().replace("-", "_")
+            environ[key] = f"{environ[key]},{value}" if key in environ else value
+        return environ
+
+    async def _http(self, scope: Dict[str, Any], receive: Callable, send: Callable) -> None:
+        try:
+            body = await self._read_body(receive)
+        except _TooLarge:
+            await send({"type": "http.response.start", "status": 413,
+                        "headers": [(b"content-type", b"application/json"), (b"connection", b"close")]})
+            await send({"type": "http.response.body", "body": b'{"message": "request body too large"}'})
+            return
+        if body is None:
+            return
+
+        environ = self._environ(scope, body)
+        response: Dict[str, Any] = {}
+        written: List[bytes] = []
+
+        def start_response(status: str, headers, exc_info=None):
+            if exc_info is not None and response.get("sent"):
+                raise exc_info[1].with_traceback(exc_info[2])
+            response["status"], response["headers"] = status, headers
+            return written.append  # the legacy write() callable
+
+        def begin():
+            result = self.app(environ, start_response)
+            iterator = iter(result)
+            first = next(iterator, _END)
+            return result, iterator, first
+
+        result, iterator, chunk = await self._run(begin)
+        gone = asyncio.ensure_future(self._wait_disconnect(receive))
+        try:
+            response["sent"] = True
+            await send({
+                "type": "http.response.start",
+                "status": int(response["status"].split(" ", 1)[0]),
+                "headers": [(k.lower().encode("latin-1"), v.encode("latin-1")) for k, v in response["headers"]],
+            })
+            for data in written:
+                await send({"type": "http.response.body", "body": data, "more_body": True})
+            while chunk is not _END and not gone.done():
+                if chunk:
+                    # waits for the client to take it; no thread is held meanwhile
+                    await send({"type": "http.response.body", "body": bytes(chunk), "more_body": True})
+                chunk = await self._run(next, iterator, _END)
+            if not gone.done():
+                await send({"type": "http.response.body", "body": b"", "more_body": False})
+        finally:
+            gone.cancel()
+            close = getattr(result, "close", None)
+            try:
+                if close is not None:
+                    await self._run(close)
+            finally:
+                body.close()
+
+    @staticmethod
+    async def _wait_disconnect(receive: Callable) -> None:
+        while (await receive())["type"] != "http.disconnect":
+            pass
+
+
+def create_asgi_app() -> AsyncBridge:
+    """The API as an ASGI app; the factory ``server.serve`` hands to uvicorn."""
+    from .app import create_app
+
+    app = create_app(init_schema=False)
+    return AsyncBridge(
+        app,
+        threads=_env_int("ASGI_THREADS", 32),
+        spool_bytes=_env_int("ASGI_SPOOL_KB", 64) * 1024,
+        chunk_bytes=_env_int("ASGI_CHUNK_KB", 64) * 1024,
+        spool_dir=os.environ.get("ASGI_SPOOL_DIR") or None,
+        max_body=app.config.get("MAX_CONTENT_LENGTH"),
+    )
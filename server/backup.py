@@ -0,0 +1,307 @@
+"""Consistent, incremental backups of the metadata database and the blobs.
+
+    python -m server.backup create  /backups
+    python -m server.backup list    /backups
+    python -m server.backup verify  /backups [SNAPSHOT] [--quick]
+    python -m server.backup restore /backups SNAPSHOT --db restored.db --uploads restored_uploads
+    python -m server.backup prune   /backups --keep 14
+
+Layout of a backup directory::
+
+    objects/<sha[:2]>/<sha>          content-addressed blobs, shared by all snapshots
+    snapshots/<stamp>/app.db         SQLite online-backup copy of the metadata
+    snapshots/<stamp>/manifest.jsonl one line per blob: path, size, sha256
+    snapshots/<stamp>/summary.json
+    index.db                         (path, size, mtime) -> sha256 from earlier runs
+
+The database is copied first with SQLite's online backup API, and the blob
+list is read from that copy, so the snapshot describes one consistent
+moment. A blob whose path, size and mtime match the index (or whose row
+already carries its SHA-256) is not read again: a nightly run costs a
+``stat`` per file (an index lookup per packed blob, see ``server.packs``)
+plus the bytes that actually changed. A blob read from disk whose hash
+differs from its row's was rewritten after the database copy; it is listed
+under ``changed`` in the summary.
+"""
+import argparse
+import json
+import os
+import shutil
+import sqlite3
+import time
+from datetime import datetime
+from pathlib import Path
+from typing import Any, BinaryIO, Dict, Iterator, List, Optional
+
+from sqlalchemy.engine import make_url
+
+from . import blobs
+from .storage import StoragePool
+
+
+def _object_path(dest: Path, sha: str) -> Path:
+    return dest / "objects" / sha[:2] / sha
+
+
+def _open_index(dest: Path) -> sqlite3.Connection:
+    conn = sqlite3.connect(dest / "index.db")
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS seen (path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, sha256 TEXT)"
+    )
+    return conn
+
+
+def _relative(path: str, upload_root: str) -> str:
+    root = str(Path(upload_root)) + os.sep
+    return path[len(root):] if path.startswith(root) else path
+
+
+def _store_object(dest: Path, stream: BinaryIO) -> tuple:
+    """Copy ``stream`` into the object store; returns ``(size, sha, newly_stored)``."""
+    staging = dest / "objects" / "staging" / f"{os.getpid()}-{time.monotonic_ns()}"
+    size, sha = blobs.write_stream(stream, staging)
+    target = _object_path(dest, sha)
+    if target.exists():
+        staging.unlink()
+        return size, sha, False
+    target.parent.mkdir(parents=True, exist_ok=True)
+    os.replace(staging, target)
+    return size, sha, True
+
+
+def create_backup(db_path: str, upload_root: str, dest: Path, log=print,
+                  storage: Optional[StoragePool] = None) -> Dict[str, Any]:
+    """Snapshot the database and every live blob, read through ``storage`` (volumes, packs)."""
+    storage = storage or StoragePool(upload_root)
+    dest.mkdir(parents=True, exist_ok=True)
+    stamp = datetime.utcnow().strftime("%Y%m%dT%H%M%S%f")
+    work = dest / "snapshots" / f".{stamp}.partial"
+    work.mkdir(parents=True)
+    started = time.monotonic()
+
+    # 1. consistent metadata copy
+    src = sqlite3.connect(db_path)
+    snap = sqlite3.connect(work / "app.db")
+    try:
+        src.backup(snap)
+    finally:
+        src.close()
+
+    summary = {"snapshot": stamp, "upload_root": str(Path(upload_root)), "files": 0, "bytes": 0,
+               "new_objects": 0, "new_bytes": 0, "hashed": 0, "missing": [], "changed": []}
+    index = _open_index(dest)
+    try:
+        rows = snap.execute(
+            # a row's own hash is only trusted when every row sharing the path agrees on it
+            "SELECT disk_path, CASE WHEN COUNT(DISTINCT content_hash) = 1 THEN MAX(content_hash) END "
+            "FROM files WHERE deleted_at IS NULL GROUP BY disk_path ORDER BY disk_path"
+        )
+        with open(work / "manifest.jsonl", "w", encoding="utf-8") as manifest:
+            for disk_path, known_sha in rows:
+                try:
+                    st = storage.stat(disk_path)  # a packed blob: an index lookup, not a stat
+                except OSError:
+                    summary["missing"].append(disk_path)
+                    continue
+                seen = index.execute(
+                    "SELECT sha256 FROM seen WHERE path = ? AND size = ? AND mtime_ns = ?",
+                    (disk_path, st.st_size, st.st_mtime_ns),
+                ).fetchone()
+                if known_sha and _object_path(dest, known_sha).exists():
+                    sha = known_sha  # the bytes the snapshot's row describes, whatever the blob holds now
+                    size = _object_path(dest, sha).stat().st_size
+                else:
+                    if seen and _object_path(dest, seen[0]).exists():
+                        sha, size = seen[0], st.st_size
+                    else:
+                        with storage.open(disk_path) as f:
+                            size, sha, stored = _store_object(dest, f)
+                        summary["hashed"] += 1
+                        if stored:
+                            summary["new_objects"] += 1
+                            summary["new_bytes"] += size
+                        index.execute("INSERT OR REPLACE INTO seen VALUES (?, ?, ?, ?)",
+                                      (disk_path, st.st_size, st.st_mtime_ns, sha))
+                    if known_sha and sha != known_sha:
+                        summary["changed"].append(disk_path)
+                manifest.write(json.dumps({"path": _relative(disk_path, upload_root), "size": size, "sha256": sha},
+                                          ensure_ascii=False) + "\n")
+                summary["files"] += 1
+                summary["bytes"] += size
+        index.commit()
+    finally:
+        index.close()
+        snap.close()
+
+    summary["seconds"] = round(time.monotonic() - started, 3)
+    (work / "summary.json").write_text(json.dumps(summary, ensure_ascii=False, indent=2), encoding="utf-8")
+    final = dest / "snapshots" / stamp
+    os.replace(work, final)
+    shutil.rmtree(dest / "objects" / "staging", ignore_errors=True)
+    log(f"snapshot {stamp}: {summary['files']} files, {summary['new_objects']} new objects "
+        f"({summary['new_bytes'] / 1e6:.1f} MB) in {summary['seconds']} s")
+    if summary["changed"]:
+        log(f"{len(summary['changed'])} blobs were rewritten after the database copy; "
+            "their newer contents are in the snapshot")
+    return summary
+
+
+def list_snapshots(dest: Path) -> List[str]:
+    root = dest / "snapshots"
+    if not root.exists():
+        return []
+    return sorted(p.name for p in root.iterdir() if p.is_dir() and not p.name.startswith("."))
+
+
+def _manifest(dest: Path, snapshot: str) -> Iterator[Dict[str, Any]]:
+    with open(dest / "snapshots" / snapshot / "manifest.jsonl", encoding="utf-8") as f:
+        for line in f:
+            yield json.loads(line)
+
+
+def verify_snapshot(dest: Path, snapshot: str, deep: bool = True) -> Dict[str, Any]:
+    """Check the database copy and every object the snapshot needs (rehashing with ``deep``)."""
+    import hashlib
+
+    report = {"snapshot": snapshot, "database": None, "objects": 0, "problems": []}
+    conn = sqlite3.connect(dest / "snapshots" / snapshot / "app.db")
+    try:
+        report["database"] = conn.execute("PRAGMA integrity_check").fetchone()[0]
+    finally:
+        conn.close()
+    if report["database"] != "ok":
+        report["problems"].append(f"database: {report['database']}")
+
+    for item in _manifest(dest, snapshot):
+        report["objects"] += 1
+        obj = _object_path(dest, item["sha256"])
+        if not obj.exists():
+            report["problems"].append(f"missing object for {item['path']}")
+            continue
+        if obj.stat().st_size != item["size"]:
+            report["problems"].append(f"size mismatch for {item['path']}")
+            continue
+        if deep:
+            digest = hashlib.sha256()
+            with open(obj, "rb") as f:
+                for chunk in iter(lambda: f.read(blobs.COPY_CHUNK), b""):
+                    digest.update(chunk)
+            if digest.hexdigest() != item["sha256"]:
+                report["problems"].append(f"corrupt object for {item['path']}")
+    report["ok"] = not report["problems"]
+    return report
+
+
+def restore_snapshot(dest: Path, snapshot: str, db_path: str, upload_root: str) -> Dict[str, Any]:
+    """Materialise a snapshot as a new database file and upload tree."""
+    if os.path.exists(db_path):
+        raise SystemExit(f"refusing to overwrite existing database {db_path}")
+    snap_dir = dest / "snapshots" / snapshot
+    summary = json.loads((snap_dir / "summary.json").read_text(encoding="utf-8"))
+    new_root = str(Path(upload_root).resolve())
+
+    restored = 0
+    for item in _manifest(dest, snapshot):
+        target = Path(new_root) / item["path"] if not os.path.isabs(item["path"]) else Path(item["path"])
+        target.parent.mkdir(parents=True, exist_ok=True)
+        shutil.copyfile(_object_path(dest, item["sha256"]), target)
+        restored += 1
+
+    Path(db_path).parent.mkdir(parents=True, exist_ok=True)
+    shutil.copyfile(snap_dir / "app.db", db_path)
+    old_root = summary["upload_root"] + os.sep
+    conn = sqlite3.connect(db_path)
+    try:
+        conn.execute(
+            "UPDATE files SET disk_path = ? || substr(disk_path, ?) WHERE substr(disk_path, 1, ?) = ?",
+            (new_root + os.sep, len(old_root) + 1, len(old_root), old_root),
+        )
+        conn.commit()
+    finally:
+        conn.close()
+    return {"snapshot": snapshot, "files": restored, "db": db_path, "upload_root": new_root}
+
+
+def prune(dest: Path, keep: int) -> Dict[str, Any]:
+    """Keep the newest ``keep`` snapshots and delete objects none of them reference."""
+    snapshots = list_snapshots(dest)
+    dropped = snapshots[:-keep] if keep > 0 else snapshots
+    for name in dropped:
+        shutil.rmtree(dest / "snapshots" / name)
+
+    live = sqlite3.connect(":memory:")
+    live.execute("CREATE TABLE live (sha256 TEXT PRIMARY KEY)")
+    for name in list_snapshots(dest):
+        live.executemany("INSERT OR IGNORE INTO live VALUES (?)", ((i["sha256"],) for i in _manifest(dest, name)))
+    removed = 0
+    objects = dest / "objects"
+    if objects.exists():
+        for bucket in objects.iterdir():
+            for obj in bucket.iterdir():
+                if live.execute("SELECT 1 FROM live WHERE sha256 = ?", (obj.name,)).fetchone() is None:
+                    obj.unlink()
+                    removed += 1
+    live.close()
+    index = _open_index(dest)
+    try:
+        index.execute("DELETE FROM seen")  # cheap to rebuild; avoids pointing at removed objects
+        index.commit()
+    finally:
+        index.close()
+    return {"dropped_snapshots": dropped, "removed_objects": removed}
+
+
+def _sqlite_path(url: str) -> str:
+    parsed = make_url(url)
+    if parsed.get_backend_name() != "sqlite" or not parsed.database:
+        raise SystemExit("backups are only supported for file-based SQLite databases")
+    return parsed.database
+
+
+def main(argv=None) -> None:
+    parser = argparse.ArgumentParser(description="Back up, verify and restore Mini Drive data")
+    sub = parser.add_subparsers(dest="command", required=True)
+    p = sub.add_parser("create")
+    p.add_argument("dest")
+    p = sub.add_parser("list")
+    p.add_argument("dest")
+    p = sub.add_parser("verify")
+    p.add_argument("dest")
+    p.add_argument("snapshot", nargs="?")
+    p.add_argument("--quick", action="store_true", help="check sizes only, do not rehash objects")
+    p = sub.add_parser("restore")
+    p.add_argument("dest")
+    p.add_argument("snapshot")
+    p.add_argument("--db", required=True, help="path of the database file to create")
+    p.add_argument("--uploads", required=True, help="directory to restore blobs into")
+    p = sub.add_parser("prune")
+    p.add_argument("dest")
+    p.add_argument("--keep", type=int, required=True)
+    args = parser.parse_args(argv)
+    dest = Path(args.dest)
+
+    if args.command == "create":
+        default_db = f"sqlite:///{Path(__file__).parent / 'app.db'}"
+        db_path = _sqlite_path(os.environ.get("DATABASE_URL", default_db))
+        upload_root = os.environ.get("UPLOAD_ROOT", str(Path(__file__).parent / "uploads"))
+        volumes = [v for v in os.environ.get("STORAGE_VOLUMES", "").split(os.pathsep) if v]
+        pool = StoragePool(upload_root, volumes or None, int(os.environ.get("STORAGE_REPLICAS", "2")))
+        result: Any = create_backup(db_path, upload_root, dest, storage=pool)
+    elif args.command == "list":
+        result = list_snapshots(dest)
+    elif args.command == "verify":
+        snapshot = args.snapshot or (list_snapshots(dest) or [None])[-1]
+        if snapshot is None:
+            raise SystemExit("no snapshots")
+        result = verify_snapshot(dest, snapshot, deep=not args.quick)
+    elif args.command == "restore":
+        result = restore_snapshot(dest, args.snapshot, args.db, args.uploads)
+    else:
+        result = prune(dest, args.keep)
+    print(json.dumps(result, ensure_ascii=False, indent=2))
+    if isinstance(result, dict) and result.get("ok") is False:
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,144 @@
+"""Writing blobs into the upload tree.
+
+Blobs are written to a hidden temporary file next to their destination and
+renamed into place, so a crash never leaves a half-written file under a
+real name, and a reader of the old file keeps its old inode.
+"""
+import hashlib
+import os
+import threading
+from pathlib import Path
+from typing import BinaryIO, Optional, Tuple
+
+COPY_CHUNK = 1024 * 1024
+
+
+def temp_path_for(dest: Path) -> Path:
+    return dest.with_name(f".{dest.name}.{os.getpid()}.{threading.get_ident()}.part")
+
+
+class DigestMismatch(ValueError):
+    """The written content did not have the SHA-256 the caller announced."""
+
+
+def write_stream(stream: BinaryIO, dest: Path, expected_sha256: Optional[str] = None) -> Tuple[int, str]:
+    """Copy ``stream`` to ``dest`` atomically; returns ``(size, sha256 hex)``.
+
+    With ``expected_sha256`` the existing ``dest`` is left untouched unless the
+    content matches.
+    """
+    digest = hashlib.sha256()
+    size = 0
+    dest.parent.mkdir(parents=True, exist_ok=True)
+    tmp = temp_path_for(dest)
+    try:
+        with open(tmp, "wb") as out:
+            while True:
+                chunk = stream.read(COPY_CHUNK)
+                if not chunk:
+                    break
+                digest.update(chunk)
+                out.write(chunk)
+                size += len(chunk)
+        if expected_sha256 is not None and digest.hexdigest() != expected_sha256:
+            raise DigestMismatch(f"expected {expected_sha256}, got {digest.hexdigest()}")
+        os.replace(tmp, dest)
+    except BaseException:
+        tmp.unlink(missing_ok=True)
+        raise
+    return size, digest.hexdigest()
+
+
+def copy_file(src: str, dest: Path) -> Tuple[int, str]:
+    with open(src, "rb") as f:
+        return write_stream(f, dest)
+
+
+FICLONE = 0x40049409  # linux/fs.h: _IOW(0x94, 9, int)
+
+
+def _reflink(src_fd: int, dst_fd: int) -> bool:
+    try:
+        import fcntl
+        fcntl.ioctl(dst_fd, FICLONE, src_fd)
+        return True
+    except (ImportError, OSError):
+        return False
+
+
+def _kernel_copy(src_fd: int, dst_fd: int, size: int) -> str:
+    """Copy inside the kernel (no user-space buffers); returns the method used."""
+    if hasattr(os, "copy_file_range"):
+        try:
+            copied = 0
+            while copied < size:
+                n = os.copy_file_range(src_fd, dst_fd, size - copied)
+                if n == 0:
+                    break
+                copied += n
+            return "copy_file_range"
+        except OSError:
+            os.lseek(src_fd, 0, os.SEEK_SET)
+            os.lseek(dst_fd, 0, os.SEEK_SET)
+            os.ftruncate(dst_fd, 0)
+    if hasattr(os, "sendfile"):
+        try:
+            offset = 0
+            while offset < size:
+                n = os.sendfile(dst_fd, src_fd, offset, size - offset)
+                if n == 0:
+                    break
+                offset += n
+            return "sendfile"
+        except OSError:
+            os.ftruncate(dst_fd, 0)
+            os.lseek(dst_fd, 0, os.SEEK_SET)
+    with open(src_fd, "rb", closefd=False) as fin, open(dst_fd, "wb", closefd=False) as fout:
+        fin.seek(0)
+        for chunk in iter(lambda: fin.read(COPY_CHUNK), b""):
+            fout.write(chunk)
+    return "copy"
+
+
+def clone_file(src: str, dest: Path, allow_link: bool = True) -> str:
+    """Make ``dest`` hold the same bytes as ``src`` without passing them through Python.
+
+    Tries, in order: a hard link (safe because blobs are never modified in
+    place: a later write to either path renames a new inode over it), a
+    reflink (``FICLONE``: copy-on-write on btrfs/XFS), ``copy_file_range``,
+    ``sendfile`` and finally a buffered copy. Returns the method used.
+
+    An existing ``dest`` (a tombstoned blob not reaped yet) is never replaced
+    by a link: the reaper tells a rewritten path by its inode having a single
+    link.
+    """
+    if os.path.abspath(src) == os.path.abspath(dest):
+        return "same"
+    dest.parent.mkdir(parents=True, exist_ok=True)
+    tmp = temp_path_for(dest)
+    try:
+        method = None
+        if allow_link and not os.path.lexists(dest):
+            try:
+                os.link(src, tmp)
+                method = "link"
+            except OSError:
+                pass  # another filesystem, or links not supported
+        if method is None:
+            src_fd = os.open(src, os.O_RDONLY)
+            try:
+                dst_fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+                try:
+                    if _reflink(src_fd, dst_fd):
+                        method = "reflink"
+                    else:
+                        method = _kernel_copy(src_fd, dst_fd, os.fstat(src_fd).st_size)
+                finally:
+                    os.close(dst_fd)
+            finally:
+                os.close(src_fd)
+        os.replace(tmp, dest)
+        return method
+    except BaseException:
+        tmp.unlink(missing_ok=True)
+        raise
@@ -0,0 +1,205 @@
+"""Bulk import of an existing directory tree into one user's space.
+
+    python -m server.bulk_import /srv/archive --user alice [--workers 16] [--batch 2000]
+
+The tree is walked with ``os.scandir`` in sorted order; a thread pool hashes
+and copies files while the main thread inserts ``FileEntry`` rows, one
+transaction per batch. After every commit the last imported path is written
+to the checkpoint file, so an interrupted import resumes right after it.
+Source directories become folders (``server.folders``), as in an archive
+upload; the main thread creates them before handing their files to the pool.
+A file whose (sanitized) name is already taken in its folder, by an existing
+file or by an earlier one of the same import, is skipped and reported.
+"""
+import argparse
+import json
+import os
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Callable, Deque, Dict, List, Optional, Set, Tuple
+
+from sqlalchemy import func, insert, select
+
+from . import collection, folders
+from .models import FileEntry, User
+from .reaper import walk_sorted
+from .storage import StoragePool
+
+
+def load_checkpoint(path: Path) -> Dict[str, Any]:
+    if path.exists():
+        return json.loads(path.read_text(encoding="utf-8"))
+    return {}
+
+
+def save_checkpoint(path: Path, state: Dict[str, Any]) -> None:
+    tmp = path.with_name(path.name + ".tmp")
+    tmp.write_text(json.dumps(state, ensure_ascii=False), encoding="utf-8")
+    os.replace(tmp, path)
+
+
+def run_import(session_factory, upload_root: str, source: str, owner_id: int, checkpoint: Path,
+               workers: int = 8, batch_size: int = 1000, extensions: Optional[Set[str]] = None,
+               progress: Callable[[str], None] = print, storage: Optional[StoragePool] = None) -> Dict[str, Any]:
+    from .app import secure_filename_unicode
+
+    source = str(Path(source).resolve())
+    state = load_checkpoint(checkpoint)
+    if state and (state.get("source") != source or state.get("owner_id") != owner_id):
+        raise SystemExit(f"checkpoint {checkpoint} belongs to another import")
+    state.setdefault("source", source)
+    state.setdefault("owner_id", owner_id)
+    state.setdefault("files", 0)
+    state.setdefault("bytes", 0)
+    state.setdefault("errors", 0)
+    state.setdefault("skipped", 0)
+
+    storage = storage or StoragePool(upload_root)
+    started = time.monotonic()
+    session_files = session_bytes = 0
+    folder_db = session_factory()
+    blob_dirs: Dict[str, Path] = {}  # folder path -> its blob directory
+    taken: Dict[str, Set[str]] = {}  # folder path -> names of live files, including this import's
+
+    def target(path: str) -> Optional[Tuple[str, Path]]:
+        """``(folder path, blob path)`` for a source file, creating its folder on first use.
+
+        ``None`` if the name is taken in that folder.
+        """
+        rel = Path(os.path.relpath(path, source))
+        folder_path = folders.normalize("/".join(rel.parts[:-1]))
+        if folder_path not in blob_dirs:
+            folder = folders.ensure(folder_db, owner_id, folder_path)
+            folder_db.commit()
+            blob_dirs[folder_path] = folders.blob_dir(upload_root, owner_id, folder)
+            taken[folder_path] = set(folder_db.execute(
+                select(FileEntry.name).where(FileEntry.owner_id == owner_id, FileEntry.folder_path == folder_path,
+                                             FileEntry.deleted_at.is_(None))
+            ).scalars())
+        name = secure_filename_unicode(rel.name)
+        if name in taken[folder_path]:
+            return None
+        taken[folder_path].add(name)
+        return folder_path, blob_dirs[folder_path] / name
+
+    def copy_one(path: str, dest: Path) -> Tuple[str, Path, int, str]:
+        with open(path, "rb") as f:
+            size, digest = storage.write_stream(f, dest)
+        return path, dest, size, digest
+
+    def commit(rows: List[Dict[str, Any]], last_path: str) -> None:
+        nonlocal session_files, session_bytes
+        db = session_factory()
+        try:
+            ids = db.execute(insert(FileEntry).returning(FileEntry.id, sort_by_parameter_order=True), rows).scalars()
+            for row, file_id in zip(rows, ids):
+                row["id"] = file_id
+            collection.record_added_many(db, owner_id, rows)
+            db.commit()
+        finally:
+            db.close()
+        state["last_path"] = last_path
+        state["files"] += len(rows)
+        state["bytes"] += sum(r["size"] for r in rows)
+        save_checkpoint(checkpoint, state)
+        session_files += len(rows)
+        session_bytes += sum(r["size"] for r in rows)
+        elapsed = max(time.monotonic() - started, 1e-6)
+        progress(f"{state['files']} files, {state['bytes'] / 1e6:.1f} MB imported "
+                 f"({session_files / elapsed:.0f} files/s, {session_bytes / 1e6 / elapsed:.1f} MB/s)")
+
+    rows: List[Dict[str, Any]] = []
+    last_path = state.get("last_path")
+    in_flight: Deque[Tuple[str, str, Future]] = deque()
+
+    def drain_one() -> None:
+        nonlocal last_path
+        path, folder_path, future = in_flight.popleft()
+        last_path = path
+        try:
+            _, dest, size, digest = future.result()
+        except OSError as e:
+            state["errors"] += 1
+            progress(f"skipped {path}: {e}")
+            return
+        now = datetime.utcnow()
+        rows.append({
+            "owner_id": owner_id, "uploader_id": owner_id, "editor_id": owner_id, "folder_path": folder_path,
+            "name": dest.name, "extension": dest.suffix.lower(), "disk_path": str(dest),
+            "size": size, "content_hash": digest, "created_at": now, "updated_at": now,
+        })
+        if len(rows) >= batch_size:
+            commit(rows, last_path)
+            rows.clear()
+
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            for path, _st in walk_sorted(source, start_after=state.get("last_path")):
+                if extensions and Path(path).suffix.lower() not in extensions:
+                    continue
+                if os.path.abspath(path) == os.path.abspath(checkpoint):
+                    continue
+                placed = target(path)
+                if placed is None:
+                    state["skipped"] += 1
+                    progress(f"skipped {path}: the name is taken in its folder")
+                    continue
+                folder_path, dest = placed
+                in_flight.append((path, folder_path, pool.submit(copy_one, path, dest)))
+                # Keep the pool busy while the main thread is inserting
+                if len(in_flight) >= 2 * batch_size:
+                    drain_one()
+            while in_flight:
+                drain_one()
+    finally:
+        folder_db.close()
+    if rows:
+        commit(rows, last_path)
+    elif last_path and last_path != state.get("last_path"):
+        state["last_path"] = last_path
+        save_checkpoint(checkpoint, state)
+
+    elapsed = time.monotonic() - started
+    return {
+        "files": session_files,
+        "bytes": session_bytes,
+        "errors": state["errors"],
+        "skipped": state["skipped"],
+        "seconds": round(elapsed, 3),
+        "files_per_second": round(session_files / elapsed, 1) if elapsed else 0.0,
+        "mb_per_second": round(session_bytes / 1e6 / elapsed, 2) if elapsed else 0.0,
+    }
+
+
+def main(argv=None) -> None:
+    parser = argparse.ArgumentParser(description="Import a directory tree into a user's files")
+    parser.add_argument("source")
+    parser.add_argument("--user", required=True, help="username that will own the files")
+    parser.add_argument("--workers", type=int, default=min(32, (os.cpu_count() or 1) * 4))
+    parser.add_argument("--batch", type=int, default=1000, help="rows per transaction")
+    parser.add_argument("--checkpoint", help="resume file (default: ./import-<user>.json)")
+    parser.add_argument("--ext", help="comma separated extensions to import, e.g. .py,.jpg")
+    args = parser.parse_args(argv)
+
+    from .app import create_app
+    app = create_app(background_jobs=False)
+    factory = app.extensions["db_session"].session_factory
+    with factory() as db:
+        owner_id = db.execute(select(User.id).where(func.lower(User.username) == args.user.lower())).scalar()
+    if owner_id is None:
+        raise SystemExit(f"no such user: {args.user}")
+
+    extensions = {e if e.startswith(".") else f".{e}" for e in args.ext.lower().split(",")} if args.ext else None
+    summary = run_import(
+        factory, app.config["UPLOAD_ROOT"], args.source, owner_id,
+        Path(args.checkpoint or f"import-{args.user}.json"),
+        workers=args.workers, batch_size=args.batch, extensions=extensions, storage=app.extensions["storage"],
+    )
+    print(json.dumps(summary))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,308 @@
+"""Per-owner bookkeeping kept in step with the ``files`` table.
+
+Every path that adds or removes a ``FileEntry`` calls ``record_added`` /
+``record_removed`` inside its own transaction, so the aggregates read by
+``GET /files/stats`` never need a GROUP BY over ``files``, the owner's
+``files_version`` (the listing ETag) moves with every mutation, a
+``file_events`` row is queued for push subscribers and the filename search
+index (``server.search``) stays in step.
+"""
+from datetime import datetime
+from types import SimpleNamespace
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from sqlalchemy import String, cast, delete, func, insert, literal, select, update
+from sqlalchemy.orm import Session, aliased, selectinload
+
+from . import search
+from .models import FileEntry, FileEvent, FileStat, User
+
+
+def _buckets(entry) -> Iterable[Tuple[str, str]]:
+    yield "extension", entry.extension
+    yield "uploader", str(entry.uploader_id)
+
+
+def _bucket_columns() -> Dict[str, Any]:
+    """SQL expressions for the same buckets as ``_buckets``."""
+    return {"extension": FileEntry.extension, "uploader": cast(FileEntry.uploader_id, String)}
+
+
+def _adjust(db: Session, owner_id: int, dimension: str, key: str, count: int, size: int) -> None:
+    bucket = (FileStat.owner_id == owner_id) & (FileStat.dimension == dimension) & (FileStat.key == key)
+    result = db.execute(
+        update(FileStat).where(bucket).values(
+            file_count=FileStat.file_count + count,
+            total_bytes=FileStat.total_bytes + size,
+        )
+    )
+    if result.rowcount == 0 and count > 0:
+        db.add(FileStat(owner_id=owner_id, dimension=dimension, key=key, file_count=count, total_bytes=size))
+        db.flush()
+    elif count < 0:
+        db.execute(delete(FileStat).where(bucket & (FileStat.file_count <= 0)))
+
+
+def _apply(db: Session, entry: FileEntry, sign: int) -> None:
+    for dimension, key in _buckets(entry):
+        _adjust(db, entry.owner_id, dimension, key, sign, sign * (entry.size or 0))
+
+
+def bump_version(db: Session, owner_id: int) -> int:
+    return db.execute(
+        update(User).where(User.id == owner_id).values(files_version=User.files_version + 1)
+        .returning(User.files_version)
+    ).scalar_one()
+
+
+def current_version(db: Session, owner_id: int) -> int:
+    """Primary-key lookup on ``users``; never touches ``files``."""
+    return db.execute(select(User.files_version).where(User.id == owner_id)).scalar() or 0
+
+
+def _emit(db: Session, kind: str, entry: FileEntry, version: int) -> None:
+    db.add(FileEvent(owner_id=entry.owner_id, kind=kind, file_id=entry.id, name=entry.name,
+                     folder=entry.folder_path or "/", version=version, created_at=datetime.utcnow()))
+
+
+def _emit_bulk(db: Session, owner_id: int, description: str) -> None:
+    db.add(FileEvent(owner_id=owner_id, kind="bulk", file_id=0, name=description,
+                     version=bump_version(db, owner_id), created_at=datetime.utcnow()))
+
+
+def record_added(db: Session, entry: FileEntry) -> None:
+    db.flush()  # the event needs the new row's id
+    _apply(db, entry, +1)
+    search.index_many(db, [(entry.id, entry.name)])
+    _emit(db, "created", entry, bump_version(db, entry.owner_id))
+
+
+def record_removed(db: Session, entry: FileEntry) -> None:
+    _apply(db, entry, -1)
+    search.unindex(db, entry.id)
+    _emit(db, "deleted", entry, bump_version(db, entry.owner_id))
+
+
+def snapshot(entry: FileEntry) -> SimpleNamespace:
+    """The fields the bookkeeping needs, copied before an entry is changed in place."""
+    return SimpleNamespace(id=entry.id, owner_id=entry.owner_id, name=entry.name, extension=entry.extension,
+                           uploader_id=entry.uploader_id, size=entry.size, folder_path=entry.folder_path)
+
+
+def record_moved(db: Session, before: SimpleNamespace, entry: FileEntry) -> None:
+    """An entry was renamed or given to another owner: a delete where it was, a create where it is."""
+    _apply(db, before, -1)
+    _emit(db, "deleted", before, bump_version(db, before.owner_id))
+    _apply(db, entry, +1)
+    _emit(db, "created", entry, bump_version(db, entry.owner_id))
+    if entry.name != before.name:
+        search.unindex(db, entry.id)
+        search.index_many(db, [(entry.id, entry.name)])
+
+
+def record_replaced(db: Session, before: SimpleNamespace, entry: FileEntry) -> None:
+    """An entry's blob was overwritten in place: same id, name and folder, new size and content."""
+    _apply(db, before, -1)
+    _apply(db, entry, +1)
+    _emit(db, "updated", entry, bump_version(db, entry.owner_id))
+
+
+def record_added_many(db: Session, owner_id: int, rows: List[Dict[str, Any]]) -> None:
+    """Bookkeeping for a batch inserted in one statement (bulk import, archive upload).
+
+    Aggregates are applied once per bucket and subscribers get a single
+    ``bulk`` event telling them to re-list instead of one event per file.
+    Rows must carry their new ``id`` (``INSERT ... RETURNING``) to be searchable.
+    """
+    if not rows:
+        return
+    deltas: Dict[Tuple[str, str], List[int]] = {}
+    for row in rows:
+        for bucket in _buckets(SimpleNamespace(**row)):
+            delta = deltas.setdefault(bucket, [0, 0])
+            delta[0] += 1
+            delta[1] += row.get("size") or 0
+    for (dimension, key), (count, size) in sorted(deltas.items()):
+        _adjust(db, owner_id, dimension, key, count, size)
+    search.index_many(db, [(row["id"], row["name"]) for row in rows if row.get("id")])
+    _emit_bulk(db, owner_id, f"{len(rows)} files")
+
+
+def record_removed_where(db: Session, owner_id: int, where) -> int:
+    """Bookkeeping for live files about to be removed by one statement matching ``where``.
+
+    Call before the statement runs. The deltas come from one grouped query
+    per dimension, so a subtree of any size costs the same number of round trips.
+    """
+    where = (FileEntry.owner_id == owner_id) & FileEntry.deleted_at.is_(None) & where
+    total = 0
+    for dimension, column in _bucket_columns().items():
+        grouped = db.execute(
+            select(column, func.count(), func.coalesce(func.sum(FileEntry.size), 0)).where(where).group_by(column)
+        ).all()
+        for key, count, size in grouped:
+            _adjust(db, owner_id, dimension, key, -count, -size)
+            if dimension == "extension":
+                total += count
+    search.unindex_where(db, where)
+    _emit_bulk(db, owner_id, f"{total} files removed")
+    return total
+
+
+def record_changed_many(db: Session, owner_id: int, description: str) -> None:
+    """Many files changed place but not content (a folder move): clients re-list."""
+    _emit_bulk(db, owner_id, description)
+
+
+_uploader, _editor = aliased(User), aliased(User)
+
+# Keys of FileEntry.to_dict() -> the column each one is read from, for ``?fields=``
+FILE_FIELDS = {
+    "id": FileEntry.id,
+    "name": FileEntry.name,
+    "extension": FileEntry.extension,
+    "disk_path": FileEntry.disk_path,
+    "size": FileEntry.size,
+    "sha256": FileEntry.content_hash,
+    "folder": FileEntry.folder_path,
+    "created_at": FileEntry.created_at,
+    "updated_at": FileEntry.updated_at,
+    "uploader": _uploader.username,
+    "editor": _editor.username,
+}
+
+
+def parse_fields(raw) -> Optional[List[str]]:
+    """``"id,name"`` or ``["id", "name"]`` -> field names; None (all fields) when absent or empty.
+
+    Raises ``ValueError`` naming any field ``FileEntry.to_dict`` does not have.
+    """
+    if raw is None:
+        return None
+    names = raw.split(",") if isinstance(raw, str) else raw
+    if not isinstance(names, list) or not all(isinstance(n, str) for n in names):
+        raise ValueError("fields must be a comma separated string or a list of names")
+    names = list(dict.fromkeys(n.strip() for n in names if n.strip()))
+    unknown = [n for n in names if n not in FILE_FIELDS]
+    if unknown:
+        raise ValueError(f"unknown fields: {', '.join(unknown)}")
+    return names or None
+
+
+def select_fields(fields: List[str]):
+    """A Core select of just ``fields`` (labelled by field name); the user joins only when asked for."""
+    stmt = select(*(FILE_FIELDS[f].label(f) for f in fields)).select_from(FileEntry)
+    if "uploader" in fields:
+        stmt = stmt.outerjoin(_uploader, _uploader.id == FileEntry.uploader_id)
+    if "editor" in fields:
+        stmt = stmt.outerjoin(_editor, _editor.id == FileEntry.editor_id)
+    return stmt
+
+
+def field_dict(row, fields: List[str]) -> Dict[str, Any]:
+    """The ``fields`` of a ``select_fields`` row, serialised like ``FileEntry.to_dict``."""
+    out = {}
+    for f in fields:
+        value = row._mapping[f]
+        out[f] = value.isoformat() if isinstance(value, datetime) else value
+    return out
+
+
+def listing_statement(db: Session, owner_id: int, ftype: str = "all", sort_by: str = "created_at",
+                      order: str = "desc", folder_path: Optional[str] = None,
+                      name_contains: Optional[str] = None, name_prefix: Optional[str] = None,
+                      fields: Optional[List[str]] = None):
+    """The ``GET /files`` query; ``server.dbbench`` times it and checks its plan.
+
+    Without ``fields`` it selects ``FileEntry`` objects, with them only those columns.
+    """
+    if fields is None:
+        # one extra query for all uploaders/editors instead of one per distinct user
+        stmt = select(FileEntry).options(selectinload(FileEntry.uploader), selectinload(FileEntry.editor))
+    else:
+        stmt = select_fields(fields)
+    stmt = stmt.where(FileEntry.owner_id == owner_id, FileEntry.deleted_at.is_(None))
+    if ftype and ftype != "all":
+        # served by ix_files_owner_ext_updated
+        stmt = stmt.where(FileEntry.extension == f".{ftype}")
+    if folder_path is not None:
+        # one folder's files only, served by ix_files_owner_folder_updated
+        stmt = stmt.where(FileEntry.folder_path == folder_path)
+    # substring / prefix of the name, case- and Unicode-insensitive, via the trigram index
+    stmt = stmt.where(*search.name_filter(db, name_contains, name_prefix))
+
+    if sort_by == "uploader":
+        # join with user for uploader name
+        return stmt.join(User, User.id == FileEntry.uploader_id).order_by(
+            User.username.asc() if order == "asc" else User.username.desc()
+        )
+    # default by updated_at
+    return stmt.order_by(FileEntry.updated_at.asc() if order == "asc" else FileEntry.updated_at.desc())
+
+
+def lookup(db: Session, owner_id: int, ids: List[int], fields: Optional[List[str]] = None) -> Dict[int, Dict[str, Any]]:
+    """Metadata of the owner's live files among ``ids``, keyed by id, in one query."""
+    where = (FileEntry.owner_id == owner_id, FileEntry.deleted_at.is_(None), FileEntry.id.in_(ids))
+    if fields is None:
+        rows = db.execute(
+            select(FileEntry).where(*where).options(selectinload(FileEntry.uploader), selectinload(FileEntry.editor))
+        ).scalars()
+        return {r.id: r.to_dict() for r in rows}
+    rows = db.execute(select_fields(fields).add_columns(FileEntry.id.label("_id")).where(*where))
+    return {row._id: field_dict(row, fields) for row in rows}
+
+
+def rebuild_stats(conn, owner_id: Optional[int] = None) -> None:
+    """Recompute the aggregates from ``files``; used when upgrading a database and for repairs."""
+    wipe = delete(FileStat)
+    if owner_id is not None:
+        wipe = wipe.where(FileStat.owner_id == owner_id)
+    conn.execute(wipe)
+    for dimension, column in _bucket_columns().items():
+        grouped = select(
+            FileEntry.owner_id,
+            literal(dimension),
+            column,
+            func.count(),
+            func.coalesce(func.sum(FileEntry.size), 0),
+        ).where(FileEntry.deleted_at.is_(None)).group_by(FileEntry.owner_id, column)
+        if owner_id is not None:
+            grouped = grouped.where(FileEntry.owner_id == owner_id)
+        conn.execute(
+            insert(FileStat).from_select(["owner_id", "dimension", "key", "file_count", "total_bytes"], grouped)
+        )
+
+
+def read_stats(db: Session, owner_id: int) -> Dict[str, Any]:
+    rows = db.execute(
+        select(FileStat.dimension, FileStat.key, FileStat.file_count, FileStat.total_bytes)
+        .where(FileStat.owner_id == owner_id)
+    ).all()
+
+    uploader_ids = [int(r.key) for r in rows if r.dimension == "uploader"]
+    names = dict(db.execute(select(User.id, User.username).where(User.id.in_(uploader_ids))).all()) if uploader_ids else {}
+
+    extensions, uploaders = [], []
+    total_count = total_bytes = 0
+    for r in rows:
+        if r.dimension == "extension":
+            extensions.append({"extension": r.key, "count": r.file_count, "bytes": r.total_bytes})
+            total_count += r.file_count
+            total_bytes += r.total_bytes
+        else:
+            uploaders.append({"uploader": names.get(int(r.key)), "count": r.file_count, "bytes": r.total_bytes})
+    extensions.sort(key=lambda x: (-x["count"], x["extension"]))
+    uploaders.sort(key=lambda x: (-x["count"], x["uploader"] or ""))
+
+    # Walks ix_files_owner_updated from the newest end to the first live row
+    # (max() would visit every entry of the owner to check deleted_at)
+    newest: Optional[datetime] = db.execute(
+        select(FileEntry.updated_at).where(FileEntry.owner_id == owner_id, FileEntry.deleted_at.is_(None))
+        .order_by(FileEntry.updated_at.desc()).limit(1)
+    ).scalar()
+    return {
+        "total": {"count": total_count, "bytes": total_bytes},
+        "extensions": extensions,
+        "uploaders": uploaders,
+        "newest_updated_at": newest.isoformat() if newest else None,
+    }
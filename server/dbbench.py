@@ -0,0 +1,278 @@
+"""Database benchmarks at realistic sizes, with query-plan checks.
+
+Builds synthetic databases (users, folders, files, tombstones, events) at
+each requested size, then runs every query shape the API issues against
+them: the median time over a few runs and the ``EXPLAIN QUERY PLAN`` of
+every statement it executed. Each shape states which indexes it must use
+and whether it may sort in a temporary b-tree; a full table scan or a
+missing index is reported as a failure and makes the command exit 1.
+
+    python -m server.dbbench --rows 10000,100000,1000000 --out dbbench.json
+    python -m server.dbbench --rows 1000000 --dir /tmp/dbbench   # reuses the generated database
+
+One user ("heavy") owns 5% of the rows, the others share the rest, so both
+a large and a typical collection are measured.
+"""
+import argparse
+import json
+import random
+import sqlite3
+import statistics
+import sys
+import time
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from pathlib import Path
+from types import SimpleNamespace
+from typing import Any, Callable, Dict, List, Tuple
+
+from sqlalchemy import event, func, insert, or_, select
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Session, sessionmaker
+
+from . import collection, events, folders, search, sqlstats
+from .models import FileEntry, FileEvent, Folder, User, create_db_engine, init_db
+
+BATCH = 20000
+HEAVY_SHARE = 20  # the heavy user owns 1/20 of the rows
+FOLDER_TREE = ["/docs/", "/docs/2024/", "/photos/", "/photos/2024/", "/src/"]
+EXTENSIONS = [".py", ".jpg", ".pdf", ".docx", ".txt", ".png", ".md", ".json"]
+WORDS = ["report", "invoice", "photo", "main", "звіт", "notes", "budget", "scan", "draft", "backup"]
+TEMP_SORT = "USE TEMP B-TREE FOR ORDER BY"
+
+
+# -- synthetic data -----------------------------------------------------------
+
+def generate(engine: Engine, rows: int, seed: int = 1) -> Dict[str, Any]:
+    """Fill an empty database with ``rows`` files; returns what the query shapes need."""
+    rng = random.Random(seed)
+    users = max(20, rows // 500)
+    heavy_rows = rows // HEAVY_SHARE
+    now = datetime(2026, 1, 1)
+    started = time.perf_counter()
+    with engine.begin() as conn:
+        conn.exec_driver_sql("PRAGMA synchronous=OFF")
+        conn.execute(insert(User), [{"id": u, "username": f"user{u:07d}", "password_hash": "!", "files_version": 1}
+                                    for u in range(1, users + 1)])
+        folder_rows = []
+        for u in range(1, users + 1):
+            ids = {}
+            for path in FOLDER_TREE:
+                ids[path] = len(folder_rows) + 1
+                folder_rows.append({"id": ids[path], "owner_id": u, "parent_id": ids.get(folders.parent_of(path)),
+                                    "name": path.rstrip("/").rsplit("/", 1)[1], "path": path, "created_at": now})
+        conn.execute(insert(Folder), folder_rows)
+
+        batch = []
+        for i in range(1, rows + 1):
+            owner = 1 if i <= heavy_rows else rng.randint(2, users)
+            ext = rng.choice(EXTENSIONS)
+            updated = now - timedelta(seconds=rng.randint(0, 30_000_000))
+            batch.append({
+                "id": i, "owner_id": owner, "uploader_id": owner if rng.random() < 0.9 else rng.randint(1, users),
+                "editor_id": owner, "name": f"{rng.choice(WORDS)}_{i}{ext}", "extension": ext,
+                "disk_path": f"/bench/{owner}/{i}{ext}", "size": rng.randint(100, 5_000_000),
+                "content_hash": f"{rng.getrandbits(256):064x}", "folder_path": rng.choice(["/"] + FOLDER_TREE),
+                "created_at": updated, "updated_at": updated,
+                "deleted_at": now if rng.random() < 0.01 else None,
+            })
+            if len(batch) == BATCH:
+                conn.execute(insert(FileEntry), batch)
+                batch = []
+        if batch:
+            conn.execute(insert(FileEntry), batch)
+
+        event_rows = [{"owner_id": 1 if n % 10 == 0 else rng.randint(2, users), "kind": "created",
+                       "file_id": rng.randint(1, rows), "name": "x.py", "folder": "/", "version": n, "created_at": now}
+                      for n in range(1, max(1000, rows // 100) + 1)]
+        conn.execute(insert(FileEvent), event_rows)
+        if search.probe(engine):
+            search.rebuild(conn)
+        collection.rebuild_stats(conn)
+    return {"users": users, "heavy_rows": heavy_rows, "seconds": round(time.perf_counter() - started, 2)}
+
+
+def open_database(path: Path, rows: int) -> Tuple[Engine, Dict[str, Any]]:
+    """The database for ``rows``, generated on first use."""
+    meta_path = path.with_suffix(".json")
+    fresh = not (path.exists() and meta_path.exists())
+    if fresh:
+        path.unlink(missing_ok=True)
+    engine = create_db_engine(f"sqlite:///{path}")
+    init_db(engine)
+    if fresh:
+        meta_path.write_text(json.dumps(generate(engine, rows)), encoding="utf-8")
+    search.probe(engine)
+    return engine, json.loads(meta_path.read_text(encoding="utf-8"))
+
+
+# -- query shapes -------------------------------------------------------------
+
+@dataclass
+class Shape:
+    name: str
+    run: Callable[[Session, SimpleNamespace], Any]
+    uses: Tuple[str, ...] = ()       # substrings that must appear in the plan (index names)
+    sort_ok: bool = True             # may sort rows in a temporary b-tree
+    scan_ok: Tuple[str, ...] = ()    # tables a full scan is acceptable on
+
+
+def _listing(owner=None, **kwargs) -> Callable[[Session, SimpleNamespace], Any]:
+    def run(db, ctx):
+        return db.execute(collection.listing_statement(db, owner or ctx.heavy, **kwargs)).scalars().all()
+    return run
+
+
+def _upload_duplicates(db, ctx):
+    # POST /files/check: files with the same content the upload could be cloned from
+    return db.execute(select(FileEntry).where(
+        FileEntry.owner_id == ctx.heavy, FileEntry.content_hash == ctx.content_hash,
+        FileEntry.size == ctx.size, FileEntry.deleted_at.is_(None))).scalars().all()
+
+
+def _name_taken(db, ctx):
+    # copy / move: is the destination name free? (it usually is, so nothing stops the search early)
+    return db.execute(select(FileEntry.id).where(
+        or_(FileEntry.disk_path == ctx.disk_path,
+            (FileEntry.owner_id == ctx.heavy) & (FileEntry.folder_path == "/docs/") & (FileEntry.name == "free.txt")),
+        FileEntry.deleted_at.is_(None), FileEntry.id != 1).limit(1)).scalar()
+
+
+def _login(db, ctx):
+    return db.execute(select(User).where(func.lower(User.username) == "user0000002")).scalar_one_or_none()
+
+
+def _tombstones(db, ctx):
+    # server.reaper: the next batch of deleted rows
+    return db.execute(select(FileEntry.id, FileEntry.disk_path).where(
+        FileEntry.deleted_at.is_not(None), FileEntry.id > 0).order_by(FileEntry.id).limit(1000)).all()
+
+
+def _rebalance_page(db, ctx):
+    # server.storage rebalance: the next page of live blobs
+    return db.execute(select(FileEntry.disk_path).where(FileEntry.deleted_at.is_(None), FileEntry.disk_path > "")
+                      .group_by(FileEntry.disk_path).order_by(FileEntry.disk_path).limit(1000)).scalars().all()
+
+
+SHAPES = [
+    Shape("list_newest", _listing(), uses=("ix_files_owner_updated",), sort_ok=False),
+    Shape("list_oldest", _listing(order="asc"), uses=("ix_files_owner_updated",), sort_ok=False),
+    Shape("list_typical_user", lambda db, ctx: _listing(owner=ctx.typical)(db, ctx),
+          uses=("ix_files_owner_updated",), sort_ok=False),
+    Shape("list_sparse_fields", _listing(fields=["id", "name", "updated_at"]), uses=("ix_files_owner_updated",),
+          sort_ok=False),
+    Shape("list_by_type", _listing(ftype="py"), uses=("ix_files_owner_ext_updated",), sort_ok=False),
+    Shape("list_folder", _listing(folder_path="/docs/2024/"), uses=("ix_files_owner_folder_updated",), sort_ok=False),
+    Shape("list_by_uploader", _listing(sort_by="uploader"), uses=("ix_files_owner",)),
+    Shape("search_contains", _listing(name_contains="invoice_12"), uses=("VIRTUAL TABLE INDEX 0:M",)),
+    Shape("search_prefix", _listing(name_prefix="звіт_3"), uses=("VIRTUAL TABLE INDEX 0:M",)),
+    # under three characters the trigram index cannot help: its own table is scanned
+    Shape("search_short", _listing(name_contains="_7"), scan_ok=("file_names",)),
+    Shape("lookup_ids", lambda db, ctx: list(collection.lookup(db, ctx.heavy, list(range(1, 201)), ["id", "name"])),
+          uses=("rowid=?",)),
+    Shape("listing_version", lambda db, ctx: collection.current_version(db, ctx.heavy)),
+    Shape("stats", lambda db, ctx: collection.read_stats(db, ctx.heavy), sort_ok=False),
+    Shape("folder_children", lambda db, ctx: folders.children(db, ctx.heavy, None), uses=("ix_folders_owner_parent",)),
+    Shape("folder_usage", lambda db, ctx: folders.usage(db, ctx.heavy, "/photos/"),
+          uses=("ix_files_owner_folder",)),
+    Shape("upload_duplicates", _upload_duplicates, uses=("ix_files_owner_hash",)),
+    Shape("name_taken", _name_taken, uses=("ix_files_disk_path", "ix_files_owner_folder")),
+    Shape("login", _login, uses=("ix_users_username_lower",)),
+    Shape("events_replay", lambda db, ctx: events.replay(db, ctx.heavy, ctx.since), uses=("ix_file_events_owner_id",)),
+    Shape("events_latest", lambda db, ctx: events.latest_id(db, ctx.heavy), uses=("ix_file_events_owner_id",)),
+    Shape("reaper_batch", _tombstones, uses=("ix_files_tombstones",)),
+    Shape("rebalance_page", _rebalance_page, uses=("ix_files_disk_path",), sort_ok=False),
+]
+
+
+def _context(db: Session) -> SimpleNamespace:
+    sample = db.get(FileEntry, 1)
+    typical = db.execute(select(FileEntry.owner_id).where(FileEntry.owner_id != 1).limit(1)).scalar()
+    since = db.execute(select(func.max(FileEvent.id))).scalar() - 500
+    return SimpleNamespace(heavy=1, typical=typical, since=since, content_hash=sample.content_hash, size=sample.size,
+                           disk_path=sample.disk_path + ".copy")
+
+
+def check_plan(shape: Shape, lines: List[str]) -> List[str]:
+    problems = [f"full scan: {line}" for line in sqlstats.full_scans("sqlite", lines)
+                if not any(line.startswith(f"SCAN {table}") for table in shape.scan_ok)]
+    problems += [f"plan does not use {name}" for name in shape.uses if not any(name in line for line in lines)]
+    if not shape.sort_ok:
+        problems += [f"sorts in a temporary b-tree: {line}" for line in lines if TEMP_SORT in line]
+    return problems
+
+
+def measure(engine: Engine, repeat: int = 5) -> List[Dict[str, Any]]:
+    """Time every shape and check the plans of the statements it ran."""
+    captured: List[Tuple[str, Any]] = []
+
+    def capture(conn, cursor, statement, parameters, context, executemany):
+        captured.append((statement, parameters))
+
+    factory = sessionmaker(bind=engine, future=True)
+    with factory() as db:
+        ctx = _context(db)
+    results = []
+    for shape in SHAPES:
+        captured.clear()
+        event.listen(engine, "before_cursor_execute", capture)
+        try:
+            with factory() as db:
+                shape.run(db, ctx)  # also warms the page cache
+        finally:
+            event.remove(engine, "before_cursor_execute", capture)
+        lines = []
+        with engine.connect() as conn:
+            for statement, parameters in captured:
+                lines += sqlstats.explain(conn.connection.dbapi_connection, "sqlite", statement, parameters) or []
+
+        timings, rows = [], None
+        for _ in range(repeat):
+            with factory() as db:
+                started = time.perf_counter()
+                out = shape.run(db, ctx)
+                timings.append((time.perf_counter() - started) * 1000)
+            rows = len(out) if isinstance(out, (list, tuple)) else None
+        problems = check_plan(shape, lines)
+        results.append({"shape": shape.name, "ms_median": round(statistics.median(timings), 3),
+                        "ms_min": round(min(timings), 3), "rows": rows, "statements": len(captured),
+                        "plan": lines, "ok": not problems, "problems": problems})
+    return results
+
+
+def run(sizes: List[int], directory: Path, repeat: int = 5) -> Dict[str, Any]:
+    directory.mkdir(parents=True, exist_ok=True)
+    report: Dict[str, Any] = {"sqlite": sqlite3.sqlite_version, "at": datetime.utcnow().isoformat(), "sizes": []}
+    for rows in sizes:
+        engine, meta = open_database(directory / f"files-{rows}.db", rows)
+        try:
+            shapes = measure(engine, repeat)
+        finally:
+            engine.dispose()
+        report["sizes"].append({"rows": rows, **meta, "shapes": shapes})
+    report["failures"] = [f"{size['rows']}/{s['shape']}: {p}" for size in report["sizes"]
+                          for s in size["shapes"] for p in s["problems"]]
+    return report
+
+
+def main(argv=None) -> None:
+    parser = argparse.ArgumentParser(description="Benchmark the API's queries on synthetic databases")
+    parser.add_argument("--rows", default="10000,100000,1000000", help="comma separated database sizes")
+    parser.add_argument("--dir", default="dbbench", help="where the generated databases are kept")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--out", help="write the JSON report here instead of stdout")
+    args = parser.parse_args(argv)
+
+    report = run([int(n) for n in args.rows.split(",")], Path(args.dir), args.repeat)
+    data = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.out:
+        Path(args.out).write_text(data, encoding="utf-8")
+    else:
+        print(data)
+    for failure in report["failures"]:
+        print(f"FAIL {failure}", file=sys.stderr)
+    sys.exit(1 if report["failures"] else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,168 @@
+"""Push delivery of ``file_events`` to waiting clients.
+
+Each worker process runs one ``EventBroker`` thread. While anybody in the
+process is subscribed it polls ``file_events`` for rows past the last id it
+has seen (one indexed query per process per ``poll_interval``, however many
+clients are connected) and hands them to the subscribers of the matching
+owner. Because every process reads the same table, an upload committed by
+one worker reaches clients held by any other worker.
+"""
+import queue
+import threading
+import time
+from collections import defaultdict
+from datetime import datetime, timedelta
+from typing import Callable, Dict, List, Optional, Set
+
+from sqlalchemy import delete, func, insert, select, text
+from sqlalchemy.orm import Session
+
+from .models import FileEvent
+
+POLL_BATCH = 1000
+MAX_WAITERS = 16  # default EVENTS_MAX_WAITERS: open feeds per process
+
+
+class Subscription:
+    def __init__(self, owner_id: int, last_id: int) -> None:
+        self.owner_id = owner_id
+        self.last_id = last_id
+        self._queue: "queue.Queue[dict]" = queue.Queue()
+
+    def put(self, event: dict) -> None:
+        self._queue.put(event)
+
+    def get(self, timeout: float) -> List[dict]:
+        """Wait up to ``timeout`` for events newer than the last one returned."""
+        events = []
+        try:
+            events.append(self._queue.get(timeout=timeout))
+            while True:
+                events.append(self._queue.get_nowait())
+        except queue.Empty:
+            pass
+        fresh = [e for e in events if e["id"] > self.last_id]
+        if fresh:
+            self.last_id = fresh[-1]["id"]
+        return fresh
+
+
+class EventBroker:
+    def __init__(self, session_factory: Callable[[], Session], poll_interval: float = 0.5) -> None:
+        self.session_factory = session_factory
+        self.poll_interval = poll_interval
+        self._subs: Dict[int, Set[Subscription]] = defaultdict(set)
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._last_id: Optional[int] = None
+
+    def subscribe(self, owner_id: int, since: int) -> Subscription:
+        sub = Subscription(owner_id, since)
+        with self._lock:
+            if not self._subs:
+                # Everything up to here is covered by the subscriber's own replay; without
+                # this, the first poll after an idle spell would page through the whole gap
+                self._last_id = self._max_id()
+            self._subs[owner_id].add(sub)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="event-broker", daemon=True)
+                self._thread.start()
+        self._wake.set()
+        return sub
+
+    def unsubscribe(self, sub: Subscription) -> None:
+        with self._lock:
+            subs = self._subs.get(sub.owner_id)
+            if subs is not None:
+                subs.discard(sub)
+                if not subs:
+                    del self._subs[sub.owner_id]
+
+    def _max_id(self) -> int:
+        db = self.session_factory()
+        try:
+            return db.execute(select(func.max(FileEvent.id))).scalar() or 0
+        finally:
+            db.close()
+
+    def _run(self) -> None:
+        while True:
+            with self._lock:
+                idle = not self._subs
+            if idle:
+                # Nobody listening in this process: no queries until someone subscribes
+                self._wake.wait()
+                self._wake.clear()
+                continue
+            try:
+                self._poll()
+            except Exception:
+                pass  # a locked or briefly unavailable database just delays delivery
+            time.sleep(self.poll_interval)
+
+    def _poll(self) -> None:
+        db = self.session_factory()
+        try:
+            rows = db.execute(
+                select(FileEvent).where(FileEvent.id > self._last_id).order_by(FileEvent.id).limit(POLL_BATCH)
+            ).scalars().all()
+            events = [r.to_dict() | {"owner_id": r.owner_id} for r in rows]
+        finally:
+            db.close()
+        if not events:
+            return
+        with self._lock:
+            self._last_id = max(self._last_id, events[-1]["id"])  # a subscribe may have moved it on
+            for event in events:
+                for sub in self._subs.get(event.pop("owner_id"), ()):
+                    sub.put(event)
+
+
+def replay(db: Session, owner_id: int, since: int, limit: int = POLL_BATCH) -> Optional[List[dict]]:
+    """Events after ``since`` for one owner, or ``None`` if the client has to start over.
+
+    That is when the events were already pruned, or when ``since`` is past
+    every id here: the cursor came from another database (the user was moved
+    to another shard, or the server restored from a backup).
+    """
+    if since:
+        oldest, newest = db.execute(select(func.min(FileEvent.id), func.max(FileEvent.id))).one()
+        if oldest is None or since < oldest - 1 or since > newest:
+            return None
+    rows = db.execute(
+        select(FileEvent)
+        .where(FileEvent.owner_id == owner_id, FileEvent.id > since)
+        .order_by(FileEvent.id)
+        .limit(limit)
+    ).scalars().all()
+    return [r.to_dict() for r in rows]
+
+
+def advance_ids(db: Session, owner_id: int, floor: int) -> None:
+    """Make every event id written from now on larger than ``floor``.
+
+    Used when ``owner_id`` moves in from another database, where their clients
+    hold cursors up to ``floor``: an event numbered below a cursor would never
+    be delivered. SQLite's AUTOINCREMENT counter follows an explicit id, so a
+    placeholder row is inserted at ``floor`` and removed again.
+    """
+    newest = db.execute(select(func.max(FileEvent.id))).scalar() or 0
+    if newest >= floor:
+        return
+    if db.get_bind().dialect.name == "postgresql":
+        db.execute(text("SELECT setval(pg_get_serial_sequence('file_events', 'id'), :floor)"), {"floor": floor})
+        return
+    db.execute(insert(FileEvent).values(id=floor, owner_id=owner_id, kind="bulk", file_id=0, name="",
+                                        version=0, created_at=datetime.utcnow()))
+    db.execute(delete(FileEvent).where(FileEvent.id == floor))
+
+
+def latest_id(db: Session, owner_id: int) -> int:
+    return db.execute(select(func.max(FileEvent.id)).where(FileEvent.owner_id == owner_id)).scalar() or 0
+
+
+def prune_events(db: Session, retention: timedelta) -> int:
+    result = db.execute(delete(FileEvent).where(FileEvent.created_at < datetime.utcnow() - retention))
+    db.commit()
+    return result.rowcount
@@ -0,0 +1,629 @@
+"""Plain-text extraction for document previews (.docx, .pdf).
+
+The text of a file version is extracted once and cached under
+``<cache_root>/text/<file_id>-<version>/``::
+
+    text.txt     the extracted text, UTF-8
+    lines.idx    byte offset of every line start (array of uint64), for paging
+    meta.json    format, line count, source pages and a first-page summary
+
+DOCX is read by streaming ``word/document.xml`` out of the zip with
+``iterparse``. PDF text comes from the page content streams: text-showing
+operators are decoded through each font's ``ToUnicode`` map. Scanned PDFs
+(images only) simply produce no text.
+"""
+import json
+import os
+import re
+import shutil
+import tempfile
+import zipfile
+import zlib
+from array import array
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, BinaryIO, Dict, Iterator, List, Optional, Tuple, Union
+from xml.etree import ElementTree
+
+from .tiles import building
+
+DOCUMENT_EXTENSIONS = {".docx", ".pdf"}
+SUMMARY_CHARS = 1500
+MAX_CHARS = 10_000_000  # stop extracting past this; previews never need more
+MAX_STREAM_BYTES = 64 * 1024 * 1024  # a PDF stream that inflates past this is a bomb
+MAX_XML_BYTES = 128 * 1024 * 1024  # of a DOCX's word/document.xml; the text after it is dropped
+MAX_NESTING = 100  # arrays/dictionaries nested deeper than this are not a real document
+
+
+class ExtractionError(Exception):
+    pass
+
+
+def text_dir(cache_root: str, file_id: int, version: str) -> Path:
+    return Path(cache_root) / "text" / f"{file_id}-{version}"
+
+
+# --- DOCX -------------------------------------------------------------------
+
+W = "{http://schemas.openxmlformats.org/wordprocessingml/2006/main}"
+
+
+class Truncated(str):
+    """The last page of a text cut short by ``MAX_CHARS`` or ``MAX_XML_BYTES``."""
+
+
+class _Capped:
+    """Reads at most ``limit`` bytes of ``inner``; ``exhausted`` once it withheld the rest."""
+
+    def __init__(self, inner: BinaryIO, limit: int) -> None:
+        self.inner = inner
+        self.left = limit
+        self.exhausted = False
+
+    def read(self, n: int = -1) -> bytes:
+        if self.left <= 0:
+            self.exhausted = True
+            return b""
+        chunk = self.inner.read(self.left if n < 0 else min(n, self.left))
+        self.left -= len(chunk)
+        return chunk
+
+
+def docx_pages(path: Union[str, BinaryIO]) -> Iterator[str]:
+    """Yield the document text split at explicit or last-rendered page breaks.
+
+    Stops with a ``Truncated`` page once ``MAX_CHARS`` of text were collected
+    or ``MAX_XML_BYTES`` of XML inflated, so memory stays bounded whatever
+    the archive expands to.
+    """
+    try:
+        archive = zipfile.ZipFile(path)
+    except (zipfile.BadZipFile, OSError) as e:
+        raise ExtractionError(f"not a docx file: {e}")
+    with archive:
+        try:
+            xml = archive.open("word/document.xml")
+        except KeyError:
+            raise ExtractionError("docx without word/document.xml")
+        except (zipfile.BadZipFile, NotImplementedError, OSError) as e:
+            raise ExtractionError(f"cannot read word/document.xml: {e}")
+        with xml:
+            source = _Capped(xml, MAX_XML_BYTES)
+            page: List[str] = []
+            paragraph: List[str] = []
+            chars = 0  # collected so far, including pages already yielded
+
+            def rest() -> str:
+                return "\n".join(page + ["".join(paragraph)] if paragraph else page)
+
+            try:
+                for event, el in ElementTree.iterparse(source, events=("start", "end")):
+                    tag = el.tag
+                    if event == "start":
+                        if tag == W + "lastRenderedPageBreak" or (
+                            tag == W + "br" and el.get(W + "type") == "page"
+                        ):
+                            page.append("".join(paragraph))
+                            paragraph = []
+                            yield "\n".join(page)
+                            page = []
+                        continue
+                    if tag == W + "t" and el.text:
+                        paragraph.append(el.text)
+                        chars += len(el.text)
+                    elif tag == W + "tab":
+                        paragraph.append("\t")
+                        chars += 1
+                    elif tag == W + "br" and el.get(W + "type") != "page":
+                        paragraph.append("\n")
+                        chars += 1
+                    elif tag == W + "p":
+                        page.append("".join(paragraph))
+                        paragraph = []
+                        chars += 1
+                        el.clear()  # keep memory flat on long documents
+                    if chars > MAX_CHARS:
+                        yield Truncated(rest())
+                        return
+            except ElementTree.ParseError as e:
+                if not source.exhausted:
+                    raise ExtractionError(f"malformed word/document.xml: {e}")
+                yield Truncated(rest())  # the XML was cut off at MAX_XML_BYTES
+                return
+            except (zipfile.BadZipFile, zlib.error, EOFError, OSError) as e:
+                raise ExtractionError(f"cannot read word/document.xml: {e}")
+            if paragraph:
+                page.append("".join(paragraph))
+            if page:
+                yield "\n".join(page)
+
+
+# --- PDF --------------------------------------------------------------------
+
+class Ref:
+    __slots__ = ("num",)
+
+    def __init__(self, num: int) -> None:
+        self.num = num
+
+
+class Name(str):
+    pass
+
+
+class Op(bytes):
+    """A content-stream operator such as ``Tj`` (plain ``bytes`` are strings)."""
+
+
+_DELIMS = b"()<>[]{}/%"
+_WS = b" \t\r\n\x00\x0c"
+_NUMBER = re.compile(rb"[+-]?(?:\d+\.?\d*|\.\d+)")
+_REF = re.compile(rb"(\d+)\s+(\d+)\s+R(?![^\s()<>\[\]{}/%])")
+_OBJ = re.compile(rb"(\d+)\s+(\d+)\s+obj\b")
+_ESCAPES = {ord("n"): b"\n", ord("r"): b"\r", ord("t"): b"\t", ord("b"): b"\b", ord("f"): b"\f",
+            ord("("): b"(", ord(")"): b")", ord("\\"): b"\\"}
+
+
+class Lexer:
+    """Just enough of the PDF object syntax for dictionaries and content streams."""
+
+    def __init__(self, data: bytes, pos: int = 0) -> None:
+        self.data = data
+        self.pos = pos
+        self.depth = 0
+
+    def skip_ws(self) -> None:
+        data, n = self.data, len(self.data)
+        while self.pos < n:
+            c = data[self.pos]
+            if c in _WS:
+                self.pos += 1
+            elif c == 0x25:  # % comment
+                end = data.find(b"\n", self.pos)
+                self.pos = n if end < 0 else end + 1
+            else:
+                break
+
+    def token(self) -> Any:
+        """The next object or operator; ``None`` at the end."""
+        self.skip_ws()
+        data = self.data
+        while self.pos < len(data) and data[self.pos] in b"]>)":  # stray closers
+            self.pos += 1
+            self.skip_ws()
+        if self.pos >= len(data):
+            return None
+        c = data[self.pos]
+        if c == 0x2F:  # /Name
+            end = self.pos + 1
+            while end < len(data) and data[end] not in _WS and data[end] not in _DELIMS:
+                end += 1
+            name = re.sub(rb"#([0-9A-Fa-f]{2})", lambda m: bytes([int(m.group(1), 16)]), data[self.pos + 1:end])
+            self.pos = end
+            return Name(name.decode("latin-1"))
+        if c == 0x28:  # (literal string)
+            return self._literal()
+        if c == 0x3C:
+            if data[self.pos + 1:self.pos + 2] == b"<":
+                self.pos += 2
+                with self._nested():
+                    return self._dict()
+            end = data.find(b">", self.pos)
+            hexdigits = re.sub(rb"[^0-9A-Fa-f]", b"", data[self.pos + 1:end])
+            if len(hexdigits) % 2:
+                hexdigits += b"0"
+            self.pos = end + 1
+            return bytes.fromhex(hexdigits.decode())
+        if c == 0x5B:  # [
+            self.pos += 1
+            items = []
+            with self._nested():
+                while True:
+                    self.skip_ws()
+                    if self.pos >= len(data) or data[self.pos] == 0x5D:
+                        self.pos += 1
+                        return items
+                    items.append(self.token())
+        m = _NUMBER.match(data, self.pos)
+        if m:
+            ref = _REF.match(data, self.pos)
+            if ref:
+                self.pos = ref.end()
+                return Ref(int(ref.group(1)))
+            self.pos = m.end()
+            text = m.group()
+            return float(text) if b"." in text else int(text)
+        end = self.pos
+        while end < len(data) and data[end] not in _WS and data[end] not in _DELIMS:
+            end += 1
+        if end == self.pos:
+            end += 1
+        word = data[self.pos:end]
+        self.pos = end
+        if word == b"true":
+            return True
+        if word == b"false":
+            return False
+        if word == b"null":
+            return None
+        return Op(word)
+
+    @contextmanager
+    def _nested(self) -> Iterator[None]:
+        self.depth += 1
+        if self.depth > MAX_NESTING:
+            raise ExtractionError("pdf objects nested too deeply")
+        try:
+            yield
+        finally:
+            self.depth -= 1
+
+    def _literal(self) -> bytes:
+        data = self.data
+        out = bytearray()
+        depth = 1
+        i = self.pos + 1
+        while i < len(data):
+            c = data[i]
+            if c == 0x5C:  # backslash
+                i += 1
+                e = data[i] if i < len(data) else 0
+                if e in _ESCAPES:
+                    out += _ESCAPES[e]
+                elif 0x30 <= e <= 0x37:
+                    digits = data[i:i + 3]
+                    m = re.match(rb"[0-7]{1,3}", digits)
+                    out.append(int(m.group(), 8) & 0xFF)
+                    i += len(m.group()) - 1
+                elif e in (0x0D, 0x0A):
+                    if e == 0x0D and data[i + 1:i + 2] == b"\n":
+                        i += 1
+                else:
+                    out.append(e)
+            elif c == 0x28:
+                depth += 1
+                out.append(c)
+            elif c == 0x29:
+                depth -= 1
+                if depth == 0:
+                    break
+                out.append(c)
+            else:
+                out.append(c)
+            i += 1
+        self.pos = i + 1
+        return bytes(out)
+
+    def _dict(self) -> Dict[str, Any]:
+        result: Dict[str, Any] = {}
+        while True:
+            self.skip_ws()
+            if self.data[self.pos:self.pos + 2] == b">>" or self.pos >= len(self.data):
+                self.pos += 2
+                return result
+            key = self.token()
+            result[str(key)] = self.token()
+
+
+class PdfDocument:
+    def __init__(self, data: bytes) -> None:
+        self.data = data
+        self.objects: Dict[int, Tuple[Any, Optional[bytes]]] = {}
+        self._index()
+
+    def _index(self) -> None:
+        for m in _OBJ.finditer(self.data):
+            lexer = Lexer(self.data, m.end())
+            try:
+                value = lexer.token()
+            except (IndexError, ValueError, AttributeError):
+                continue
+            stream = None
+            lexer.skip_ws()
+            if self.data.startswith(b"stream", lexer.pos) and isinstance(value, dict):
+                start = lexer.pos + 6
+                if self.data[start:start + 2] == b"\r\n":
+                    start += 2
+                elif self.data[start:start + 1] in (b"\n", b"\r"):
+                    start += 1
+                length = value.get("Length")
+                if isinstance(length, int) and self.data[start + length:start + length + 20].lstrip().startswith(b"endstream"):
+                    stream = self.data[start:start + length]
+                else:
+                    end = self.data.find(b"endstream", start)
+                    stream = self.data[start:end].rstrip(b"\r\n")
+            # later definitions (incremental updates) win
+            self.objects[int(m.group(1))] = (value, stream)
+        for num, (value, stream) in list(self.objects.items()):
+            if isinstance(value, dict) and value.get("Type") == "ObjStm" and stream is not None:
+                self._unpack_object_stream(value, stream)
+
+    def _unpack_object_stream(self, header: Dict[str, Any], stream: bytes) -> None:
+        data = self.decode(header, stream)
+        if data is None:
+            return
+        first = self.resolve(header.get("First"))
+        lexer = Lexer(data)
+        pairs = [(lexer.token(), lexer.token()) for _ in range(int(self.resolve(header.get("N")) or 0))]
+        for num, offset in pairs:
+            if isinstance(num, int) and isinstance(offset, int) and num not in self.objects:
+                self.objects[num] = (Lexer(data, first + offset).token(), None)
+
+    def resolve(self, value: Any) -> Any:
+        seen = 0
+        while isinstance(value, Ref) and seen < 32:
+            value = self.objects.get(value.num, (None, None))[0]
+            seen += 1
+        return value
+
+    def stream_of(self, value: Any) -> Optional[bytes]:
+        if not isinstance(value, Ref):
+            return None
+        header, stream = self.objects.get(value.num, (None, None))
+        if stream is None:
+            return None
+        return self.decode(header, stream)
+
+    def decode(self, header: Dict[str, Any], stream: bytes) -> Optional[bytes]:
+        filters = self.resolve(header.get("Filter"))
+        if filters is None:
+            return stream
+        if not isinstance(filters, list):
+            filters = [filters]
+        for f in filters:
+            if f == "FlateDecode":
+                inflater = zlib.decompressobj()
+                try:
+                    stream = inflater.decompress(stream, MAX_STREAM_BYTES)
+                except zlib.error:
+                    return None
+                if inflater.unconsumed_tail:
+                    raise ExtractionError(f"pdf stream inflates past {MAX_STREAM_BYTES} bytes")
+            else:
+                return None  # image or unusual filters carry no text we can use
+        return stream
+
+    def pages(self) -> List[Dict[str, Any]]:
+        catalog = None
+        for value, _ in self.objects.values():
+            if isinstance(value, dict) and value.get("Type") == "Catalog":
+                catalog = value
+        result: List[Dict[str, Any]] = []
+        if catalog is not None:
+            self._walk(self.resolve(catalog.get("Pages")), {}, result, 0)
+        if not result:
+            result = [v for v, _ in self.objects.values() if isinstance(v, dict) and v.get("Type") == "Page"]
+        return result
+
+    def _walk(self, node: Any, inherited: Dict[str, Any], out: List[Dict[str, Any]], depth: int) -> None:
+        if not isinstance(node, dict) or depth > 64:
+            return
+        attrs = dict(inherited)
+        if "Resources" in node:
+            attrs["Resources"] = node["Resources"]
+        if node.get("Type") == "Page" or "Kids" not in node:
+            out.append({**attrs, **node})
+            return
+        for kid in self.resolve(node.get("Kids")) or []:
+            self._walk(self.resolve(kid), attrs, out, depth + 1)
+
+
+class Font:
+    def __init__(self, doc: PdfDocument, font: Dict[str, Any]) -> None:
+        self.code_bytes = 2 if font.get("Subtype") == "Type0" else 1
+        self.map: Dict[int, str] = {}
+        cmap = doc.stream_of(font.get("ToUnicode"))
+        if cmap:
+            self._parse_cmap(cmap)
+
+    def _parse_cmap(self, data: bytes) -> None:
+        for block in re.findall(rb"begincodespacerange(.*?)endcodespacerange", data, re.S):
+            codes = re.findall(rb"<([0-9A-Fa-f]+)>", block)
+            if codes:
+                self.code_bytes = max(1, len(codes[0]) // 2)
+        for block in re.findall(rb"beginbfchar(.*?)endbfchar", data, re.S):
+            for src, dst in re.findall(rb"<([0-9A-Fa-f]+)>\s*<([0-9A-Fa-f]*)>", block):
+                self.map[int(src, 16)] = _utf16(dst)
+        for block in re.findall(rb"beginbfrange(.*?)endbfrange", data, re.S):
+            lexer = Lexer(block)
+            while True:
+                lo, hi, dst = lexer.token(), lexer.token(), lexer.token()
+                if not (isinstance(lo, bytes) and isinstance(hi, bytes)):
+                    break
+                start, end = int.from_bytes(lo, "big"), int.from_bytes(hi, "big")
+                if end - start > 65535:
+                    continue
+                if isinstance(dst, list):
+                    for i, item in enumerate(dst[:end - start + 1]):
+                        self.map[start + i] = _utf16(item.hex().encode())
+                elif isinstance(dst, bytes):
+                    base = int.from_bytes(dst, "big")
+                    width = len(dst)
+                    for code in range(start, end + 1):
+                        value = (base + code - start).to_bytes(width, "big")
+                        self.map[code] = value.decode("utf-16-be", errors="ignore")
+
+    def decode(self, raw: bytes) -> str:
+        if not self.map:
+            return raw.decode("cp1252", errors="replace") if self.code_bytes == 1 else ""
+        n = self.code_bytes
+        return "".join(self.map.get(int.from_bytes(raw[i:i + n], "big"), "") for i in range(0, len(raw), n))
+
+
+def _utf16(hexdigits: bytes) -> str:
+    try:
+        return bytes.fromhex(hexdigits.decode()).decode("utf-16-be", errors="ignore")
+    except ValueError:
+        return ""
+
+
+def _page_text(doc: PdfDocument, page: Dict[str, Any], fonts_cache: Dict[int, Font]) -> str:
+    resources = doc.resolve(page.get("Resources")) or {}
+    font_refs = doc.resolve(resources.get("Font")) or {}
+    fonts: Dict[str, Font] = {}
+    for name, ref in font_refs.items():
+        key = ref.num if isinstance(ref, Ref) else id(ref)
+        if key not in fonts_cache:
+            fonts_cache[key] = Font(doc, doc.resolve(ref) or {})
+        fonts[name] = fonts_cache[key]
+
+    contents = page.get("Contents")
+    resolved = doc.resolve(contents)
+    refs = resolved if isinstance(resolved, list) else [contents]
+    data = b"\n".join(s for s in (doc.stream_of(r) for r in refs) if s)
+
+    out: List[str] = []
+
+    def newline() -> None:
+        if out and not out[-1].endswith("\n"):
+            out.append("\n")
+
+    font: Optional[Font] = None
+    operands: List[Any] = []
+    lexer = Lexer(data)
+    while True:
+        tok = lexer.token()
+        if tok is None:
+            break
+        if not isinstance(tok, Op):
+            operands.append(tok)
+            continue
+        if tok == b"BI":  # inline image: skip its binary data
+            end = data.find(b"EI", lexer.pos)
+            lexer.pos = len(data) if end < 0 else end + 2
+        elif tok == b"Tf" and len(operands) >= 2:
+            font = fonts.get(str(operands[-2]))
+        elif tok in (b"Tj", b"'", b'"') and operands and isinstance(operands[-1], bytes) and font:
+            if tok != b"Tj":
+                newline()
+            out.append(font.decode(operands[-1]))
+        elif tok == b"TJ" and operands and isinstance(operands[-1], list) and font:
+            for item in operands[-1]:
+                if isinstance(item, bytes):
+                    out.append(font.decode(item))
+                elif isinstance(item, (int, float)) and item < -200:
+                    out.append(" ")  # wide negative kerning is a word gap
+        elif tok in (b"Td", b"TD") and len(operands) >= 2 and operands[-1] != 0:
+            newline()
+        elif tok in (b"T*", b"ET"):
+            newline()
+        operands = []
+    text = "".join(out)
+    return re.sub(r"\n{3,}", "\n\n", text).strip()
+
+
+def pdf_pages(path: Union[str, BinaryIO]) -> Iterator[str]:
+    """Yield the text of each page.
+
+    Unlike DOCX this is not streamed: the whole file is read into memory
+    (objects are found by scanning it), plus up to ``MAX_STREAM_BYTES`` for
+    each stream being decoded. Malformed input raises ``ExtractionError``.
+    """
+    if isinstance(path, str):
+        with open(path, "rb") as f:
+            data = f.read()
+    else:
+        data = path.read()
+    if not data.startswith(b"%PDF"):
+        raise ExtractionError("not a pdf file")
+    try:
+        doc = PdfDocument(data)
+        fonts_cache: Dict[int, Font] = {}
+        for page in doc.pages():
+            yield _page_text(doc, page, fonts_cache)
+    except (IndexError, ValueError, AttributeError, TypeError, KeyError, RecursionError) as e:
+        raise ExtractionError(f"malformed pdf: {e!r}")
+
+
+# --- cache ------------------------------------------------------------------
+
+def _extract_pages(source: Union[str, BinaryIO], extension: str) -> Iterator[str]:
+    if extension == ".docx":
+        return docx_pages(source)
+    if extension == ".pdf":
+        return pdf_pages(source)
+    raise ExtractionError(f"no extractor for {extension}")
+
+
+def ensure_text(source: Union[str, BinaryIO], extension: str, target: Path) -> Dict[str, Any]:
+    """Return the metadata for ``target``, extracting the text from ``source`` if needed.
+
+    Built in a temporary sibling directory and renamed into place, like
+    ``tiles.ensure_pyramid``.
+    """
+    meta_path = target / "meta.json"
+    if meta_path.exists():
+        return json.loads(meta_path.read_text(encoding="utf-8"))
+
+    with building(target):
+        if meta_path.exists():
+            return json.loads(meta_path.read_text(encoding="utf-8"))
+        target.parent.mkdir(parents=True, exist_ok=True)
+        work = Path(tempfile.mkdtemp(prefix=f".{target.name}.", dir=target.parent))
+        try:
+            meta = _build(source, extension, work)
+            try:
+                os.rename(work, target)
+            except OSError:
+                shutil.rmtree(work, ignore_errors=True)  # another worker finished first
+        except BaseException:
+            shutil.rmtree(work, ignore_errors=True)
+            raise
+    return meta
+
+
+def _build(source: Union[str, BinaryIO], extension: str, work: Path) -> Dict[str, Any]:
+    offsets = array("Q", [0])
+    written = chars = source_pages = 0
+    summary = None
+    truncated = False
+    with open(work / "text.txt", "wb") as out:
+        for page in _extract_pages(source, extension):
+            source_pages += 1
+            truncated = isinstance(page, Truncated)
+            if summary is None and page.strip():
+                summary = page.strip()[:SUMMARY_CHARS]
+            if source_pages > 1:
+                page = "\n\n" + page
+            if chars + len(page) > MAX_CHARS:
+                page = page[:MAX_CHARS - chars]
+                truncated = True
+            encoded = page.encode("utf-8")
+            pos = 0
+            while True:
+                nl = encoded.find(b"\n", pos)
+                if nl < 0:
+                    break
+                offsets.append(written + nl + 1)
+                pos = nl + 1
+            out.write(encoded)
+            written += len(encoded)
+            chars += len(page)
+            if truncated:
+                break
+    with open(work / "lines.idx", "wb") as f:
+        offsets.tofile(f)
+    meta = {
+        "format": extension.lstrip("."),
+        "lines": len(offsets),
+        "bytes": written,
+        "source_pages": source_pages,
+        "summary": summary or "",
+        "truncated": truncated,
+    }
+    (work / "meta.json").write_text(json.dumps(meta, ensure_ascii=False), encoding="utf-8")
+    return meta
+
+
+def read_lines(target: Path, first: int, count: int, total: int) -> str:
+    """Lines ``[first, first + count)`` of the cached text, read with one seek."""
+    if first >= total:
+        return ""
+    offsets = array("Q")
+    with open(target / "lines.idx", "rb") as f:
+        f.seek(first * offsets.itemsize)
+        offsets.fromfile(f, min(count + 1, total - first))
+    with open(target / "text.txt", "rb") as f:
+        f.seek(offsets[0])
+        data = f.read(offsets[-1] - offsets[0]) if len(offsets) > count else f.read()
+    return data.decode("utf-8", errors="replace").removesuffix("\n")
@@ -0,0 +1,168 @@
+"""Folder trees stored as materialized paths.
+
+Every folder row carries its full path ("/a/b/") and every file its
+``folder_path``. Because paths end with "/", the whole subtree under
+``/a/`` is the half-open range ``["/a/", "/a0")`` (``"0"`` is the character
+after ``"/"``), so listing, counting, moving and deleting a subtree are each
+one range scan on ``uq_folders_owner_path`` / ``ix_files_owner_folder``,
+however deep or wide the tree is.
+
+Blobs of files inside a folder live in ``<user dir>/_f<folder id>/``: the id
+never changes, so moving a subtree touches no files on disk. Sanitised names
+never start with "_", so these directories cannot clash with uploads.
+"""
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+from sqlalchemy import String, delete, func, literal, select, update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+
+from . import collection
+from .models import FileEntry, Folder
+
+ROOT = "/"
+
+
+class FolderError(ValueError):
+    """A folder operation that cannot be carried out; the message is safe to show."""
+
+
+class FolderConflict(FolderError):
+    """The destination already exists."""
+
+
+def normalize(path: Optional[str]) -> str:
+    """``"a//b"`` -> ``"/a/b/"``; every component is sanitised like an uploaded filename."""
+    from .app import secure_filename_unicode
+
+    parts = [p for p in (path or "").replace("\\", "/").split("/") if p not in ("", ".")]
+    if any(p == ".." for p in parts):
+        raise FolderError("'..' is not allowed in folder paths")
+    if not parts:
+        return ROOT
+    return "/" + "/".join(secure_filename_unicode(p) for p in parts) + "/"
+
+
+def parent_of(path: str) -> str:
+    return path[:path.rstrip("/").rfind("/") + 1] if path != ROOT else ROOT
+
+
+def subtree(column, path: str):
+    """SQL condition for ``column`` lying in the subtree rooted at ``path`` (inclusive)."""
+    if path == ROOT:
+        return column >= ROOT
+    return (column >= path) & (column < path[:-1] + "0")
+
+
+def blob_dir(upload_root: str, owner_id: int, folder: Optional[Folder]) -> Path:
+    user_dir = Path(upload_root) / str(owner_id)
+    return user_dir if folder is None else user_dir / f"_f{folder.id}"
+
+
+def get(db: Session, owner_id: int, path: str) -> Optional[Folder]:
+    if path == ROOT:
+        return None
+    return db.execute(select(Folder).where(Folder.owner_id == owner_id, Folder.path == path)).scalar_one_or_none()
+
+
+def ensure(db: Session, owner_id: int, path: str) -> Optional[Folder]:
+    """Return the folder at ``path``, creating it and any missing ancestors (``mkdir -p``)."""
+    if path == ROOT:
+        return None
+    existing = get(db, owner_id, path)
+    if existing is not None:
+        return existing
+    parent = ensure(db, owner_id, parent_of(path))
+    folder = Folder(owner_id=owner_id, parent_id=parent.id if parent else None,
+                    name=path.rstrip("/").rsplit("/", 1)[-1], path=path, created_at=datetime.utcnow())
+    try:
+        with db.begin_nested():
+            db.add(folder)
+    except IntegrityError:
+        return get(db, owner_id, path)  # created concurrently by another request
+    return folder
+
+
+def children(db: Session, owner_id: int, folder: Optional[Folder]) -> List[Folder]:
+    parent = Folder.parent_id.is_(None) if folder is None else Folder.parent_id == folder.id
+    return db.execute(
+        select(Folder).where(Folder.owner_id == owner_id, parent).order_by(Folder.name)
+    ).scalars().all()
+
+
+def usage(db: Session, owner_id: int, path: str) -> Dict[str, Any]:
+    """File count, bytes and folder count of a whole subtree."""
+    files, size = db.execute(
+        select(func.count(), func.coalesce(func.sum(FileEntry.size), 0)).where(
+            FileEntry.owner_id == owner_id,
+            subtree(FileEntry.folder_path, path),
+            FileEntry.deleted_at.is_(None),
+        )
+    ).one()
+    folders = db.execute(
+        select(func.count()).where(Folder.owner_id == owner_id, subtree(Folder.path, path))
+    ).scalar()
+    if path != ROOT:
+        folders -= 1  # the folder itself
+    return {"path": path, "files": files, "bytes": size, "folders": folders}
+
+
+def _rebase(column, old: str, new: str):
+    return literal(new, String) + func.substr(column, len(old) + 1, type_=String)
+
+
+def move_subtree(db: Session, owner_id: int, folder: Folder, new_path: str) -> Tuple[int, int]:
+    """Move/rename the subtree at ``folder`` to ``new_path``; returns ``(folders, files)`` rewritten."""
+    old_path = folder.path
+    if new_path == ROOT:
+        raise FolderError("cannot replace the root folder")
+    if new_path == old_path:
+        raise FolderError("source and destination are the same")
+    if new_path.startswith(old_path):
+        raise FolderError("cannot move a folder into itself")
+    if get(db, owner_id, new_path) is not None:
+        raise FolderConflict("a folder with this path already exists")
+    parent = ensure(db, owner_id, parent_of(new_path))
+
+    moved_folders = db.execute(
+        update(Folder)
+        .where(Folder.owner_id == owner_id, subtree(Folder.path, old_path))
+        .values(path=_rebase(Folder.path, old_path, new_path))
+        .execution_options(synchronize_session=False)
+    ).rowcount
+    moved_files = db.execute(
+        update(FileEntry)
+        .where(FileEntry.owner_id == owner_id, subtree(FileEntry.folder_path, old_path))
+        .values(folder_path=_rebase(FileEntry.folder_path, old_path, new_path))
+        .execution_options(synchronize_session=False)
+    ).rowcount
+    db.execute(
+        update(Folder).where(Folder.id == folder.id)
+        .values(parent_id=parent.id if parent else None, name=new_path.rstrip("/").rsplit("/", 1)[-1])
+        .execution_options(synchronize_session=False)
+    )
+    db.expire_all()
+    collection.record_changed_many(db, owner_id, f"{old_path} -> {new_path}")
+    return moved_folders, moved_files
+
+
+def delete_subtree(db: Session, owner_id: int, folder: Folder) -> Tuple[int, int]:
+    """Remove a subtree: its files are tombstoned for the reaper, its folder rows dropped."""
+    path = folder.path
+    in_subtree = subtree(FileEntry.folder_path, path)
+    removed_files = collection.record_removed_where(db, owner_id, in_subtree)
+    db.execute(
+        update(FileEntry)
+        .where(FileEntry.owner_id == owner_id, in_subtree, FileEntry.deleted_at.is_(None))
+        .values(deleted_at=datetime.utcnow())
+        .execution_options(synchronize_session=False)
+    )
+    # One statement for the whole subtree: parent links are checked at its end, not per row
+    removed_folders = db.execute(
+        delete(Folder).where(Folder.owner_id == owner_id, subtree(Folder.path, path))
+        .execution_options(synchronize_session=False)
+    ).rowcount
+    db.expire_all()
+    return removed_folders, removed_files
@@ -1,9 +1,14 @@
 from datetime import datetime
-from typing import Dict, Any
+from typing import Dict, Any, Optional, Set, Tuple
 
 from passlib.hash import bcrypt, sha256_crypt
 import os
-from sqlalchemy import Column, Integer, String, DateTime, ForeignKey, Text
+from sqlalchemy import (
+    Column, Integer, BigInteger, String, DateTime, ForeignKey, Text, Index, UniqueConstraint,
+    create_engine, event, func, inspect, text,
+)
+from sqlalchemy.engine import Engine
+from sqlalchemy.schema import CreateIndex
 from sqlalchemy.orm import declarative_base, Mapped, mapped_column, relationship
 
 
@@ -16,6 +21,8 @@ class User(Base):
     id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=True)
     username: Mapped[str] = mapped_column(String(150), unique=True, nullable=False, index=True)
     password_hash: Mapped[str] = mapped_column(String(200), nullable=False)
+    # Bumped on every change to the user's files; drives listing ETags
+    files_version: Mapped[int] = mapped_column(Integer, nullable=False, default=0, server_default="0")
 
     def set_password(self, raw: str) -> None:
         # Use SHA256 to avoid bcrypt compatibility issues
@@ -26,6 +33,10 @@ class User(Base):
         return sha256_crypt.verify(raw, self.password_hash)
 
 
+# Login and registration look users up case-insensitively
+Index("ix_users_username_lower", func.lower(User.username))
+
+
 class FileEntry(Base):
     __tablename__ = "files"
 
@@ -37,20 +48,48 @@ class FileEntry(Base):
     name: Mapped[str] = mapped_column(String(255), nullable=False)
     extension: Mapped[str] = mapped_column(String(10), nullable=False)
     disk_path: Mapped[str] = mapped_column(Text, nullable=False)
+    size: Mapped[int] = mapped_column(BigInteger, nullable=False, default=0, server_default="0")
+    content_hash: Mapped[Optional[str]] = mapped_column(String(64), nullable=True)  # SHA-256 hex
+    # Materialized path of the containing folder ("/" or "/a/b/"); see server.folders
+    folder_path: Mapped[str] = mapped_column(String(1024), nullable=False, default="/", server_default="/")
 
     created_at: Mapped[datetime] = mapped_column(DateTime, nullable=False)
     updated_at: Mapped[datetime] = mapped_column(DateTime, nullable=False)
+    # Set by DELETE; the blob and the row are removed later by server.reaper
+    deleted_at: Mapped[Optional[datetime]] = mapped_column(DateTime, nullable=True)
 
     owner = relationship("User", foreign_keys=[owner_id])
     uploader = relationship("User", foreign_keys=[uploader_id])
     editor = relationship("User", foreign_keys=[editor_id])
 
+    __table_args__ = (
+        # type filter and folder listing, already in listing order (no sort step)
+        Index("ix_files_owner_ext_updated", "owner_id", "extension", "updated_at"),
+        Index("ix_files_owner_folder_updated", "owner_id", "folder_path", "updated_at"),
+        Index("ix_files_owner_updated", "owner_id", "updated_at"),
+        Index("ix_files_disk_path", "disk_path"),
+        Index("ix_files_owner_hash", "owner_id", "content_hash"),
+        Index("ix_files_owner_folder", "owner_id", "folder_path", "name"),
+        # Partial: an index on all of deleted_at tempts the planner into "deleted_at IS NULL"
+        # lookups that match nearly every row
+        Index("ix_files_tombstones", "id", sqlite_where=text("deleted_at IS NOT NULL"),
+              postgresql_where=text("deleted_at IS NOT NULL")),
+    )
+
+    def version_tag(self) -> str:
+        """Changes whenever the stored content does; used to key derived caches (tiles, previews)."""
+        stamp = self.updated_at.strftime("%Y%m%d%H%M%S%f") if self.updated_at else "0"
+        return f"{stamp}-{self.size}"
+
     def to_dict(self) -> Dict[str, Any]:
         return {
             "id": self.id,
             "name": self.name,
             "extension": self.extension,
             "disk_path": self.disk_path,
+            "size": self.size,
+            "sha256": self.content_hash,
+            "folder": self.folder_path,
             "created_at": self.created_at.isoformat() if self.created_at else None,
             "updated_at": self.updated_at.isoformat() if self.updated_at else None,
             "uploader": self.uploader.username if self.uploader else None,
@@ -58,3 +97,150 @@ class FileEntry(Base):
         }
 
 
+class Folder(Base):
+    """A directory in an owner's tree.
+
+    ``path`` is the full materialized path with a trailing slash ("/a/b/"),
+    so a subtree is one range on ``uq_folders_owner_path``. The root "/" has
+    no row.
+    """
+    __tablename__ = "folders"
+
+    id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=True)
+    owner_id: Mapped[int] = mapped_column(ForeignKey("users.id"), nullable=False)
+    parent_id: Mapped[Optional[int]] = mapped_column(ForeignKey("folders.id"), nullable=True)
+    name: Mapped[str] = mapped_column(String(255), nullable=False)
+    path: Mapped[str] = mapped_column(String(1024), nullable=False)
+    created_at: Mapped[datetime] = mapped_column(DateTime, nullable=False)
+
+    __table_args__ = (
+        UniqueConstraint("owner_id", "path", name="uq_folders_owner_path"),
+        Index("ix_folders_owner_parent", "owner_id", "parent_id"),
+    )
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "id": self.id,
+            "name": self.name,
+            "path": self.path,
+            "parent_id": self.parent_id,
+            "created_at": self.created_at.isoformat() if self.created_at else None,
+        }
+
+
+class FileStat(Base):
+    """Aggregate row per (owner, dimension, key), maintained by ``server.collection``."""
+    __tablename__ = "file_stats"
+
+    id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=True)
+    owner_id: Mapped[int] = mapped_column(ForeignKey("users.id"), nullable=False)
+    dimension: Mapped[str] = mapped_column(String(16), nullable=False)  # "extension" | "uploader"
+    key: Mapped[str] = mapped_column(String(255), nullable=False)
+    file_count: Mapped[int] = mapped_column(Integer, nullable=False, default=0)
+    total_bytes: Mapped[int] = mapped_column(BigInteger, nullable=False, default=0)
+
+    __table_args__ = (UniqueConstraint("owner_id", "dimension", "key", name="uq_file_stats_bucket"),)
+
+
+class FileEvent(Base):
+    """Change feed per owner; written with the change, read by ``server.events``."""
+    __tablename__ = "file_events"
+
+    id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=True)
+    owner_id: Mapped[int] = mapped_column(ForeignKey("users.id"), nullable=False)
+    kind: Mapped[str] = mapped_column(String(16), nullable=False)  # "created" | "updated" | "deleted" | "bulk"
+    file_id: Mapped[int] = mapped_column(Integer, nullable=False)
+    name: Mapped[str] = mapped_column(String(255), nullable=False)
+    folder: Mapped[str] = mapped_column(String(1024), nullable=False, default="/", server_default="/")
+    version: Mapped[int] = mapped_column(Integer, nullable=False)
+    created_at: Mapped[datetime] = mapped_column(DateTime, nullable=False)
+
+    # AUTOINCREMENT: ids must never be reused after pruning, clients resume from them
+    __table_args__ = (Index("ix_file_events_owner_id", "owner_id", "id"), {"sqlite_autoincrement": True})
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "id": self.id,
+            "kind": self.kind,
+            "file_id": self.file_id,
+            "name": self.name,
+            "folder": self.folder,
+            "version": self.version,
+            "at": self.created_at.isoformat(),
+        }
+
+
+def create_db_engine(url: str) -> Engine:
+    """Create the SQLAlchemy engine used by the API and the maintenance commands."""
+    engine = create_engine(url, future=True, pool_pre_ping=True)
+    if engine.dialect.name == "sqlite":
+        @event.listens_for(engine, "connect")
+        def _sqlite_pragmas(dbapi_conn, _record):
+            # WAL lets several worker processes read while one of them writes
+            cur = dbapi_conn.cursor()
+            cur.execute("PRAGMA journal_mode=WAL")
+            cur.execute("PRAGMA busy_timeout=30000")
+            cur.close()
+    return engine
+
+
+# Replaced by the indexes above; dropped from older databases
+SUPERSEDED_INDEXES = ("ix_files_deleted_at", "ix_files_owner_extension")
+
+
+def init_db(engine: Engine) -> None:
+    """Create missing tables, columns and indexes. Run once per deployment, not once per worker."""
+    existing = set(inspect(engine).get_table_names())
+    Base.metadata.create_all(engine)
+    added = _add_missing_columns(engine)
+    with engine.begin() as conn:
+        for name in SUPERSEDED_INDEXES:
+            conn.execute(text(f"DROP INDEX IF EXISTS {name}"))
+        for table in Base.metadata.sorted_tables:
+            for index in table.indexes:
+                # IF NOT EXISTS rather than checkfirst: expression indexes are not reflected
+                conn.execute(CreateIndex(index, if_not_exists=True))
+
+    if ("files", "size") in added:
+        _backfill_sizes(engine)
+    if ("file_stats" not in existing and "files" in existing) or ("files", "size") in added:
+        # Upgrading an older database: seed the aggregates from the rows already there
+        from .collection import rebuild_stats
+        with engine.begin() as conn:
+            rebuild_stats(conn)
+
+    from .search import create_index
+    create_index(engine)
+
+
+def _add_missing_columns(engine: Engine) -> Set[Tuple[str, str]]:
+    """Additive migration for databases created before a column existed; returns the ``(table, column)`` added."""
+    insp = inspect(engine)
+    added = set()
+    with engine.begin() as conn:
+        for table in Base.metadata.sorted_tables:
+            present = {c["name"] for c in insp.get_columns(table.name)}
+            for column in table.columns:
+                if column.name in present:
+                    continue
+                ddl = f"ALTER TABLE {table.name} ADD COLUMN {column.name} {column.type.compile(engine.dialect)}"
+                if column.server_default is not None:
+                    default = "'" + str(column.server_default.arg).replace("'", "''") + "'"
+                    ddl += f" NOT NULL DEFAULT {default}" if not column.nullable else f" DEFAULT {default}"
+                conn.execute(text(ddl))
+                added.add((table.name, column.name))
+    return added
+
+
+def _backfill_sizes(engine: Engine) -> None:
+    """Fill the new ``files.size`` of existing rows from their blobs; rows whose blob is missing keep 0."""
+    with engine.begin() as conn:
+        sizes = []
+        for file_id, disk_path in conn.execute(text("SELECT id, disk_path FROM files")):
+            try:
+                sizes.append({"id": file_id, "size": os.stat(disk_path).st_size})
+            except OSError:
+                continue
+        if sizes:
+            conn.execute(text("UPDATE files SET size = :size WHERE id = :id"), sizes)
+
@@ -0,0 +1,245 @@
+"""Append-only pack files for small blobs.
+
+With ``STORAGE_PACK_MAX_KB`` set, a blob up to that size does not get a file
+of its own: it is appended to ``<UPLOAD_ROOT>/.packs/pack-NNNNNN.dat`` and
+``index.db`` (SQLite) maps its path relative to ``UPLOAD_ROOT`` to
+``(pack, offset, size)``. Millions of small scripts become a handful of
+large files, so backups, reconciliation scans and the filesystem deal with
+a few inodes instead of millions. Reads go through ``mmap``.
+
+Pack files are only ever appended to. Overwriting or deleting a blob only
+changes the index; copies share one record. ``compact`` reclaims the space
+of dead records: the live records of a sealed pack that is mostly dead are
+appended to the current pack, the index is repointed and the old pack is
+deleted. The reaper runs it after every sweep:
+
+    python -m server.storage compact
+
+Processes share a store: appends and compaction hold an exclusive ``flock``
+on ``append.lock``, readers take no lock and look the blob up again if
+compaction deleted its pack in between. Writes are not fsynced, like loose
+blobs; a crash mid-append leaves bytes past the recorded pack size, which
+the next append overwrites.
+"""
+import mmap
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, Dict, Iterator, NamedTuple, Optional, Tuple
+
+PACK_DIR = ".packs"  # in UPLOAD_ROOT
+PACK_BYTES = 64 * 1024 * 1024  # a pack is sealed once it is this large
+COMPACT_BELOW = 0.5  # a sealed pack is compacted once less than this share of it is live
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS packs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    size INTEGER NOT NULL DEFAULT 0,
+    sealed INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS blobs (
+    path TEXT PRIMARY KEY,
+    pack INTEGER NOT NULL,
+    offset INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    sha256 TEXT,
+    stored_ns INTEGER NOT NULL
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS ix_blobs_pack ON blobs (pack, offset);
+"""
+
+
+class PackEntry(NamedTuple):
+    """Where a packed blob lives; ``st_size``/``st_mtime_ns`` let it stand in for ``os.stat``."""
+
+    path: str
+    pack: int
+    offset: int
+    st_size: int
+    st_mtime_ns: int
+
+    @property
+    def st_mtime(self) -> float:
+        return self.st_mtime_ns / 1e9
+
+
+class PackStore:
+    def __init__(self, root: str, pack_bytes: int = PACK_BYTES) -> None:
+        self.root = Path(root)
+        self.pack_bytes = pack_bytes
+        self.root.mkdir(parents=True, exist_ok=True)
+        self._local = threading.local()
+        self._maps: Dict[int, mmap.mmap] = {}
+        self._maps_lock = threading.Lock()
+        conn = self._connect()
+        try:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.executescript(SCHEMA)
+        finally:
+            conn.close()
+
+    @staticmethod
+    def present(root: str) -> bool:
+        return (Path(root) / "index.db").exists()
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.root / "index.db", timeout=30)
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    def _db(self) -> sqlite3.Connection:
+        """This thread's connection (reopened after a fork)."""
+        if getattr(self._local, "pid", None) != os.getpid():
+            self._local.conn = self._connect()
+            self._local.pid = os.getpid()
+        return self._local.conn
+
+    def pack_path(self, pack: int) -> Path:
+        return self.root / f"pack-{pack:06d}.dat"
+
+    @contextmanager
+    def _locked(self) -> Iterator[sqlite3.Connection]:
+        """The exclusive append lock (between threads as well: each call opens its own lock file)."""
+        import fcntl
+
+        conn = self._db()
+        with open(self.root / "append.lock", "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                yield conn
+                conn.commit()
+            except BaseException:
+                conn.rollback()
+                raise
+
+    # -- lookups ---------------------------------------------------------------
+
+    def get(self, rel: str) -> Optional[PackEntry]:
+        row = self._db().execute(
+            "SELECT path, pack, offset, size, stored_ns FROM blobs WHERE path = ?", (rel,)
+        ).fetchone()
+        return PackEntry(*row) if row else None
+
+    def read(self, rel: str) -> Optional[bytes]:
+        """The blob's bytes, or None when ``rel`` is not packed."""
+        for attempt in (1, 2):
+            entry = self.get(rel)
+            if entry is None:
+                return None
+            if entry.st_size == 0:
+                return b""
+            try:
+                view = self._map(entry.pack, entry.offset + entry.st_size)
+            except FileNotFoundError:
+                if attempt == 2:
+                    raise
+                continue  # compacted away between the lookup and the read
+            return view[entry.offset:entry.offset + entry.st_size]
+        return None
+
+    def _map(self, pack: int, needed: int) -> mmap.mmap:
+        """A read-only map of ``pack`` covering at least ``needed`` bytes.
+
+        A pack that grew is mapped again; old maps are not closed but dropped,
+        so a reader still slicing one keeps it alive until it is done.
+        """
+        with self._maps_lock:
+            mapped = self._maps.get(pack)
+            if mapped is not None and len(mapped) >= needed:
+                return mapped
+            with open(self.pack_path(pack), "rb") as f:
+                mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self._maps[pack] = mapped
+            for stale in [p for p in self._maps if p != pack and not self.pack_path(p).exists()]:
+                del self._maps[stale]
+            return mapped
+
+    def walk(self) -> Iterator[PackEntry]:
+        """Every packed blob in path order (on its own connection: safe to interleave with writes)."""
+        conn = self._connect()
+        try:
+            yield from (PackEntry(*row) for row in conn.execute(
+                "SELECT path, pack, offset, size, stored_ns FROM blobs ORDER BY path"))
+        finally:
+            conn.close()
+
+    def stats(self) -> Dict[str, Any]:
+        conn = self._db()
+        packs, pack_bytes = conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM packs").fetchone()
+        blobs, = conn.execute("SELECT COUNT(*) FROM blobs").fetchone()
+        live, = conn.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM (SELECT DISTINCT pack, offset, size FROM blobs)").fetchone()
+        return {"packs": packs, "blobs": blobs, "pack_bytes": pack_bytes, "live_bytes": live}
+
+    # -- writes ----------------------------------------------------------------
+
+    def _append(self, conn: sqlite3.Connection, data: bytes) -> Tuple[int, int]:
+        """Write ``data`` at the end of the current pack; returns ``(pack, offset)``. Needs the lock."""
+        row = conn.execute("SELECT id, size FROM packs WHERE sealed = 0 ORDER BY id DESC LIMIT 1").fetchone()
+        if row is None or row[1] >= self.pack_bytes:
+            if row is not None:
+                conn.execute("UPDATE packs SET sealed = 1 WHERE id = ?", (row[0],))
+            row = (conn.execute("INSERT INTO packs (size) VALUES (0)").lastrowid, 0)
+        pack, offset = row
+        fd = os.open(self.pack_path(pack), os.O_WRONLY | os.O_CREAT, 0o644)
+        try:
+            view = memoryview(data)
+            written = 0
+            while written < len(view):
+                written += os.pwrite(fd, view[written:], offset + written)
+        finally:
+            os.close(fd)
+        conn.execute("UPDATE packs SET size = ? WHERE id = ?", (offset + len(data), pack))
+        return pack, offset
+
+    def put(self, rel: str, data: bytes, sha256: str) -> None:
+        with self._locked() as conn:
+            pack, offset = self._append(conn, data)
+            conn.execute("INSERT OR REPLACE INTO blobs VALUES (?, ?, ?, ?, ?, ?)",
+                         (rel, pack, offset, len(data), sha256, time.time_ns()))
+
+    def link(self, src: str, dest: str) -> bool:
+        """Make ``dest`` another name for the packed blob ``src``; False when ``src`` is not packed."""
+        with self._locked() as conn:
+            cur = conn.execute(
+                "INSERT OR REPLACE INTO blobs SELECT ?, pack, offset, size, sha256, ? FROM blobs WHERE path = ?",
+                (dest, time.time_ns(), src),
+            )
+            return cur.rowcount > 0
+
+    def remove(self, rel: str) -> bool:
+        with self._locked() as conn:
+            return conn.execute("DELETE FROM blobs WHERE path = ?", (rel,)).rowcount > 0
+
+    def compact(self, below: float = COMPACT_BELOW) -> Dict[str, Any]:
+        """Rewrite the live records of sealed packs that are less than ``below`` live, one pack at a time."""
+        report = {"packs": 0, "moved": 0, "reclaimed_bytes": 0}
+        while True:
+            with self._locked() as conn:
+                victim = conn.execute(
+                    "SELECT p.id, p.size, COALESCE(SUM(l.size), 0) FROM packs p "
+                    "LEFT JOIN (SELECT DISTINCT pack, offset, size FROM blobs) l ON l.pack = p.id "
+                    "WHERE p.sealed = 1 GROUP BY p.id HAVING COALESCE(SUM(l.size), 0) < p.size * ? "
+                    "ORDER BY p.id LIMIT 1", (below,),
+                ).fetchone()
+                if victim is None:
+                    return report
+                pack, size, live = victim
+                records = conn.execute(
+                    "SELECT DISTINCT offset, size FROM blobs WHERE pack = ? ORDER BY offset", (pack,)
+                ).fetchall()
+                if records:
+                    with open(self.pack_path(pack), "rb") as f:
+                        for offset, length in records:
+                            new_pack, new_offset = self._append(conn, os.pread(f.fileno(), length, offset))
+                            conn.execute("UPDATE blobs SET pack = ?, offset = ? WHERE pack = ? AND offset = ?",
+                                         (new_pack, new_offset, pack, offset))
+                conn.execute("DELETE FROM packs WHERE id = ?", (pack,))
+                conn.commit()
+                self.pack_path(pack).unlink(missing_ok=True)
+            report["packs"] += 1
+            report["moved"] += len(records)
+            report["reclaimed_bytes"] += size - live
@@ -0,0 +1,253 @@
+"""Opt-in per-request profiling.
+
+Enabled by either of:
+
+    PROFILE_SECRET       requests carrying a valid ``X-Profile`` header are profiled
+    PROFILE_SAMPLE_RATE  fraction of all requests to profile (e.g. 0.001)
+
+When neither is set the middleware is not installed at all, so there is no
+per-request cost. Other settings:
+
+    PROFILE_DIR          output directory (default server/profiles)
+    PROFILE_MODE         "sample" (default, statistical stack sampler) or "cprofile"
+    PROFILE_INTERVAL_MS  sampling interval (default 2)
+    PROFILE_TRACEMALLOC  "1" to record allocation deltas per profiled request
+
+Each profiled request writes ``<id>.collapsed`` (sample mode; feed it to
+flamegraph.pl or speedscope) or ``<id>.prof`` (cprofile mode; pstats /
+snakeviz), ``<id>.summary.json`` and, with tracemalloc, ``<id>.alloc.txt``.
+The id is returned in the ``X-Profile-Id`` response header.
+
+An admin signs a request with::
+
+    python -m server.profiling sign GET /files
+"""
+import cProfile
+import hashlib
+import hmac
+import io
+import json
+import os
+import pstats
+import random
+import sys
+import threading
+import time
+import tracemalloc
+import uuid
+from collections import Counter
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+from werkzeug.wsgi import ClosingIterator
+
+SIGNATURE_TTL = 300  # seconds a signed X-Profile header stays valid
+
+
+def sign_request(secret: str, method: str, path: str, ts: Optional[int] = None) -> str:
+    ts = int(time.time()) if ts is None else ts
+    mac = hmac.new(secret.encode(), f"{ts}:{method.upper()}:{path}".encode(), hashlib.sha256).hexdigest()
+    return f"{ts}:{mac}"
+
+
+def verify_signature(secret: str, header: str, method: str, path: str) -> bool:
+    try:
+        ts_text, _mac = header.split(":", 1)
+        ts = int(ts_text)
+    except ValueError:
+        return False
+    if abs(time.time() - ts) > SIGNATURE_TTL:
+        return False
+    return hmac.compare_digest(header, sign_request(secret, method, path, ts))
+
+
+def _frame_label(code) -> str:
+    parts = Path(code.co_filename).parts[-2:]
+    return f"{code.co_name} ({'/'.join(parts)}:{code.co_firstlineno})"
+
+
+class StackSampler:
+    """Samples one thread's Python stack every ``interval`` seconds into collapsed-stack counts."""
+
+    def __init__(self, thread_id: int, interval: float) -> None:
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks: Counter = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="profile-sampler", daemon=True)
+
+    def start(self) -> None:
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            labels = []
+            while frame is not None:
+                labels.append(_frame_label(frame.f_code))
+                frame = frame.f_back
+            if labels:
+                self.stacks[";".join(reversed(labels))] += 1
+
+    def collapsed(self) -> str:
+        return "".join(f"{stack} {count}\n" for stack, count in self.stacks.most_common())
+
+    def top_frames(self, limit: int = 25) -> List[Dict[str, Any]]:
+        self_counts: Counter = Counter()
+        total_counts: Counter = Counter()
+        for stack, count in self.stacks.items():
+            frames = stack.split(";")
+            self_counts[frames[-1]] += count
+            for frame in set(frames):
+                total_counts[frame] += count
+        return [{"frame": f, "self": self_counts[f], "total": total_counts[f]}
+                for f, _ in total_counts.most_common(limit)]
+
+
+class ProfilingMiddleware:
+    def __init__(self, wsgi_app, out_dir: str, secret: Optional[str] = None, sample_rate: float = 0.0,
+                 mode: str = "sample", interval: float = 0.002, trace_alloc: bool = False) -> None:
+        self.wsgi_app = wsgi_app
+        self.out_dir = Path(out_dir)
+        self.secret = secret
+        self.sample_rate = sample_rate
+        self.mode = mode
+        self.interval = interval
+        self.trace_alloc = trace_alloc
+        self._alloc_lock = threading.Lock()
+        self._alloc_users = 0
+
+    def _wanted(self, environ) -> bool:
+        header = environ.get("HTTP_X_PROFILE")
+        if header and self.secret:
+            return verify_signature(self.secret, header, environ["REQUEST_METHOD"], environ.get("PATH_INFO", ""))
+        return self.sample_rate > 0 and random.random() < self.sample_rate
+
+    def __call__(self, environ, start_response):
+        if not self._wanted(environ):
+            return self.wsgi_app(environ, start_response)
+
+        profile_id = f"{time.strftime('%Y%m%dT%H%M%S')}-{uuid.uuid4().hex[:8]}"
+        status_holder = {}
+
+        def start_with_id(status, headers, exc_info=None):
+            status_holder["status"] = status
+            return start_response(status, list(headers) + [("X-Profile-Id", profile_id)], exc_info)
+
+        alloc_before = self._start_alloc()
+        started = time.perf_counter()
+        if self.mode == "cprofile":
+            profiler: Any = cProfile.Profile()
+            profiler.enable()
+        else:
+            profiler = StackSampler(threading.get_ident(), self.interval)
+            profiler.start()
+
+        finished = []
+
+        def finish():
+            # The body may be closed by another thread than the one that produced it; only stop once
+            if finished:
+                return
+            finished.append(True)
+            if self.mode == "cprofile":
+                profiler.disable()
+            else:
+                profiler.stop()
+            elapsed = time.perf_counter() - started
+            alloc = self._stop_alloc(alloc_before)
+            self._write(profile_id, environ, status_holder.get("status"), elapsed, profiler, alloc)
+
+        try:
+            app_iter = self.wsgi_app(environ, start_with_id)
+        except BaseException:
+            finish()
+            raise
+        return ClosingIterator(app_iter, [finish])
+
+    def _start_alloc(self):
+        if not self.trace_alloc:
+            return None
+        with self._alloc_lock:
+            if self._alloc_users == 0 and not tracemalloc.is_tracing():
+                tracemalloc.start(25)
+            self._alloc_users += 1
+        return tracemalloc.take_snapshot()
+
+    def _stop_alloc(self, before) -> Optional[Dict[str, Any]]:
+        if before is None:
+            return None
+        after = tracemalloc.take_snapshot()
+        _current, peak = tracemalloc.get_traced_memory()
+        with self._alloc_lock:
+            self._alloc_users -= 1
+            if self._alloc_users == 0:
+                tracemalloc.stop()
+        return {"peak_bytes": peak, "top": after.compare_to(before, "lineno")[:25]}
+
+    def _write(self, profile_id, environ, status, elapsed, profiler, alloc) -> None:
+        self.out_dir.mkdir(parents=True, exist_ok=True)
+        base = self.out_dir / profile_id
+        summary: Dict[str, Any] = {
+            "id": profile_id,
+            "method": environ.get("REQUEST_METHOD"),
+            "path": environ.get("PATH_INFO"),
+            "query": environ.get("QUERY_STRING"),
+            "status": status,
+            "wall_ms": round(elapsed * 1000, 3),
+            "mode": self.mode,
+        }
+        if self.mode == "cprofile":
+            profiler.dump_stats(str(base) + ".prof")
+            out = io.StringIO()
+            pstats.Stats(profiler, stream=out).sort_stats("cumulative").print_stats(25)
+            summary["top"] = out.getvalue().splitlines()
+        else:
+            (Path(str(base) + ".collapsed")).write_text(profiler.collapsed(), encoding="utf-8")
+            summary["samples"] = sum(profiler.stacks.values())
+            summary["top"] = profiler.top_frames()
+        if alloc is not None:
+            summary["alloc_peak_bytes"] = alloc["peak_bytes"]
+            (Path(str(base) + ".alloc.txt")).write_text("\n".join(str(s) for s in alloc["top"]), encoding="utf-8")
+        (Path(str(base) + ".summary.json")).write_text(json.dumps(summary, ensure_ascii=False, indent=2),
+                                                       encoding="utf-8")
+
+
+def install(app) -> None:
+    """Wrap ``app.wsgi_app`` when profiling is configured; otherwise leave it untouched."""
+    secret = app.config.get("PROFILE_SECRET")
+    rate = app.config.get("PROFILE_SAMPLE_RATE", 0.0)
+    if not secret and rate <= 0:
+        return
+    app.wsgi_app = ProfilingMiddleware(
+        app.wsgi_app,
+        out_dir=app.config["PROFILE_DIR"],
+        secret=secret,
+        sample_rate=rate,
+        mode=app.config.get("PROFILE_MODE", "sample"),
+        interval=app.config.get("PROFILE_INTERVAL_MS", 2) / 1000.0,
+        trace_alloc=app.config.get("PROFILE_TRACEMALLOC", False),
+    )
+
+
+def main(argv=None) -> None:
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Profiling helpers")
+    sub = parser.add_subparsers(dest="command", required=True)
+    p = sub.add_parser("sign", help="print an X-Profile header value for one request")
+    p.add_argument("method")
+    p.add_argument("path")
+    args = parser.parse_args(argv)
+    secret = os.environ.get("PROFILE_SECRET")
+    if not secret:
+        raise SystemExit("PROFILE_SECRET is not set")
+    print(f"X-Profile: {sign_request(secret, args.method, args.path)}")
+
+
+if __name__ == "__main__":
+    main()
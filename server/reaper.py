@@ -0,0 +1,348 @@
+"""Blob garbage collection and storage reconciliation.
+
+``DELETE /files/<id>`` only tombstones the row (``deleted_at``). The reaper
+removes tombstoned blobs in batches and then the rows themselves; the
+reconciliation sweep compares the ``files`` table with the upload tree and
+reports (optionally fixes) orphan blobs and rows whose blob is missing.
+
+    python -m server.reaper                 # reap tombstones once
+    python -m server.reaper --loop 60       # keep reaping every 60 s
+    python -m server.reaper --reconcile     # report orphans / dangling rows, reap nothing
+    python -m server.reaper --reconcile --fix
+"""
+import argparse
+import json
+import logging
+import os
+import shutil
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from typing import IO, Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+from sqlalchemy import delete, select
+from sqlalchemy.orm import Session
+
+from . import collection, events
+from .models import FileEntry
+from .packs import PackEntry
+from .storage import StoragePool
+
+log = logging.getLogger(__name__)
+
+SAMPLE_LIMIT = 100  # how many example paths/ids a report keeps
+
+
+def purge_derived(cache_root: Optional[str], file_id: int) -> None:
+    """Drop every cached derivative (tiles, previews, ...) of a file."""
+    if not cache_root or not os.path.isdir(cache_root):
+        return
+    for kind in os.scandir(cache_root):
+        if not kind.is_dir():
+            continue
+        for derived in Path(kind.path).glob(f"{file_id}-*"):
+            if derived.is_dir():
+                shutil.rmtree(derived, ignore_errors=True)
+            else:
+                derived.unlink(missing_ok=True)
+
+
+def _written_after(storage: Optional[StoragePool], path: str, when: datetime) -> bool:
+    """Whether the blob at ``path`` was (re)written after ``when`` (naive UTC).
+
+    A loose blob written after ``when`` is an inode of its own: ``clone_file``
+    never hard-links onto an existing path, so a path rewritten after its
+    delete has one link and a fresh ctime. An inode with further links was
+    there before the delete; its ctime moves whenever one of them is cloned,
+    and removing this one name leaves the others intact.
+    """
+    try:
+        st = storage.stat(path) if storage is not None else os.stat(path)
+    except FileNotFoundError:
+        return False
+    if isinstance(st, PackEntry):
+        changed_ns = st.st_mtime_ns
+    elif st.st_nlink > 1:
+        return False
+    else:
+        changed_ns = st.st_ctime_ns
+    return changed_ns > when.replace(tzinfo=timezone.utc).timestamp() * 1e9
+
+
+def reap_tombstones(session_factory: Callable[[], Session], batch_size: int = 500,
+                    cache_root: Optional[str] = None, storage: Optional[StoragePool] = None) -> int:
+    """Remove blobs of tombstoned rows, then the rows. Returns the number of rows reaped.
+
+    A blob is kept while any live row still points at it (re-uploading a file
+    with the same name reuses its path), and also when it was written after
+    its row was tombstoned: an upload or archive batch reusing the path may
+    not have committed its row yet. Liveness and that write time are checked
+    per path right before removing it. Rows whose blob could not be removed
+    stay tombstoned and are retried on the next run.
+    """
+    remove = storage.remove if storage is not None else os.remove
+    reaped = 0
+    last_id = 0
+    while True:
+        db = session_factory()
+        try:
+            rows = db.execute(
+                select(FileEntry.id, FileEntry.disk_path, FileEntry.deleted_at)
+                .where(FileEntry.deleted_at.is_not(None), FileEntry.id > last_id)
+                .order_by(FileEntry.id)
+                .limit(batch_size)
+            ).all()
+            if not rows:
+                return reaped
+            last_id = rows[-1].id
+
+            deleted_at: Dict[str, datetime] = {}
+            for r in rows:
+                deleted_at[r.disk_path] = max(r.deleted_at, deleted_at.get(r.disk_path, r.deleted_at))
+            failed = set()
+            for path, since in deleted_at.items():
+                still_used = db.execute(
+                    select(FileEntry.id).where(FileEntry.disk_path == path, FileEntry.deleted_at.is_(None)).limit(1)
+                ).scalar()
+                if still_used is not None or _written_after(storage, path, since):
+                    continue  # the rows go, the blob belongs to a newer one
+                try:
+                    remove(path)
+                except FileNotFoundError:
+                    pass
+                except OSError as e:
+                    log.warning("cannot remove %s: %s", path, e)
+                    failed.add(path)
+
+            done = [r.id for r in rows if r.disk_path not in failed]
+            if done:
+                db.execute(delete(FileEntry).where(FileEntry.id.in_(done)))
+            db.commit()
+        finally:
+            db.close()
+        for file_id in done:
+            purge_derived(cache_root, file_id)
+        reaped += len(done)
+
+
+def _try_lock(path: str) -> Optional[IO[str]]:
+    """An open file holding an exclusive ``flock`` on ``path``, or ``None`` if someone else holds it."""
+    import fcntl
+
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    lock = open(path, "w")
+    try:
+        fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        lock.close()
+        return None
+    return lock
+
+
+def start_reaper(session_factory: Callable[[], Session], interval: float,
+                 cache_root: Optional[str] = None,
+                 event_retention: Optional[timedelta] = None,
+                 storage: Optional[StoragePool] = None,
+                 lock_path: Optional[str] = None) -> threading.Thread:
+    """Run ``reap_tombstones``, pack compaction and event pruning every ``interval`` seconds in a daemon thread.
+
+    Every worker process calls this. With ``lock_path`` only the one holding
+    its lock does the work; the others keep trying, so a worker that exits
+    (or is recycled) hands the jobs over within one ``interval``.
+    """
+    def loop():
+        lock = None
+        while True:
+            time.sleep(interval)
+            if lock_path is not None and lock is None:
+                lock = _try_lock(lock_path)
+                if lock is None:
+                    continue  # another process runs the jobs
+            try:
+                reap_tombstones(session_factory, cache_root=cache_root, storage=storage)
+                if storage is not None and storage.packs is not None:
+                    storage.packs.compact()
+                if event_retention is not None:
+                    with session_factory() as db:
+                        events.prune_events(db, event_retention)
+            except Exception:
+                log.exception("reaper run failed")
+
+    thread = threading.Thread(target=loop, name="blob-reaper", daemon=True)
+    thread.start()
+    return thread
+
+
+def walk_sorted(root: str, start_after: Optional[str] = None) -> Iterator[Tuple[str, os.stat_result]]:
+    """Yield ``(path, stat)`` for every file under ``root`` in plain string order.
+
+    Entries are sorted per directory with a trailing separator on directory
+    names, which makes the concatenated paths come out in the same order as
+    ``ORDER BY disk_path``. Only one directory listing is held per level.
+    With ``start_after`` only later paths are yielded, and directories that
+    sort entirely before it are not descended into.
+    """
+    try:
+        entries = list(os.scandir(root))
+    except FileNotFoundError:
+        return
+    keyed = []
+    for entry in entries:
+        is_dir = entry.is_dir(follow_symlinks=False)
+        keyed.append((entry.name + os.sep if is_dir else entry.name, entry, is_dir))
+    keyed.sort(key=lambda k: k[0])
+    for _key, entry, is_dir in keyed:
+        if is_dir:
+            prefix = entry.path + os.sep
+            if start_after is not None and prefix < start_after and not start_after.startswith(prefix):
+                continue
+            yield from walk_sorted(entry.path, start_after)
+        elif entry.is_file(follow_symlinks=False):
+            if start_after is not None and entry.path <= start_after:
+                continue
+            yield entry.path, entry.stat(follow_symlinks=False)
+
+
+def _db_paths(db: Session) -> Iterator[Tuple[str, List[int], bool]]:
+    """Yield ``(disk_path, ids, any_live)`` grouped by path, in path order, streaming."""
+    result = db.execute(
+        select(FileEntry.id, FileEntry.disk_path, FileEntry.deleted_at)
+        .order_by(FileEntry.disk_path)
+        .execution_options(yield_per=1000)
+    )
+    current, ids, live = None, [], False
+    for row in result:
+        if row.disk_path != current:
+            if current is not None:
+                yield current, ids, live
+            current, ids, live = row.disk_path, [], False
+        ids.append(row.id)
+        live = live or row.deleted_at is None
+    if current is not None:
+        yield current, ids, live
+
+
+def reconcile(session_factory: Callable[[], Session], upload_root: str, fix: bool = False,
+              grace_seconds: float = 3600, batch_size: int = 500,
+              storage: Optional[StoragePool] = None) -> Dict[str, Any]:
+    """Merge-join the sorted ``files`` table with the sorted upload tree (every volume of ``storage``, and its packs).
+
+    Orphans are blobs no row points at; dangling rows are live rows whose blob
+    is gone from every volume. With ``fix`` orphans older than ``grace_seconds`` are deleted
+    (younger ones may belong to an upload that has not committed yet) and
+    dangling rows are tombstoned so the reaper drops them.
+    """
+    report: Dict[str, Any] = {
+        "db_paths": 0, "disk_files": 0,
+        "orphan_count": 0, "orphan_bytes": 0, "orphans": [],
+        "dangling_count": 0, "dangling": [],
+        "removed": 0, "tombstoned": 0,
+    }
+    now = time.time()
+    pending: List[int] = []
+
+    def flush_dangling():
+        if not pending:
+            return
+        writer = session_factory()
+        try:
+            stamp = datetime.utcnow()
+            for entry in writer.execute(
+                select(FileEntry).where(FileEntry.id.in_(pending), FileEntry.deleted_at.is_(None))
+            ).scalars().all():
+                entry.deleted_at = stamp
+                collection.record_removed(writer, entry)
+                report["tombstoned"] += 1
+            writer.commit()
+        finally:
+            writer.close()
+        pending.clear()
+
+    def on_orphan(path: str, st):
+        report["orphan_count"] += 1
+        report["orphan_bytes"] += st.st_size
+        if len(report["orphans"]) < SAMPLE_LIMIT:
+            report["orphans"].append(path)
+        if fix and now - st.st_mtime > grace_seconds:
+            try:
+                if isinstance(st, PackEntry):
+                    storage.packs.remove(st.path)
+                else:
+                    os.remove(path)
+                report["removed"] += 1
+            except OSError as e:
+                log.warning("cannot remove orphan %s: %s", path, e)
+
+    def on_missing(path: str, ids: List[int], live: bool):
+        if not live:
+            return  # tombstoned rows without a blob are simply waiting for the reaper
+        report["dangling_count"] += 1
+        if len(report["dangling"]) < SAMPLE_LIMIT:
+            report["dangling"].append({"path": path, "ids": ids})
+        if fix:
+            pending.extend(ids)
+            if len(pending) >= batch_size:
+                flush_dangling()
+
+    if storage is None:
+        storage = StoragePool(upload_root)
+
+    reader = session_factory()
+    try:
+        disk = storage.walk()  # (disk_path, physical path, stat); one item per copy
+        rows = _db_paths(reader)
+        d = next(disk, None)
+        r = next(rows, None)
+        while d is not None or r is not None:
+            if r is None or (d is not None and d[0] < r[0]):
+                report["disk_files"] += 1
+                on_orphan(d[1], d[2])
+                d = next(disk, None)
+            elif d is None or r[0] < d[0]:
+                report["db_paths"] += 1
+                on_missing(*r)
+                r = next(rows, None)
+            else:
+                report["db_paths"] += 1
+                while d is not None and d[0] == r[0]:
+                    report["disk_files"] += 1
+                    d = next(disk, None)
+                r = next(rows, None)
+    finally:
+        reader.close()
+    flush_dangling()
+    return report
+
+
+def main(argv=None) -> None:
+    parser = argparse.ArgumentParser(description="Reap deleted blobs and reconcile storage with the database")
+    parser.add_argument("--reconcile", action="store_true", help="compare the upload tree with the files table")
+    parser.add_argument("--fix", action="store_true", help="with --reconcile: delete orphans, tombstone dangling rows")
+    parser.add_argument("--grace", type=float, default=3600, help="ignore orphans younger than this many seconds")
+    parser.add_argument("--batch", type=int, default=500)
+    parser.add_argument("--loop", type=float, default=0, help="repeat the reap every N seconds")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO)
+
+    from .app import create_app
+    app = create_app(background_jobs=False)
+    factory = app.extensions["db_session"].session_factory
+    cache_root = app.config["CACHE_ROOT"]
+
+    if args.reconcile:
+        report = reconcile(factory, app.config["UPLOAD_ROOT"], fix=args.fix,
+                           grace_seconds=args.grace, batch_size=args.batch, storage=app.extensions["storage"])
+        print(json.dumps(report, ensure_ascii=False, indent=2))
+        return
+    while True:
+        reaped = reap_tombstones(factory, batch_size=args.batch, cache_root=cache_root,
+                                 storage=app.extensions["storage"])
+        log.info("reaped %d tombstoned files", reaped)
+        if not args.loop:
+            break
+        time.sleep(args.loop)
+
+
+if __name__ == "__main__":
+    main()
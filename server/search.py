@@ -0,0 +1,133 @@
+"""Filename search backed by an SQLite FTS5 trigram index.
+
+``file_names`` holds one row per live file (``rowid`` = ``files.id``) with
+the name folded by ``fold``: NFKC-normalised and case-folded, so "ЗВІТ.docx",
+"звіт.docx" and a decomposed "звіт.docx" from macOS all match "віт". With
+the trigram tokenizer any substring of three or more characters is an index
+lookup; shorter terms scan the (small) index table instead of ``files``.
+
+The table is kept in step by the ``collection`` hooks, inside the same
+transaction as the change to ``files``. On other databases, or an SQLite
+built without FTS5, searches fall back to ``lower(name) LIKE``.
+"""
+import logging
+import unicodedata
+import weakref
+from typing import Iterable, List, Optional, Tuple
+
+from sqlalchemy import Column, Integer, MetaData, Table, Text, delete, func, insert, select, text
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import Session
+
+from .models import FileEntry
+
+log = logging.getLogger(__name__)
+
+MIN_TRIGRAM = 3
+REBUILD_BATCH = 5000
+
+# Not part of models.Base: create_all cannot create virtual tables
+file_names = Table("file_names", MetaData(), Column("rowid", Integer, primary_key=True), Column("name", Text))
+
+_enabled: "weakref.WeakKeyDictionary[Engine, bool]" = weakref.WeakKeyDictionary()
+
+
+def fold(name: str) -> str:
+    return unicodedata.normalize("NFKC", name).casefold()
+
+
+def create_index(engine: Engine) -> bool:
+    """Create and fill ``file_names`` if missing; False when FTS5 trigram is unavailable."""
+    if engine.dialect.name != "sqlite":
+        return False
+    with engine.begin() as conn:
+        if conn.execute(text("SELECT 1 FROM sqlite_master WHERE name = 'file_names'")).first():
+            return True
+        try:
+            conn.execute(text("CREATE VIRTUAL TABLE file_names USING fts5(name, tokenize = 'trigram')"))
+        except OperationalError as e:
+            log.warning("filename search index unavailable, falling back to LIKE: %s", e)
+            return False
+        rebuild(conn)
+    _enabled.pop(engine, None)
+    return True
+
+
+def rebuild(conn) -> None:
+    """Re-index every live file."""
+    conn.execute(delete(file_names))
+    last_id = 0
+    while True:
+        rows = conn.execute(
+            select(FileEntry.id, FileEntry.name)
+            .where(FileEntry.id > last_id, FileEntry.deleted_at.is_(None))
+            .order_by(FileEntry.id).limit(REBUILD_BATCH)
+        ).all()
+        if not rows:
+            return
+        conn.execute(insert(file_names), [{"rowid": i, "name": fold(n)} for i, n in rows])
+        last_id = rows[-1][0]
+
+
+def probe(engine: Engine) -> bool:
+    """Whether ``engine`` has the index; looked up once per engine (``create_app`` does it at startup)."""
+    if engine not in _enabled:
+        if engine.dialect.name != "sqlite":
+            _enabled[engine] = False
+        else:
+            with engine.connect() as conn:
+                _enabled[engine] = conn.execute(
+                    text("SELECT 1 FROM sqlite_master WHERE name = 'file_names'")
+                ).first() is not None
+    return _enabled[engine]
+
+
+def enabled(db: Session) -> bool:
+    return probe(db.get_bind())
+
+
+def index_many(db: Session, entries: Iterable[Tuple[int, str]]) -> None:
+    """Add ``(file id, name)`` pairs."""
+    if not enabled(db):
+        return
+    rows = [{"rowid": file_id, "name": fold(name)} for file_id, name in entries]
+    if rows:
+        db.execute(insert(file_names), rows)
+
+
+def unindex(db: Session, file_id: int) -> None:
+    if enabled(db):
+        db.execute(delete(file_names).where(file_names.c.rowid == file_id))
+
+
+def unindex_where(db: Session, where) -> None:
+    """Drop the entries of all files matching ``where``, in one statement."""
+    if enabled(db):
+        db.execute(delete(file_names).where(file_names.c.rowid.in_(select(FileEntry.id).where(where))))
+
+
+def name_filter(db: Session, contains: Optional[str] = None, prefix: Optional[str] = None) -> List:
+    """Conditions on ``FileEntry`` for names containing and/or starting with the given terms."""
+    if not enabled(db):
+        name = func.lower(FileEntry.name)
+        conditions = []
+        if contains:
+            conditions.append(name.contains(contains.lower(), autoescape=True))
+        if prefix:
+            conditions.append(name.startswith(prefix.lower(), autoescape=True))
+        return conditions
+
+    contains, prefix = fold(contains or ""), fold(prefix or "")
+    if not (contains or prefix):
+        return []
+    conditions = []
+    # The longest term drives the trigram lookup; the rest are checked on its few candidates
+    term = max(contains, prefix, key=len)
+    if len(term) >= MIN_TRIGRAM:
+        conditions.append(file_names.c.name.match('"' + term.replace('"', '""') + '"'))
+    if contains and (contains != term or len(contains) < MIN_TRIGRAM):
+        conditions.append(func.instr(file_names.c.name, contains) > 0)
+    if prefix:
+        conditions.append(func.substr(file_names.c.name, 1, len(prefix)) == prefix)
+    return [FileEntry.id.in_(select(file_names.c.rowid).where(*conditions))]
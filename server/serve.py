@@ -0,0 +1,167 @@
+"""Production launcher for the REST API.
+
+    python -m server.serve
+
+Runs ``create_app()`` under gunicorn's prefork model with threaded workers.
+The schema is created once in the master process; every worker builds its
+own engine and ``scoped_session`` after the fork, so no SQLite connection is
+ever shared between processes. Background jobs (reaping, pack compaction,
+event pruning, rebalancing) run in one worker at a time, chosen by a lock
+file. Settings come from the environment:
+
+    WEB_BIND               address to listen on (default 0.0.0.0:5000)
+    WEB_WORKERS            worker processes (default 2 * CPU + 1)
+    WEB_THREADS            threads per worker (default 8 + EVENTS_MAX_WAITERS)
+    WEB_MAX_REQUESTS       recycle a worker after this many requests (default 2000, 0 = never)
+    WEB_GRACEFUL_TIMEOUT   seconds to let in-flight uploads finish on shutdown (default 120)
+    WEB_TIMEOUT            seconds before a silent worker is killed (default 300)
+    WEB_PRELOAD            "1" to import the app in the master before forking
+    WEB_MODE               "asgi" to serve through uvicorn and ``server.asgi`` instead
+
+In ASGI mode slow uploads and downloads wait on an event loop rather than on
+a worker thread (see ``server/asgi.py``, tuned by ASGI_THREADS, ASGI_SPOOL_KB,
+ASGI_CHUNK_KB and ASGI_SPOOL_DIR); WEB_BIND, WEB_WORKERS and
+WEB_GRACEFUL_TIMEOUT apply to both modes.
+
+An open change feed (``GET /files/events`` as SSE or a waiting long poll)
+holds a worker thread, in ASGI mode one of ASGI_THREADS. At most
+EVENTS_MAX_WAITERS (default 16) are served per worker process, and later
+ones get 503 with Retry-After. The default WEB_THREADS adds that many
+threads on top of the 8 for ordinary requests, so idle sync clients cannot
+starve them. Keep WEB_THREADS and ASGI_THREADS above EVENTS_MAX_WAITERS
+when setting them.
+"""
+import multiprocessing
+import os
+from typing import Any, Dict
+
+try:
+    from gunicorn.app.base import BaseApplication
+    HAS_GUNICORN = True
+except ImportError:
+    BaseApplication = object
+    HAS_GUNICORN = False
+
+try:
+    import uvicorn
+    HAS_UVICORN = True
+except ImportError:
+    uvicorn = None
+    HAS_UVICORN = False
+
+from .events import MAX_WAITERS
+from .models import create_db_engine, init_db
+
+
+def _env_int(name: str, default: int) -> int:
+    value = os.environ.get(name)
+    return int(value) if value else default
+
+
+def on_starting(server) -> None:
+    """Master hook: create the schema once, before any worker exists."""
+    url = os.environ.get("DATABASE_URL") or _default_database_url()
+    engine = create_db_engine(url)
+    try:
+        init_db(engine)
+    finally:
+        engine.dispose()
+
+
+def post_fork(server, worker) -> None:
+    """Worker hook: with WEB_PRELOAD the app was built in the master.
+
+    Drop the engine pool it inherited and start the background jobs, which
+    the master left out: its threads would not survive the fork, and the
+    master would hold the reaper lock forever.
+    """
+    app = getattr(worker.app, "callable", None)
+    engine = getattr(app, "extensions", {}).get("db_engine") if app is not None else None
+    if engine is not None:
+        engine.dispose(close=False)
+        from .app import start_background_jobs
+        start_background_jobs(app)
+
+
+def worker_exit(server, worker) -> None:
+    """Release DB connections once the worker has drained its requests."""
+    app = getattr(worker, "wsgi", None)
+    extensions = getattr(app, "extensions", {}) if app is not None else {}
+    if "db_session" in extensions:
+        extensions["db_session"].remove()
+    if "db_engine" in extensions:
+        extensions["db_engine"].dispose()
+
+
+def _default_database_url() -> str:
+    from pathlib import Path
+    return f"sqlite:///{Path(__file__).parent / 'app.db'}"
+
+
+def build_options() -> Dict[str, Any]:
+    max_requests = _env_int("WEB_MAX_REQUESTS", 2000)
+    return {
+        "bind": os.environ.get("WEB_BIND", "0.0.0.0:5000"),
+        "workers": _env_int("WEB_WORKERS", multiprocessing.cpu_count() * 2 + 1),
+        "worker_class": "gthread",
+        # ordinary requests plus the change feeds parked on threads (see above)
+        "threads": _env_int("WEB_THREADS", 8 + _env_int("EVENTS_MAX_WAITERS", MAX_WAITERS)),
+        # send_file() hands the open file to wsgi.file_wrapper; gunicorn then uses os.sendfile
+        "sendfile": True,
+        "max_requests": max_requests,
+        "max_requests_jitter": max_requests // 10,
+        "graceful_timeout": _env_int("WEB_GRACEFUL_TIMEOUT", 120),
+        "timeout": _env_int("WEB_TIMEOUT", 300),
+        "preload_app": os.environ.get("WEB_PRELOAD") == "1",
+        "on_starting": on_starting,
+        "post_fork": post_fork,
+        "worker_exit": worker_exit,
+    }
+
+
+class DriveServer(BaseApplication):
+    def __init__(self, options: Dict[str, Any]) -> None:
+        self.options = options
+        super().__init__()
+
+    def load_config(self) -> None:
+        for key, value in self.options.items():
+            if key in self.cfg.settings and value is not None:
+                self.cfg.set(key, value)
+
+    def load(self):
+        from .app import create_app
+        if self.cfg.preload_app:
+            # in the master, before on_starting: the schema has to exist for create_app
+            on_starting(None)
+            return create_app(init_schema=False, background_jobs=False)
+        return create_app(init_schema=False)
+
+
+def run_asgi() -> None:
+    if not HAS_UVICORN:
+        raise SystemExit("uvicorn is not installed: pip install uvicorn")
+    on_starting(None)
+    host, _, port = os.environ.get("WEB_BIND", "0.0.0.0:5000").rpartition(":")
+    uvicorn.run(
+        "server.asgi:create_asgi_app",
+        factory=True,
+        host=host or "0.0.0.0",
+        port=int(port),
+        workers=_env_int("WEB_WORKERS", multiprocessing.cpu_count()),
+        timeout_graceful_shutdown=_env_int("WEB_GRACEFUL_TIMEOUT", 120),
+        access_log=False,
+    )
+
+
+def main() -> None:
+    if os.environ.get("WEB_MODE") == "asgi":
+        run_asgi()
+        return
+    if not HAS_GUNICORN:
+        raise SystemExit("gunicorn is not installed: pip install gunicorn")
+    DriveServer(build_options()).run()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,573 @@
+"""User-sharded deployments: a routing table, a small router and user moves.
+
+Each shard is an ordinary instance (``create_app`` with its own database and
+upload root). A user and everything they own live on exactly one shard. The
+router is a WSGI app in front of the shards: it reads the user id from the
+JWT (all shards share ``JWT_SECRET_KEY``) and forwards the request, either to
+a URL or, in-process, straight to a shard's WSGI app.
+
+The shard map is a JSON file (``SHARD_MAP``)::
+
+    {"shards": {"s0": {"url": "http://10.0.0.1:5000", "database": "sqlite:////srv/s0/app.db",
+                       "upload_root": "/srv/s0/uploads"}, ...},
+     "pins": {"42": "s1"}, "moving": []}
+
+A shard may also set ``volumes``, ``replicas`` and ``pack_max_kb`` (see
+``server.storage``) for the blobs written into it by moves.
+
+``owner_id`` -> shard is a consistent-hash ring (64 virtual nodes per shard)
+unless the user is pinned. User ids are global: the router allocates them
+in a small directory database (``SHARD_DIRECTORY``) and passes the id to the
+shard's ``/auth/register`` with ``X-Shard-Secret``. The map file is re-read
+when it changes, so moves done by the CLI take effect without a restart.
+
+    python -m server.shards router --bind 0.0.0.0:5000
+    python -m server.shards where 42
+    python -m server.shards add NAME URL DATABASE UPLOAD_ROOT   # pins users whose ring shard changes
+    python -m server.shards rebalance                           # moves pinned users to their ring shard
+    python -m server.shards move 42 s2
+    python -m server.shards bench --shards 1,2,4                # local instances, throughput and a rebalance
+
+Moving a user copies their folders, files and blobs to the new shard (file
+and folder ids are re-assigned there; clients get a ``bulk`` event and
+re-list), then pins them and deletes the originals. Requests for a user in
+``moving`` are answered with 503 and ``Retry-After``. Copying or moving a
+file ``to_user`` only works between users on the same shard.
+"""
+import argparse
+import bisect
+import hashlib
+import http.client
+import json
+import os
+import sqlite3
+import threading
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+from urllib.parse import urlsplit
+
+import jwt
+from sqlalchemy import delete, func, insert, select
+from sqlalchemy.orm import Session, sessionmaker
+
+from . import collection, events, folders, search
+from .models import FileEntry, FileEvent, FileStat, Folder, User, create_db_engine, init_db
+from .storage import StoragePool
+
+VIRTUAL_NODES = 64
+SECRET_HEADER = "X-Shard-Secret"
+USER_ID_HEADER = "X-Shard-User-Id"
+HOP_BY_HOP = {"connection", "keep-alive", "proxy-authenticate", "proxy-authorization", "te", "trailers",
+              "transfer-encoding", "upgrade"}
+
+
+def _point(key: str) -> int:
+    return int.from_bytes(hashlib.sha1(key.encode("utf-8")).digest()[:8], "big")
+
+
+def _build_ring(names: Iterable[str]) -> List[Tuple[int, str]]:
+    return sorted((_point(f"{name}#{i}"), name) for name in names for i in range(VIRTUAL_NODES))
+
+
+def _on_ring(ring: List[Tuple[int, str]], keys: List[int], owner_id: int) -> str:
+    return ring[bisect.bisect(keys, _point(str(owner_id))) % len(ring)][1]
+
+
+class ShardMap:
+    def __init__(self, path: Path) -> None:
+        self.path = Path(path)
+        self._mtime = None
+        self._lock = threading.Lock()
+        self.reload()
+
+    def reload(self) -> None:
+        data = json.loads(self.path.read_text(encoding="utf-8"))
+        self.shards: Dict[str, Dict[str, Any]] = data["shards"]
+        self.pins: Dict[str, str] = data.get("pins", {})
+        self.moving: List[int] = data.get("moving", [])
+        self._ring = _build_ring(self.shards)
+        self._keys = [p for p, _ in self._ring]
+        self._mtime = self.path.stat().st_mtime_ns
+
+    def refresh(self) -> None:
+        """Re-read the file if it changed (one ``stat`` per call)."""
+        if self.path.stat().st_mtime_ns != self._mtime:
+            with self._lock:
+                if self.path.stat().st_mtime_ns != self._mtime:
+                    self.reload()
+
+    def save(self) -> None:
+        tmp = self.path.with_name(self.path.name + ".tmp")
+        tmp.write_text(json.dumps({"shards": self.shards, "pins": self.pins, "moving": self.moving},
+                                  ensure_ascii=False, indent=2), encoding="utf-8")
+        os.replace(tmp, self.path)
+        self.reload()
+
+    def ring_shard(self, owner_id: int) -> str:
+        return _on_ring(self._ring, self._keys, owner_id)
+
+    def shard_for(self, owner_id: int) -> str:
+        return self.pins.get(str(owner_id)) or self.ring_shard(owner_id)
+
+    def storage(self, name: str) -> StoragePool:
+        shard = self.shards[name]
+        return StoragePool(shard["upload_root"], shard.get("volumes"), shard.get("replicas", 1),
+                           pack_max_bytes=int(shard.get("pack_max_kb", 0) * 1024))
+
+
+class Directory:
+    """Global user ids: ``username -> id``, allocated by the router."""
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        with self._connect() as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS accounts ("
+                         "id INTEGER PRIMARY KEY AUTOINCREMENT, username TEXT NOT NULL UNIQUE COLLATE NOCASE)")
+
+    def _connect(self) -> sqlite3.Connection:
+        return sqlite3.connect(self.path, timeout=30)
+
+    def allocate(self, username: str) -> Optional[int]:
+        with self._connect() as conn:
+            try:
+                return conn.execute("INSERT INTO accounts (username) VALUES (?)", (username,)).lastrowid
+            except sqlite3.IntegrityError:
+                return None
+
+    def release(self, user_id: int) -> None:
+        with self._connect() as conn:
+            conn.execute("DELETE FROM accounts WHERE id = ?", (user_id,))
+
+    def lookup(self, username: str) -> Optional[int]:
+        with self._connect() as conn:
+            row = conn.execute("SELECT id FROM accounts WHERE username = ?", (username,)).fetchone()
+        return row[0] if row else None
+
+    def ids(self) -> List[int]:
+        with self._connect() as conn:
+            return [r[0] for r in conn.execute("SELECT id FROM accounts ORDER BY id")]
+
+
+# -- router -------------------------------------------------------------------
+
+def _json_response(start_response, status: str, body: Dict[str, Any], extra: Iterable[Tuple[str, str]] = ()):
+    data = json.dumps(body, ensure_ascii=False).encode("utf-8")
+    start_response(status, [("Content-Type", "application/json"), ("Content-Length", str(len(data))), *extra])
+    return [data]
+
+
+class _Body:
+    """A request body that was already read, offered again as ``wsgi.input``."""
+
+    def __init__(self, data: bytes) -> None:
+        self.data = data
+        self.pos = 0
+
+    def read(self, n: int = -1) -> bytes:
+        end = len(self.data) if n is None or n < 0 else self.pos + n
+        out = self.data[self.pos:end]
+        self.pos += len(out)
+        return out
+
+    def readline(self, limit: int = -1) -> bytes:
+        end = self.data.find(b"\n", self.pos) + 1 or len(self.data)
+        if limit >= 0:
+            end = min(end, self.pos + limit)
+        out = self.data[self.pos:end]
+        self.pos = end
+        return out
+
+
+def _chunks(stream, length: int, size: int = 64 * 1024) -> Iterator[bytes]:
+    """Exactly ``length`` bytes of a request body; reading a socket past it would block."""
+    while length > 0:
+        chunk = stream.read(min(size, length))
+        if not chunk:
+            return
+        length -= len(chunk)
+        yield chunk
+
+
+class ShardRouter:
+    """WSGI app forwarding each request to the shard of the user in its JWT.
+
+    ``backends`` maps shard names to in-process WSGI apps; shards without one
+    are reached over HTTP at their ``url``.
+    """
+
+    def __init__(self, shard_map: ShardMap, directory: Directory, jwt_secret: str, shard_secret: str,
+                 backends: Optional[Dict[str, Callable]] = None) -> None:
+        self.map = shard_map
+        self.directory = directory
+        self.jwt_secret = jwt_secret
+        self.shard_secret = shard_secret
+        self.backends = backends or {}
+
+    def __call__(self, environ, start_response):
+        self.map.refresh()
+        path = environ.get("PATH_INFO", "")
+        if environ["REQUEST_METHOD"] == "POST" and path in ("/auth/register", "/auth/login"):
+            return self._auth(environ, start_response, path)
+        owner_id = self._identity(environ)
+        if owner_id is None:
+            # unauthenticated: any shard gives the same 401 / CORS answer
+            return self._forward(sorted(self.map.shards)[0], environ, start_response)
+        if owner_id in self.map.moving:
+            return _json_response(start_response, "503 Service Unavailable",
+                                  {"message": "account is being moved, retry shortly"}, [("Retry-After", "5")])
+        return self._forward(self.map.shard_for(owner_id), environ, start_response)
+
+    def _identity(self, environ) -> Optional[int]:
+        auth = environ.get("HTTP_AUTHORIZATION", "")
+        if not auth.startswith("Bearer "):
+            return None
+        try:
+            claims = jwt.decode(auth[7:], self.jwt_secret, algorithms=["HS256"])
+            return int(claims["sub"])
+        except (jwt.InvalidTokenError, KeyError, ValueError):
+            return None  # the shard will reject it with its usual error
+
+    def _auth(self, environ, start_response, path: str):
+        length = int(environ.get("CONTENT_LENGTH") or 0)
+        raw = environ["wsgi.input"].read(length) if length else b""
+        environ["wsgi.input"] = _Body(raw)
+        try:
+            username = (json.loads(raw or b"{}").get("username") or "").strip()
+        except ValueError:
+            username = ""
+        if not username:
+            return self._forward(sorted(self.map.shards)[0], environ, start_response)
+
+        if path == "/auth/login":
+            user_id = self.directory.lookup(username)
+            if user_id is None:
+                return _json_response(start_response, "401 UNAUTHORIZED", {"message": "invalid credentials"})
+            return self._forward(self.map.shard_for(user_id), environ, start_response)
+
+        user_id = self.directory.allocate(username)
+        if user_id is None:
+            return _json_response(start_response, "409 CONFLICT", {"message": "user already exists"})
+        environ["HTTP_" + USER_ID_HEADER.upper().replace("-", "_")] = str(user_id)
+        environ["HTTP_" + SECRET_HEADER.upper().replace("-", "_")] = self.shard_secret
+        status_holder = {}
+
+        def capture(status, headers, exc_info=None):
+            status_holder["status"] = status
+            return start_response(status, headers, exc_info)
+
+        body = list(self._forward(self.map.shard_for(user_id), environ, capture))
+        if not status_holder.get("status", "").startswith("2"):
+            self.directory.release(user_id)
+        return body
+
+    def _forward(self, shard: str, environ, start_response):
+        backend = self.backends.get(shard)
+        if backend is not None:
+            def tagged(status, headers, exc_info=None):
+                return start_response(status, list(headers) + [("X-Shard", shard)], exc_info)
+            return backend(environ, tagged)
+        return self._proxy(shard, environ, start_response)
+
+    def _proxy(self, shard: str, environ, start_response):
+        target = urlsplit(self.map.shards[shard]["url"])
+        conn_class = http.client.HTTPSConnection if target.scheme == "https" else http.client.HTTPConnection
+        conn = conn_class(target.hostname, target.port, timeout=300)
+        path = target.path.rstrip("/") + environ.get("PATH_INFO", "")
+        if environ.get("QUERY_STRING"):
+            path += "?" + environ["QUERY_STRING"]
+        headers = {key[5:].replace("_", "-").title(): value for key, value in environ.items()
+                   if key.startswith("HTTP_") and key[5:].replace("_", "-").lower() not in HOP_BY_HOP}
+        headers.pop("Host", None)
+        for key in ("CONTENT_TYPE", "CONTENT_LENGTH"):
+            if environ.get(key):
+                headers[key.replace("_", "-").title()] = environ[key]
+        length = int(environ.get("CONTENT_LENGTH") or 0)
+        body = _chunks(environ["wsgi.input"], length) if length else None
+        conn.request(environ["REQUEST_METHOD"], path, body=body, headers=headers)
+        response = conn.getresponse()
+        out_headers = [(k, v) for k, v in response.getheaders() if k.lower() not in HOP_BY_HOP]
+        start_response(f"{response.status} {response.reason}", out_headers + [("X-Shard", shard)])
+
+        def stream():
+            try:
+                while True:
+                    chunk = response.read1(64 * 1024)
+                    if not chunk:
+                        break
+                    yield chunk
+            finally:
+                conn.close()
+        return stream()
+
+
+def router_from_env() -> ShardRouter:
+    """Router configured from ``SHARD_MAP``, ``SHARD_DIRECTORY``, ``JWT_SECRET_KEY`` and ``SHARD_SECRET``."""
+    shard_map = ShardMap(Path(os.environ["SHARD_MAP"]))
+    directory = Directory(os.environ.get("SHARD_DIRECTORY", str(shard_map.path.with_name("directory.db"))))
+    return ShardRouter(shard_map, directory, os.environ.get("JWT_SECRET_KEY", "dev-secret"),
+                       os.environ["SHARD_SECRET"])
+
+
+# -- moving users -------------------------------------------------------------
+
+def _session(url: str) -> Session:
+    engine = create_db_engine(url)
+    init_db(engine)
+    search.probe(engine)
+    return sessionmaker(bind=engine, future=True)()
+
+
+def move_user(shard_map: ShardMap, owner_id: int, target: str) -> Dict[str, Any]:
+    """Copy one user to ``target``, pin them there, then delete the source copy."""
+    source = shard_map.shard_for(owner_id)
+    if source == target:
+        return {"owner_id": owner_id, "from": source, "to": target, "files": 0, "bytes": 0}
+    if target not in shard_map.shards:
+        raise SystemExit(f"no such shard: {target}")
+    shard_map.moving = sorted(set(shard_map.moving) | {owner_id})
+    shard_map.save()
+    src_store, dst_store = shard_map.storage(source), shard_map.storage(target)
+    src = _session(shard_map.shards[source]["database"])
+    dst = _session(shard_map.shards[target]["database"])
+    report = {"owner_id": owner_id, "from": source, "to": target, "files": 0, "bytes": 0}
+    try:
+        user = src.get(User, owner_id)
+        if user is None:
+            raise SystemExit(f"user {owner_id} is not on shard {source}")
+        if dst.get(User, owner_id) is None:
+            dst.add(User(id=owner_id, username=user.username, password_hash=user.password_hash,
+                         files_version=user.files_version))
+            dst.flush()
+
+        for path in src.execute(select(Folder.path).where(Folder.owner_id == owner_id)
+                                .order_by(Folder.path)).scalars():
+            folders.ensure(dst, owner_id, path)
+        rows = []
+        for entry in src.execute(select(FileEntry).where(FileEntry.owner_id == owner_id,
+                                                         FileEntry.deleted_at.is_(None))).scalars():
+            folder = folders.get(dst, owner_id, entry.folder_path)
+            dest = folders.blob_dir(dst_store.upload_root, owner_id, folder) / entry.name
+            with src_store.open(entry.disk_path) as f:
+                size, digest = dst_store.write_stream(f, dest)
+            rows.append({
+                "owner_id": owner_id, "folder_path": entry.folder_path, "uploader_id": entry.uploader_id,
+                "editor_id": entry.editor_id, "name": entry.name, "extension": entry.extension,
+                "disk_path": str(dest), "size": size, "content_hash": digest,
+                "created_at": entry.created_at, "updated_at": entry.updated_at,
+            })
+            report["files"] += 1
+            report["bytes"] += size
+        if rows:
+            ids = dst.execute(insert(FileEntry).returning(FileEntry.id, sort_by_parameter_order=True), rows).scalars()
+            for row, file_id in zip(rows, ids):
+                row["id"] = file_id
+        # the user's clients keep their change-feed cursors, which count the source's events
+        events.advance_ids(dst, owner_id, src.execute(select(func.max(FileEvent.id))).scalar() or 0)
+        collection.record_added_many(dst, owner_id, rows)
+        dst.commit()
+
+        shard_map.pins[str(owner_id)] = target
+        if shard_map.ring_shard(owner_id) == target:
+            del shard_map.pins[str(owner_id)]
+        shard_map.save()
+
+        for disk_path in src.execute(select(FileEntry.disk_path).where(FileEntry.owner_id == owner_id)).scalars():
+            src_store.remove(disk_path)
+        search.unindex_where(src, FileEntry.owner_id == owner_id)
+        for model in (FileEntry, Folder, FileStat, FileEvent):
+            src.execute(delete(model).where(model.owner_id == owner_id))
+        src.execute(delete(User).where(User.id == owner_id))
+        src.commit()
+    finally:
+        shard_map.moving = [u for u in shard_map.moving if u != owner_id]
+        shard_map.save()
+        src.close()
+        dst.close()
+    return report
+
+
+def add_shard(shard_map: ShardMap, directory: Directory, name: str, shard: Dict[str, Any]) -> int:
+    """Add a shard; users whose ring position moves are pinned where they are. Returns how many.
+
+    The pins are worked out on the new ring first and written together with
+    the shard, so a router never sees the shard without them.
+    """
+    ring = _build_ring([*shard_map.shards, name])
+    keys = [p for p, _ in ring]
+    pinned = 0
+    for user_id in directory.ids():
+        current = shard_map.shard_for(user_id)
+        if str(user_id) not in shard_map.pins and _on_ring(ring, keys, user_id) != current:
+            shard_map.pins[str(user_id)] = current
+            pinned += 1
+    shard_map.shards[name] = shard
+    shard_map.save()
+    return pinned
+
+
+def rebalance(shard_map: ShardMap) -> List[Dict[str, Any]]:
+    """Move every pinned user whose ring shard differs from the pin."""
+    moves = []
+    for user_id, pinned in sorted(shard_map.pins.items()):
+        target = shard_map.ring_shard(int(user_id))
+        if target != pinned:
+            moves.append(move_user(shard_map, int(user_id), target))
+    return moves
+
+
+# -- local harness ------------------------------------------------------------
+
+def bench(root: Path, shard_counts: List[int], users: int = 24, requests_per_user: int = 40,
+          workers_per_shard: int = 2, port: int = 18000) -> Dict[str, Any]:
+    """Run real shard instances (``server.serve``) behind a router and measure requests per second.
+
+    The same load (uploads and listings by ``users`` concurrent users) runs
+    against 1..N shards; the last configuration then gets one more shard and
+    a rebalance, after which every user's files are read back through the router.
+    """
+    import subprocess
+    import sys
+    import time
+    from concurrent.futures import ThreadPoolExecutor
+
+    import requests
+
+    results: Dict[str, Any] = {"cpus": os.cpu_count(), "runs": []}
+    secret, shard_secret = "bench-jwt-secret-0123456789abcdef", "bench-shard-secret"
+    procs: List[subprocess.Popen] = []
+
+    def start_shard(run_dir: Path, name: str, shard_port: int) -> Dict[str, Any]:
+        shard = {"url": f"http://127.0.0.1:{shard_port}", "database": f"sqlite:///{run_dir / name / 'app.db'}",
+                 "upload_root": str(run_dir / name / "uploads")}
+        (run_dir / name).mkdir(parents=True)
+        env = dict(os.environ, DATABASE_URL=shard["database"], UPLOAD_ROOT=shard["upload_root"],
+                   CACHE_ROOT=str(run_dir / name / "cache"), JWT_SECRET_KEY=secret, SHARD_SECRET=shard_secret,
+                   WEB_BIND=f"127.0.0.1:{shard_port}", WEB_WORKERS=str(workers_per_shard), REAPER_INTERVAL="0")
+        with open(run_dir / name / "server.log", "wb") as log_file:
+            procs.append(subprocess.Popen([sys.executable, "-m", "server.serve"], env=env,
+                                          cwd=str(Path(__file__).resolve().parent.parent),
+                                          stdout=log_file, stderr=subprocess.STDOUT))
+        wait_for(shard["url"])
+        return shard
+
+    def wait_for(url: str) -> None:
+        for _ in range(200):
+            try:
+                requests.get(url + "/files", timeout=1)
+                return
+            except requests.ConnectionError:
+                time.sleep(0.1)
+        raise RuntimeError(f"{url} did not start")
+
+    def login(base: str, i: int) -> requests.Session:
+        s = requests.Session()
+        s.post(f"{base}/auth/register", json={"username": f"user{i}", "password": "pwd"})
+        token = s.post(f"{base}/auth/login", json={"username": f"user{i}", "password": "pwd"}).json()["access_token"]
+        s.headers["Authorization"] = f"Bearer {token}"
+        return s
+
+    def user_load(base: str, s: requests.Session) -> int:
+        for n in range(requests_per_user // 2):
+            s.post(f"{base}/files", files={"file": (f"f{n}.py", f"n = {n}\n".encode())}).raise_for_status()
+            s.get(f"{base}/files").raise_for_status()
+        return requests_per_user // 2 * 2
+
+    try:
+        for count in shard_counts:
+            run_dir = root / f"shards-{count}"
+            names = [f"s{i}" for i in range(count)]
+            shards = {name: start_shard(run_dir, name, port + len(procs)) for name in names}
+            map_path = run_dir / "shards.json"
+            map_path.write_text(json.dumps({"shards": shards}), encoding="utf-8")
+            shard_map = ShardMap(map_path)
+            directory = Directory(str(run_dir / "directory.db"))
+            router_port = port + len(procs)
+            env = dict(os.environ, SHARD_MAP=str(map_path), SHARD_DIRECTORY=directory.path,
+                       JWT_SECRET_KEY=secret, SHARD_SECRET=shard_secret)
+            with open(run_dir / "router.log", "wb") as log_file:
+                procs.append(subprocess.Popen(
+                    [sys.executable, "-m", "server.shards", "router", "--bind", f"127.0.0.1:{router_port}"],
+                    env=env, cwd=str(Path(__file__).resolve().parent.parent),
+                    stdout=log_file, stderr=subprocess.STDOUT))
+            base = f"http://127.0.0.1:{router_port}"
+            wait_for(base)
+
+            with ThreadPoolExecutor(max_workers=users) as pool:
+                sessions = list(pool.map(lambda i: login(base, i), range(users)))
+                started = time.perf_counter()
+                total = sum(pool.map(lambda s: user_load(base, s), sessions))
+            elapsed = time.perf_counter() - started
+            results["runs"].append({"shards": count, "requests": total, "seconds": round(elapsed, 2),
+                                    "requests_per_second": round(total / elapsed, 1)})
+
+            if count == shard_counts[-1]:
+                name = f"s{count}"
+                pinned = add_shard(shard_map, directory, name, start_shard(run_dir, name, port + len(procs)))
+                moves = rebalance(shard_map)
+                ok = 0
+                for i in range(users):
+                    r = requests.post(f"{base}/auth/login", json={"username": f"user{i}", "password": "pwd"})
+                    headers = {"Authorization": f"Bearer {r.json()['access_token']}"}
+                    listing = requests.get(f"{base}/files", headers=headers).json()
+                    ok += len(listing) == requests_per_user // 2 and all(
+                        requests.get(f"{base}/files/{f['id']}/download", headers=headers).ok for f in listing[:3])
+                results["rebalance"] = {"added": name, "pinned": pinned, "moved": len(moves),
+                                        "users_intact": ok, "users": users}
+    finally:
+        for proc in procs:
+            proc.terminate()
+        for proc in procs:
+            proc.wait(timeout=30)
+    return results
+
+
+def main(argv=None) -> None:
+    parser = argparse.ArgumentParser(description="Shard routing, user moves and a local scaling harness")
+    sub = parser.add_subparsers(dest="command", required=True)
+    p = sub.add_parser("router")
+    p.add_argument("--bind", default="0.0.0.0:5000")
+    p = sub.add_parser("where")
+    p.add_argument("user_id", type=int)
+    p = sub.add_parser("add")
+    for arg in ("name", "url", "database", "upload_root"):
+        p.add_argument(arg)
+    sub.add_parser("rebalance")
+    p = sub.add_parser("move")
+    p.add_argument("user_id", type=int)
+    p.add_argument("shard")
+    p = sub.add_parser("bench")
+    p.add_argument("--shards", default="1,2,4", help="comma separated shard counts")
+    p.add_argument("--users", type=int, default=24)
+    p.add_argument("--requests", type=int, default=40, help="requests per user")
+    p.add_argument("--dir", default="bench-shards")
+    args = parser.parse_args(argv)
+
+    if args.command == "bench":
+        result: Any = bench(Path(args.dir).resolve(), [int(n) for n in args.shards.split(",")],
+                            users=args.users, requests_per_user=args.requests)
+        print(json.dumps(result, indent=2))
+        return
+    if args.command == "router":
+        from werkzeug.serving import run_simple
+        host, port = args.bind.rsplit(":", 1)
+        run_simple(host, int(port), router_from_env(), threaded=True)
+        return
+
+    shard_map = ShardMap(Path(os.environ["SHARD_MAP"]))
+    if args.command == "where":
+        result = {"user_id": args.user_id, "shard": shard_map.shard_for(args.user_id),
+                  "pinned": str(args.user_id) in shard_map.pins}
+    elif args.command == "add":
+        directory = Directory(os.environ.get("SHARD_DIRECTORY", str(shard_map.path.with_name("directory.db"))))
+        shard = {"url": args.url, "database": args.database, "upload_root": args.upload_root}
+        result = {"added": args.name, "pinned": add_shard(shard_map, directory, args.name, shard)}
+    elif args.command == "rebalance":
+        result = rebalance(shard_map)
+    else:
+        result = move_user(shard_map, args.user_id, args.shard)
+    print(json.dumps(result, ensure_ascii=False, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,146 @@
+"""SQL instrumentation hooked into the engine's cursor events.
+
+    SQL_STATS=1      count statements and time per request; adds ``X-SQL-Queries``,
+                     ``X-SQL-Time-ms`` and ``X-SQL-Max-Repeat`` response headers
+                     (also on when the app runs with ``debug``)
+    SQL_SLOW_MS=50   log statements slower than this to the ``server.sql.slow`` logger
+    SQL_EXPLAIN=1    capture the query plan of every distinct statement once and log
+                     it to ``server.sql.explain`` when it scans a whole table
+
+``X-SQL-Max-Repeat`` is the largest number of times a single statement ran
+in the request, which is how an N+1 loop shows up. Nothing is attached to
+the engine unless one of the switches is on.
+"""
+import logging
+import re
+import threading
+import time
+from collections import Counter
+from typing import Any, Dict, List, Optional
+
+from flask import g, has_request_context
+from sqlalchemy import event
+
+slow_log = logging.getLogger("server.sql.slow")
+explain_log = logging.getLogger("server.sql.explain")
+
+_VIRTUAL_LOOKUP = re.compile(r"VIRTUAL TABLE INDEX \d+:\S")
+
+
+class QueryPlan:
+    def __init__(self, statement: str, lines: List[str], full_scans: List[str]) -> None:
+        self.statement = statement
+        self.lines = lines
+        self.full_scans = full_scans
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {"statement": self.statement, "plan": self.lines, "full_scans": self.full_scans}
+
+
+def full_scans(dialect: str, lines: List[str]) -> List[str]:
+    """Plan lines that read a whole table rather than searching an index."""
+    if dialect == "sqlite":
+        # "SCAN files" is a table scan; "SCAN files USING INDEX ..." walks an index in order;
+        # "SCAN t VIRTUAL TABLE INDEX 0:M0" is a constrained (e.g. FTS MATCH) lookup, "INDEX 0:" is not
+        return [l for l in lines if l.startswith("SCAN ") and " USING " not in l and "CONSTANT ROW" not in l
+                and not _VIRTUAL_LOOKUP.search(l)]
+    if dialect == "postgresql":
+        return [l.strip() for l in lines if "Seq Scan" in l]
+    return []
+
+
+def explain(dbapi_connection, dialect: str, statement: str, parameters) -> Optional[List[str]]:
+    """The plan of ``statement`` as text lines, or None for a dialect we cannot explain."""
+    if dialect == "sqlite":
+        sql, rows_to_lines = "EXPLAIN QUERY PLAN " + statement, lambda rows: [r[3] for r in rows]
+    elif dialect == "postgresql":
+        sql, rows_to_lines = "EXPLAIN " + statement, lambda rows: [r[0] for r in rows]
+    else:
+        return None
+    cursor = dbapi_connection.cursor()
+    try:
+        cursor.execute(sql, parameters)
+        return rows_to_lines(cursor.fetchall())
+    except Exception as e:
+        return [f"explain failed: {e}"]
+    finally:
+        cursor.close()
+
+
+class SqlStats:
+    def __init__(self, engine, per_request: bool, slow_ms: float, explain: bool) -> None:
+        self.dialect = engine.dialect.name
+        self.per_request = per_request
+        self.slow_ms = slow_ms
+        self.explain = explain
+        self.plans: Dict[str, QueryPlan] = {}
+        self._plans_lock = threading.Lock()
+        event.listen(engine, "before_cursor_execute", self._before)
+        event.listen(engine, "after_cursor_execute", self._after)
+
+    def _before(self, conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("sql_started", []).append(time.perf_counter())
+
+    def _after(self, conn, cursor, statement, parameters, context, executemany):
+        elapsed_ms = (time.perf_counter() - conn.info["sql_started"].pop()) * 1000
+        if self.per_request and has_request_context():
+            stats = g.setdefault("sql_stats", {"count": 0, "ms": 0.0, "statements": Counter()})
+            stats["count"] += 1
+            stats["ms"] += elapsed_ms
+            stats["statements"][statement] += 1
+        if self.slow_ms and elapsed_ms >= self.slow_ms:
+            slow_log.warning("%.1f ms: %s %r", elapsed_ms, statement, parameters)
+        if self.explain and not executemany and statement not in self.plans:
+            self._capture_plan(conn, statement, parameters)
+
+    def _capture_plan(self, conn, statement: str, parameters) -> None:
+        head = statement.lstrip().split(None, 1)[0].upper() if statement.strip() else ""
+        if head not in ("SELECT", "UPDATE", "DELETE", "WITH"):
+            return
+        # A raw cursor on the same DBAPI connection, so the plan sees the same
+        # transaction and does not re-enter these event hooks
+        lines = explain(conn.connection.dbapi_connection, self.dialect, statement, parameters)
+        if lines is None:
+            return
+        plan = QueryPlan(statement, lines, full_scans(self.dialect, lines))
+        with self._plans_lock:
+            self.plans[statement] = plan
+        if plan.full_scans:
+            explain_log.warning("full scan (%s): %s", "; ".join(plan.full_scans), statement)
+
+    def scanning_plans(self) -> List[QueryPlan]:
+        with self._plans_lock:
+            return [p for p in self.plans.values() if p.full_scans]
+
+
+def request_summary() -> Optional[Dict[str, Any]]:
+    stats = g.get("sql_stats")
+    if stats is None:
+        return None
+    return {
+        "count": stats["count"],
+        "ms": stats["ms"],
+        "max_repeat": max(stats["statements"].values(), default=0),
+    }
+
+
+def install(app, engine) -> Optional[SqlStats]:
+    per_request = app.config.get("SQL_STATS", False) or app.debug
+    slow_ms = app.config.get("SQL_SLOW_MS", 0.0)
+    explain = app.config.get("SQL_EXPLAIN", False)
+    if not (per_request or slow_ms or explain):
+        return None
+    stats = SqlStats(engine, per_request, slow_ms, explain)
+    app.extensions["sql_stats"] = stats
+
+    if per_request:
+        @app.after_request
+        def add_sql_headers(response):
+            summary = request_summary()
+            if summary is not None:
+                response.headers["X-SQL-Queries"] = str(summary["count"])
+                response.headers["X-SQL-Time-ms"] = f"{summary['ms']:.2f}"
+                response.headers["X-SQL-Max-Repeat"] = str(summary["max_repeat"])
+            return response
+
+    return stats
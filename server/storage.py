@@ -0,0 +1,447 @@
+"""Blob placement across several volumes with N-way replication.
+
+    STORAGE_VOLUMES=/mnt/d1:/mnt/d2:/mnt/d3   directories standing in for disks or nodes
+    STORAGE_REPLICAS=2                         copies of every blob (capped at the volume count)
+
+``FileEntry.disk_path`` stays a path under ``UPLOAD_ROOT``; it is the blob's
+logical name. Its path relative to ``UPLOAD_ROOT`` is placed on volumes by
+rendezvous hashing: every volume gets a score from ``(volume, path)`` and
+the ``replicas`` best-scoring healthy volumes hold a copy. Adding a volume
+only moves the blobs for which it now scores in the top ``replicas``, about
+``replicas / volumes`` of them.
+
+Reads go to one of the existing copies in rotation, so read load spreads
+over the volumes; a missing or failed volume is skipped. Writes go to all
+target volumes and remove the blob's copies on any other volume; a volume
+that is down is replaced by the next in the ranking and the rebalancer
+restores the intended layout later, dropping copies that such a volume
+still holds from before an overwrite:
+
+    python -m server.storage status
+    python -m server.storage rebalance
+
+With ``STORAGE_VOLUMES`` unset the pool has the single volume ``UPLOAD_ROOT``
+and one replica, and physical paths are exactly ``disk_path``. Only then
+does ``STORAGE_PACK_MAX_KB`` apply: blobs up to that size go into
+append-only pack files (``server.packs``) instead of files of their own.
+Packed blobs have no physical path; read them through ``source`` or
+``open``.
+"""
+import argparse
+import hashlib
+import heapq
+import io
+import itertools
+import json
+import logging
+import os
+import threading
+import time
+from pathlib import Path
+from typing import Any, BinaryIO, Callable, Dict, Iterator, List, Optional, Tuple, Union
+
+from sqlalchemy import func, select
+from sqlalchemy.orm import Session
+
+from . import blobs
+from .models import FileEntry
+from .packs import PACK_DIR, PackEntry, PackStore
+
+log = logging.getLogger(__name__)
+
+LAYOUT_FILE = ".storage-layout.json"  # in UPLOAD_ROOT: the volume set the blobs were last balanced for
+
+
+class _Prefixed:
+    """``stream`` with ``head`` (already read from it) put back in front."""
+
+    def __init__(self, head: bytes, stream: BinaryIO) -> None:
+        self.head = head
+        self.stream = stream
+
+    def read(self, n: int = -1) -> bytes:
+        if not self.head:
+            return self.stream.read(n)
+        if n is None or n < 0:
+            data, self.head = self.head + self.stream.read(), b""
+        else:
+            data, self.head = self.head[:n], self.head[n:]
+        return data
+
+
+def _read_up_to(stream: BinaryIO, n: int) -> bytes:
+    parts, left = [], n
+    while left > 0:
+        chunk = stream.read(left)
+        if not chunk:
+            break
+        parts.append(chunk)
+        left -= len(chunk)
+    return b"".join(parts)
+
+
+class StoragePool:
+    def __init__(self, upload_root: str, volumes: Optional[List[str]] = None, replicas: int = 1,
+                 pack_max_bytes: int = 0) -> None:
+        self.upload_root = str(Path(upload_root))
+        self.volumes = [str(Path(v)) for v in (volumes or [upload_root])]
+        self.replicas = max(1, min(replicas, len(self.volumes)))
+        self._turn = itertools.count()
+        if pack_max_bytes and self.pooled:
+            log.warning("pack files are not replicated: STORAGE_PACK_MAX_KB is ignored with several volumes")
+            pack_max_bytes = 0
+        self.pack_max_bytes = pack_max_bytes
+        # packed blobs stay readable after packing is switched off
+        packs_root = os.path.join(self.upload_root, PACK_DIR)
+        self.packs = PackStore(packs_root) if pack_max_bytes or PackStore.present(packs_root) else None
+
+    @classmethod
+    def from_config(cls, config) -> "StoragePool":
+        volumes = [v for v in (config.get("STORAGE_VOLUMES") or "").split(os.pathsep) if v]
+        return cls(config["UPLOAD_ROOT"], volumes or None, config.get("STORAGE_REPLICAS", 1) if volumes else 1,
+                   pack_max_bytes=int(config.get("STORAGE_PACK_MAX_KB", 0) * 1024))
+
+    @property
+    def pooled(self) -> bool:
+        return self.volumes != [self.upload_root]
+
+    def prepare(self) -> None:
+        for volume in self.volumes:
+            Path(volume).mkdir(parents=True, exist_ok=True)
+
+    def healthy(self, volume: str) -> bool:
+        return os.path.isdir(volume)
+
+    def _relative(self, disk_path: str) -> Optional[str]:
+        rel = os.path.relpath(disk_path, self.upload_root)
+        return None if rel.startswith("..") or os.path.isabs(rel) else rel
+
+    def ranking(self, rel: str) -> List[str]:
+        """All volumes, best first, for the blob at ``rel``."""
+        def score(volume: str) -> bytes:
+            return hashlib.sha1(f"{volume}\0{rel}".encode("utf-8")).digest()
+        return sorted(self.volumes, key=score, reverse=True)
+
+    def targets(self, disk_path: str) -> List[str]:
+        """Physical paths that should hold the blob: the best ``replicas`` healthy volumes."""
+        rel = self._relative(disk_path)
+        if rel is None:
+            return [disk_path]  # outside the managed tree (an old absolute path): left where it is
+        healthy = [v for v in self.ranking(rel) if self.healthy(v)]
+        if len(healthy) < len(self.volumes):
+            # placed off its ideal volumes: the next rebalance has to revisit the layout
+            (Path(self.upload_root) / LAYOUT_FILE).unlink(missing_ok=True)
+        return [os.path.join(v, rel) for v in healthy[:self.replicas]]
+
+    def copies(self, disk_path: str) -> List[str]:
+        """Physical paths where the blob currently exists, in ranking order."""
+        rel = self._relative(disk_path)
+        if rel is None:
+            return [disk_path] if os.path.exists(disk_path) else []
+        return [p for p in (os.path.join(v, rel) for v in self.ranking(rel)) if os.path.isfile(p)]
+
+    def packed(self, disk_path: str) -> Optional[PackEntry]:
+        rel = self._relative(disk_path) if self.packs is not None else None
+        return self.packs.get(rel) if rel is not None else None
+
+    def locate(self, disk_path: str, spread: bool = True) -> str:
+        """A readable physical path of a loose blob. With ``spread`` successive reads rotate over the copies."""
+        if not self.pooled:
+            return disk_path
+        found = self.copies(disk_path)
+        if not found:
+            raise FileNotFoundError(disk_path)
+        preferred = found[:self.replicas]
+        return preferred[next(self._turn) % len(preferred)] if spread else found[0]
+
+    def source(self, disk_path: str) -> Union[str, BinaryIO]:
+        """What to read a blob from: its physical path, or an in-memory file for a packed blob.
+
+        Either is accepted by ``send_file``, ``Image.open`` and ``zipfile``.
+        """
+        rel = self._relative(disk_path) if self.packs is not None else None
+        data = self.packs.read(rel) if rel is not None else None
+        return io.BytesIO(data) if data is not None else self.locate(disk_path)
+
+    def open(self, disk_path: str) -> BinaryIO:
+        source = self.source(disk_path)
+        return open(source, "rb") if isinstance(source, str) else source
+
+    def stat(self, disk_path: str) -> Union[os.stat_result, PackEntry]:
+        return self.packed(disk_path) or os.stat(self.locate(disk_path, spread=False))
+
+    def exists(self, disk_path: str) -> bool:
+        if self.packed(disk_path) is not None:
+            return True
+        return os.path.exists(disk_path) if not self.pooled else bool(self.copies(disk_path))
+
+    def write_stream(self, stream: BinaryIO, disk_path: Path,
+                     expected_sha256: Optional[str] = None) -> Tuple[int, str]:
+        """``blobs.write_stream`` to the first target, then copies to the others.
+
+        A blob no larger than ``pack_max_bytes`` is appended to a pack instead.
+        """
+        rel = self._relative(str(disk_path)) if self.pack_max_bytes else None
+        if rel is not None:
+            head = _read_up_to(stream, self.pack_max_bytes + 1)
+            if len(head) <= self.pack_max_bytes:
+                digest = hashlib.sha256(head).hexdigest()
+                if expected_sha256 is not None and digest != expected_sha256:
+                    raise blobs.DigestMismatch(f"expected {expected_sha256}, got {digest}")
+                self.packs.put(rel, head, digest)
+                Path(disk_path).unlink(missing_ok=True)  # an earlier, larger version
+                return len(head), digest
+            stream = _Prefixed(head, stream)
+        if not self.pooled:
+            result = blobs.write_stream(stream, disk_path, expected_sha256)
+        else:
+            first, *others = self.targets(str(disk_path))
+            result = blobs.write_stream(stream, Path(first), expected_sha256)
+            self._replicate(first, others)
+            self._drop_copies_except(str(disk_path), [first, *others])
+        self._drop_packed(str(disk_path))  # an earlier, smaller version
+        return result
+
+    def clone(self, src: str, dest: Path) -> str:
+        """``blobs.clone_file`` per target, from a copy on the same volume when there is one.
+
+        A packed blob is cloned by giving its record a second name in the index.
+        """
+        src_rel, dest_rel = self._relative(src), self._relative(str(dest))
+        if self.packs is not None and src_rel is not None and dest_rel is not None:
+            if self.packs.link(src_rel, dest_rel):
+                Path(dest).unlink(missing_ok=True)
+                return "pack"
+            self._drop_packed(str(dest))
+        if not self.pooled:
+            return blobs.clone_file(src, dest)
+        sources = self.copies(src)
+        if not sources:
+            raise FileNotFoundError(src)
+        method = ""
+        targets = self.targets(str(dest))
+        for target in targets:
+            volume = self._volume_of(target)
+            local = next((s for s in sources if self._volume_of(s) == volume), None)
+            # a hard link between two copies on one volume is fine; across copies it is not
+            method = blobs.clone_file(local or sources[0], Path(target), allow_link=local is not None)
+        self._drop_copies_except(str(dest), targets)
+        return method
+
+    def remove(self, disk_path: str) -> None:
+        """Delete every copy; raises the first ``OSError`` other than a missing file."""
+        self._drop_packed(disk_path)
+        paths = self.copies(disk_path) if self.pooled else [disk_path]
+        for path in paths:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def _drop_packed(self, disk_path: str) -> None:
+        if self.packed(disk_path) is not None:
+            self.packs.remove(self._relative(disk_path))
+
+    def _drop_copies_except(self, disk_path: str, keep: List[str]) -> None:
+        """Remove copies outside ``keep``: they hold an earlier version and would be served as current."""
+        for path in self.copies(disk_path):
+            if path not in keep:
+                try:
+                    os.remove(path)
+                except OSError as e:
+                    log.warning("cannot remove outdated copy %s: %s", path, e)
+
+    def _split_stale(self, found: List[str], content_hash: str) -> Tuple[List[str], List[str]]:
+        """``(current, stale)`` copies of one blob.
+
+        A copy is stale when it lacks ``content_hash`` and is older than every
+        copy that has it; a copy newer than those is a write still in
+        progress (the row is updated after the blob) and is left alone.
+        """
+        hashes = {path: _sha256_of(path) for path in found}
+        matching = [path for path in found if hashes[path] == content_hash]
+        if not matching:
+            return found, []
+        oldest = min(os.stat(path).st_ctime_ns for path in matching)
+        stale = [path for path in found if hashes[path] != content_hash and os.stat(path).st_ctime_ns < oldest]
+        return [path for path in found if path not in stale], stale
+
+    def _volume_of(self, path: str) -> Optional[str]:
+        return next((v for v in self.volumes if path.startswith(v + os.sep)), None)
+
+    def _replicate(self, source: str, targets: List[str]) -> int:
+        made = 0
+        for target in targets:
+            try:
+                blobs.clone_file(source, Path(target), allow_link=False)
+                made += 1
+            except OSError as e:
+                log.warning("cannot replicate %s to %s: %s", source, target, e)
+        return made
+
+    def walk(self) -> Iterator[Tuple[str, str, Union[os.stat_result, PackEntry]]]:
+        """``(disk_path, physical path, stat)`` for every file on every volume, in ``disk_path`` order.
+
+        Packed blobs come from the pack index, with their ``disk_path`` as the
+        physical path and a ``PackEntry`` as the stat.
+        """
+        from .reaper import walk_sorted
+
+        def on_volume(volume: str):
+            for path, st in walk_sorted(volume):
+                rel = os.path.relpath(path, volume)
+                if rel.split(os.sep, 1)[0] != PACK_DIR and os.path.basename(rel) not in (
+                        LAYOUT_FILE, ".storage-rebalance.lock"):
+                    yield os.path.join(self.upload_root, rel), path, st
+
+        def packed():
+            for entry in self.packs.walk():
+                disk_path = os.path.join(self.upload_root, entry.path)
+                yield disk_path, disk_path, entry
+
+        sources = [on_volume(v) for v in self.volumes] + ([packed()] if self.packs is not None else [])
+        return heapq.merge(*sources, key=lambda item: item[0])
+
+    # -- rebalancing ----------------------------------------------------------
+
+    def layout(self) -> Dict[str, Any]:
+        return {"volumes": sorted(self.volumes), "replicas": self.replicas}
+
+    def needs_rebalance(self) -> bool:
+        if not self.pooled:
+            return False
+        try:
+            stored = json.loads((Path(self.upload_root) / LAYOUT_FILE).read_text(encoding="utf-8"))
+        except (OSError, ValueError):
+            return True
+        return stored != self.layout()
+
+    def rebalance(self, session_factory: Callable[[], Session], batch_size: int = 1000) -> Dict[str, Any]:
+        """Bring every live blob to its target volumes, then drop copies elsewhere.
+
+        A copy is only removed once all targets hold the blob, so an
+        interrupted run never leaves fewer copies than it found. When a blob
+        has several copies they are hashed and compared with the row's
+        ``content_hash`` first: a volume that was down during an overwrite
+        comes back with the old version, which is removed (``stale``) and
+        replaced from a current copy.
+        """
+        report = {"blobs": 0, "copied": 0, "removed": 0, "stale": 0, "under_replicated": 0, "lost": [],
+                  "seconds": 0.0}
+        started = time.monotonic()
+        last = ""
+        while True:
+            db = session_factory()
+            try:
+                rows = db.execute(
+                    select(FileEntry.disk_path, func.max(FileEntry.content_hash))
+                    .where(FileEntry.deleted_at.is_(None), FileEntry.disk_path > last)
+                    .group_by(FileEntry.disk_path).order_by(FileEntry.disk_path).limit(batch_size)
+                ).all()
+            finally:
+                db.close()
+            if not rows:
+                break
+            last = rows[-1][0]
+            for disk_path, content_hash in rows:
+                if self._relative(disk_path) is None or self.packed(disk_path) is not None:
+                    continue
+                report["blobs"] += 1
+                found = self.copies(disk_path)
+                if not found:
+                    if len(report["lost"]) < 100:
+                        report["lost"].append(disk_path)
+                    continue
+                if content_hash and len(found) > 1:
+                    found, stale = self._split_stale(found, content_hash)
+                    for path in stale:
+                        try:
+                            os.remove(path)
+                            report["stale"] += 1
+                        except OSError as e:
+                            log.warning("cannot remove stale copy %s: %s", path, e)
+                targets = self.targets(disk_path)
+                report["copied"] += self._replicate(found[0], [t for t in targets if t not in found])
+                if not all(os.path.isfile(t) for t in targets) or len(targets) < self.replicas:
+                    report["under_replicated"] += 1
+                    continue
+                for extra in set(found) - set(targets):
+                    try:
+                        os.remove(extra)
+                        report["removed"] += 1
+                    except OSError as e:
+                        log.warning("cannot remove surplus copy %s: %s", extra, e)
+        report["seconds"] = round(time.monotonic() - started, 3)
+        if not report["lost"] and not report["under_replicated"]:
+            marker = Path(self.upload_root) / LAYOUT_FILE
+            marker.parent.mkdir(parents=True, exist_ok=True)
+            marker.write_text(json.dumps(self.layout()), encoding="utf-8")
+        return report
+
+    def status(self) -> Dict[str, Any]:
+        volumes = []
+        for volume in self.volumes:
+            entry: Dict[str, Any] = {"path": volume, "healthy": self.healthy(volume)}
+            if entry["healthy"]:
+                usage = os.statvfs(volume)
+                entry["free_bytes"] = usage.f_bavail * usage.f_frsize
+            volumes.append(entry)
+        result = {"replicas": self.replicas, "volumes": volumes, "needs_rebalance": self.needs_rebalance()}
+        if self.packs is not None:
+            result["packs"] = {"max_blob_bytes": self.pack_max_bytes, **self.packs.stats()}
+        return result
+
+
+def _sha256_of(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(blobs.COPY_CHUNK), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def start_rebalancer(pool: StoragePool, session_factory: Callable[[], Session]) -> threading.Thread:
+    """Rebalance once in a daemon thread (used at startup after the volume set changed).
+
+    Every worker process calls this; a lock file lets only one of them run it.
+    """
+    def run():
+        import fcntl
+
+        with open(Path(pool.upload_root) / ".storage-rebalance.lock", "w") as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                return  # another worker is rebalancing
+            try:
+                report = pool.rebalance(session_factory)
+                log.info("storage rebalance: %s", report)
+            except Exception:
+                log.exception("storage rebalance failed")
+
+    thread = threading.Thread(target=run, name="storage-rebalancer", daemon=True)
+    thread.start()
+    return thread
+
+
+def main(argv=None) -> None:
+    parser = argparse.ArgumentParser(description="Inspect and rebalance the storage volumes, compact the packs")
+    parser.add_argument("command", choices=["status", "rebalance", "compact"])
+    parser.add_argument("--batch", type=int, default=1000)
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO)
+
+    from .app import create_app
+    app = create_app(background_jobs=False)
+    pool: StoragePool = app.extensions["storage"]
+    if args.command == "status":
+        result = pool.status()
+    elif args.command == "compact":
+        result = pool.packs.compact() if pool.packs is not None else {"packs": 0, "moved": 0, "reclaimed_bytes": 0}
+    else:
+        result = pool.rebalance(app.extensions["db_session"].session_factory, batch_size=args.batch)
+    print(json.dumps(result, ensure_ascii=False, indent=2))
+
+
+if __name__ == "__main__":
+    main()
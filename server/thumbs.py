@@ -0,0 +1,90 @@
+"""Small JPEG thumbnails of images, cached on disk and served many at a time.
+
+A thumbnail is built once per file version and size and cached as
+``<cache_root>/thumbs/<file_id>-<version>-<size>.jpg`` (the ``<file_id>-``
+prefix lets ``reaper.purge_derived`` drop it with the file's other
+derivatives). JPEG sources are decoded at reduced scale (``Image.draft``),
+so a thumbnail of a 24 MP photo never decodes the full image.
+
+``POST /files/thumbnails`` returns a batch either as one sprite sheet plus
+the position of every thumbnail in it, or as a ``multipart/mixed`` stream
+with one JPEG part per file.
+"""
+import io
+import math
+import os
+import tempfile
+from pathlib import Path
+from typing import Any, BinaryIO, Dict, Iterable, Iterator, List, Tuple, Union
+
+from PIL import Image, ImageOps
+
+SIZES = (64, 128, 256)  # longest side in pixels
+MAX_IDS = 500  # per request
+QUALITY = 80
+# Pillow's own DecompressionBombError threshold, checked here as well because
+# tiles raises Pillow's (process-wide) limit while it opens a pyramid source
+MAX_PIXELS = 2 * 89_478_485
+SPRITE_BACKGROUND = (255, 255, 255)
+
+
+def thumb_path(cache_root: str, file_id: int, version: str, size: int) -> Path:
+    return Path(cache_root) / "thumbs" / f"{file_id}-{version}-{size}.jpg"
+
+
+def render(source: Union[str, BinaryIO], size: int) -> bytes:
+    with Image.open(source) as img:
+        if img.width * img.height > MAX_PIXELS:
+            raise Image.DecompressionBombError(f"{img.width}x{img.height} is too large for a thumbnail")
+        img.draft("RGB", (size, size))  # JPEG: decode at 1/2, 1/4 or 1/8 scale when that is enough
+        img = ImageOps.exif_transpose(img).convert("RGB")
+    img.thumbnail((size, size))
+    out = io.BytesIO()
+    img.save(out, "JPEG", quality=QUALITY)
+    return out.getvalue()
+
+
+def ensure_thumbnail(source: Union[str, BinaryIO], target: Path, size: int) -> bytes:
+    """The cached thumbnail at ``target``, rendered from ``source`` first if missing.
+
+    Written to a temporary file and renamed into place, so concurrent
+    workers never read a partial JPEG; a lost race just renders twice.
+    """
+    try:
+        return target.read_bytes()
+    except FileNotFoundError:
+        pass
+    data = render(source, size)
+    target.parent.mkdir(parents=True, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(prefix=target.name + ".", dir=target.parent)
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp, target)
+    except OSError:
+        Path(tmp).unlink(missing_ok=True)
+    return data
+
+
+def sprite(thumbs: List[Tuple[int, bytes]], size: int) -> Tuple[bytes, Dict[str, Any]]:
+    """Pack thumbnails into a grid of ``size`` x ``size`` cells; returns the JPEG and its map."""
+    columns = max(1, math.ceil(math.sqrt(len(thumbs))))
+    rows = max(1, math.ceil(len(thumbs) / columns))
+    sheet = Image.new("RGB", (columns * size, rows * size), SPRITE_BACKGROUND)
+    cells = []
+    for i, (file_id, data) in enumerate(thumbs):
+        with Image.open(io.BytesIO(data)) as img:
+            x, y = (i % columns) * size, (i // columns) * size
+            sheet.paste(img, (x, y))
+            cells.append({"id": file_id, "x": x, "y": y, "width": img.width, "height": img.height})
+    out = io.BytesIO()
+    sheet.save(out, "JPEG", quality=QUALITY)
+    return out.getvalue(), {"width": sheet.width, "height": sheet.height, "thumbnails": cells}
+
+
+def multipart(parts: Iterable[Tuple[Dict[str, str], bytes]], boundary: str) -> Iterator[bytes]:
+    """``multipart/mixed`` body from ``(headers, body)`` pairs, yielded part by part."""
+    for headers, body in parts:
+        head = "".join(f"{k}: {v}\r\n" for k, v in {**headers, "Content-Length": str(len(body))}.items())
+        yield f"--{boundary}\r\n{head}\r\n".encode("latin-1") + body + b"\r\n"
+    yield f"--{boundary}--\r\n".encode("latin-1")
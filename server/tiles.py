@@ -0,0 +1,176 @@
+"""Deep-zoom tile pyramids for large images.
+
+The pyramid for a file version is built on first access and cached under
+``<cache_root>/tiles/<file_id>-<version>/``::
+
+    manifest.json
+    <level>/<x>_<y>.jpg
+
+Level ``max_level`` is the original resolution; each lower level halves both
+sides (rounding up) down to a 1x1 image at level 0, the same layout Deep
+Zoom / OpenSeadragon viewers use.
+"""
+import json
+import math
+import os
+import shutil
+import tempfile
+import threading
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, BinaryIO, Dict, Iterator, List, Union
+
+from PIL import Image
+
+TILE_SIZE = 256
+TILE_QUALITY = 85
+IMAGE_EXTENSIONS = {".jpg", ".jpeg", ".png"}
+
+# Pillow refuses images above ~179 MP by default; tiling exists precisely for those,
+# so the limit is raised to this while a pyramid source is opened (and only then)
+MAX_PIXELS = 1_000_000_000
+# Source pixels decoded at once by all builds in a process (~3 bytes each)
+BUILD_PIXEL_BUDGET = 300_000_000
+
+_limit_lock = threading.Lock()
+_builds: Dict[Path, List[Any]] = {}  # target -> [lock, number of threads using it]
+_builds_lock = threading.Lock()
+_decoding = [0]  # source pixels held by the builds running now
+_decoding_changed = threading.Condition()
+
+
+def pyramid_dir(cache_root: str, file_id: int, version: str) -> Path:
+    return Path(cache_root) / "tiles" / f"{file_id}-{version}"
+
+
+def level_sizes(width: int, height: int):
+    max_level = math.ceil(math.log2(max(width, height, 1)))
+    return [
+        (math.ceil(width / 2 ** (max_level - level)), math.ceil(height / 2 ** (max_level - level)))
+        for level in range(max_level + 1)
+    ]
+
+
+@contextmanager
+def building(target: Path) -> Iterator[None]:
+    """Hold the build lock of ``target``; builds of different targets run in parallel."""
+    with _builds_lock:
+        entry = _builds.setdefault(target, [threading.Lock(), 0])
+        entry[1] += 1
+    try:
+        with entry[0]:
+            yield
+    finally:
+        with _builds_lock:
+            entry[1] -= 1
+            if not entry[1]:
+                del _builds[target]
+
+
+@contextmanager
+def pixel_budget(pixels: int) -> Iterator[None]:
+    """Wait until ``pixels`` fit in ``BUILD_PIXEL_BUDGET`` next to the builds running now.
+
+    A source larger than the whole budget is built once nothing else is.
+    """
+    with _decoding_changed:
+        _decoding_changed.wait_for(lambda: not _decoding[0] or _decoding[0] + pixels <= BUILD_PIXEL_BUDGET)
+        _decoding[0] += pixels
+    try:
+        yield
+    finally:
+        with _decoding_changed:
+            _decoding[0] -= pixels
+            _decoding_changed.notify_all()
+
+
+def _open_large(source: Union[str, BinaryIO]) -> Image.Image:
+    """``Image.open`` with Pillow's pixel limit at ``MAX_PIXELS`` for this call only.
+
+    Pillow checks the limit (a module global) when the header is read, so it
+    is restored before any pixel is decoded.
+    """
+    with _limit_lock:
+        default = Image.MAX_IMAGE_PIXELS
+        Image.MAX_IMAGE_PIXELS = MAX_PIXELS
+        try:
+            return Image.open(source)
+        finally:
+            Image.MAX_IMAGE_PIXELS = default
+
+
+def ensure_pyramid(source: Union[str, BinaryIO], target: Path) -> Dict[str, Any]:
+    """Return the manifest for ``target``, building the pyramid from ``source`` if needed.
+
+    Tiles are written to a temporary sibling directory that is renamed into
+    place when complete, so readers in other workers never see a half-built
+    pyramid; a lost race just discards the duplicate.
+    """
+    manifest_path = target / "manifest.json"
+    if manifest_path.exists():
+        return json.loads(manifest_path.read_text(encoding="utf-8"))
+
+    with building(target):
+        if manifest_path.exists():
+            return json.loads(manifest_path.read_text(encoding="utf-8"))
+        target.parent.mkdir(parents=True, exist_ok=True)
+        tmp = Path(tempfile.mkdtemp(prefix=target.name + ".", dir=target.parent))
+        try:
+            manifest = _build(source, tmp)
+            try:
+                os.rename(tmp, target)
+            except OSError:
+                if not manifest_path.exists():
+                    raise
+        finally:
+            if tmp.exists():
+                shutil.rmtree(tmp, ignore_errors=True)
+    return manifest
+
+
+def _decode(img: Image.Image) -> Image.Image:
+    """The decoded source with no second full-size copy where it can be avoided.
+
+    JPEGs are decoded straight to RGB (``draft``) and RGB or greyscale
+    pixels are used as they are; tiles are converted one at a time.
+    """
+    img.draft("RGB", img.size)
+    img.load()
+    if img.mode in ("RGB", "L"):
+        return img
+    converted = img.convert("RGB")
+    img.close()
+    return converted
+
+
+def _build(source: Union[str, BinaryIO], out: Path) -> Dict[str, Any]:
+    with _open_large(source) as opened:
+        width, height = opened.size
+        sizes = level_sizes(width, height)
+        with pixel_budget(width * height):
+            img = _decode(opened)
+            for level in range(len(sizes) - 1, -1, -1):
+                if img.size != sizes[level]:
+                    smaller = img.reduce(2)
+                    img.close()  # only one full-size level is held at a time
+                    img = smaller
+                level_dir = out / str(level)
+                level_dir.mkdir()
+                w, h = img.size
+                for x in range(math.ceil(w / TILE_SIZE)):
+                    for y in range(math.ceil(h / TILE_SIZE)):
+                        box = (x * TILE_SIZE, y * TILE_SIZE, min((x + 1) * TILE_SIZE, w), min((y + 1) * TILE_SIZE, h))
+                        img.crop(box).convert("RGB").save(level_dir / f"{x}_{y}.jpg", "JPEG", quality=TILE_QUALITY)
+            img.close()
+
+    manifest = {
+        "width": width,
+        "height": height,
+        "tile_size": TILE_SIZE,
+        "overlap": 0,
+        "format": "jpg",
+        "max_level": len(sizes) - 1,
+        "levels": [{"level": i, "width": w, "height": h} for i, (w, h) in enumerate(sizes)],
+    }
+    (out / "manifest.json").write_text(json.dumps(manifest), encoding="utf-8")
+    return manifest
@@ -0,0 +1,44 @@
+import pytest
+
+from server.app import create_app
+
+
+@pytest.fixture
+def server_env(tmp_path, monkeypatch):
+    """Point the server at a data directory (``tmp_path`` unless given); undone after the test.
+
+    Returns a function that re-points it, e.g. at a restored copy or a second shard.
+    """
+    def point(root=tmp_path, database=None):
+        root.mkdir(parents=True, exist_ok=True)
+        monkeypatch.setenv("UPLOAD_ROOT", str(root / "uploads"))
+        monkeypatch.setenv("DATABASE_URL", database or f"sqlite:///{root / 'app.db'}")
+        monkeypatch.setenv("CACHE_ROOT", str(root / "cache"))
+        monkeypatch.setenv("JWT_SECRET_KEY", "test-secret")
+        return root
+
+    point()
+    return point
+
+
+@pytest.fixture
+def make_app(server_env):
+    """``create_app`` without background threads, on the current ``server_env`` (or on ``root``)."""
+    def make(root=None, **kwargs):
+        if root is not None:
+            server_env(root)
+        kwargs.setdefault("background_jobs", False)
+        return create_app(**kwargs)
+
+    return make
+
+
+@pytest.fixture
+def login():
+    """Register ``username`` (if needed) and return its auth headers."""
+    def login(client, username="tester", password="pwd"):
+        client.post("/auth/register", json={"username": username, "password": password})
+        r = client.post("/auth/login", json={"username": username, "password": password})
+        return {"Authorization": f"Bearer {r.get_json()['access_token']}"}
+
+    return login
@@ -1,10 +1,15 @@
+import io
 import os
 import json
+import sqlite3
 from pathlib import Path
 
 import pytest
+from sqlalchemy.orm import Session
 
 from server.app import create_app
+from server.collection import read_stats
+from server.models import create_db_engine, init_db
 
 
 @pytest.fixture(scope="module")
@@ -12,6 +17,7 @@ def client(tmp_path_factory):
     tmpdir = tmp_path_factory.mktemp("data")
     os.environ["UPLOAD_ROOT"] = str(tmpdir / "uploads")
     os.environ["DATABASE_URL"] = f"sqlite:///{tmpdir / 'app.db'}"
+    os.environ["CACHE_ROOT"] = str(tmpdir / "cache")
     os.environ["JWT_SECRET_KEY"] = "test-secret"
     os.environ["TESTING"] = "True"
     app = create_app()
@@ -74,3 +80,463 @@ def test_delete_file(client, tmp_path):
     assert r.status_code == 404
 
 
+
+
+def test_stats_follow_upload_and_delete(client, tmp_path):
+    headers = register_and_login(client)
+    before = client.get("/files/stats", headers=headers).get_json()
+
+    f1 = tmp_path / "notes.txt"
+    f1.write_text("0123456789", encoding="utf-8")
+    with open(f1, 'rb') as f:
+        r = client.post("/files", headers=headers, data={"file": (f, "notes.txt")})
+    fid = r.get_json()["id"]
+
+    stats = client.get("/files/stats", headers=headers).get_json()
+    txt = next(x for x in stats["extensions"] if x["extension"] == ".txt")
+    assert txt == {"extension": ".txt", "count": 1, "bytes": 10}
+    assert stats["total"]["count"] == before["total"]["count"] + 1
+    assert stats["uploaders"][0]["uploader"] == "alice"
+    assert stats["newest_updated_at"]
+
+    r = client.get("/files", headers=headers, query_string={"type": "txt"})
+    assert [x["name"] for x in r.get_json()] == ["notes.txt"]
+
+    client.delete(f"/files/{fid}", headers=headers)
+    stats = client.get("/files/stats", headers=headers).get_json()
+    assert all(x["extension"] != ".txt" for x in stats["extensions"])
+    assert stats["total"] == before["total"]
+
+
+def test_upgrade_backfills_sizes(tmp_path):
+    # a database from before files.size and file_stats existed
+    blob = tmp_path / "old.py"
+    blob.write_bytes(b"print('old')\n")
+    conn = sqlite3.connect(tmp_path / "old.db")
+    conn.executescript("""
+        CREATE TABLE users (id INTEGER PRIMARY KEY, username VARCHAR(150) NOT NULL,
+                            password_hash VARCHAR(200) NOT NULL);
+        CREATE TABLE files (id INTEGER PRIMARY KEY, owner_id INTEGER NOT NULL, uploader_id INTEGER NOT NULL,
+                            editor_id INTEGER NOT NULL, name VARCHAR(255) NOT NULL, extension VARCHAR(10) NOT NULL,
+                            disk_path TEXT NOT NULL, created_at DATETIME NOT NULL, updated_at DATETIME NOT NULL);
+        INSERT INTO users VALUES (1, 'old', 'x');
+    """)
+    conn.execute("INSERT INTO files VALUES (1, 1, 1, 1, 'old.py', '.py', ?, '2024-01-01', '2024-01-01')", (str(blob),))
+    conn.execute("INSERT INTO files VALUES (2, 1, 1, 1, 'gone.py', '.py', ?, '2024-01-01', '2024-01-01')",
+                 (str(tmp_path / "gone.py"),))
+    conn.commit()
+    conn.close()
+
+    engine = create_db_engine(f"sqlite:///{tmp_path / 'old.db'}")
+    init_db(engine)
+    with engine.connect() as conn:
+        assert dict(conn.exec_driver_sql("SELECT id, size FROM files").all()) == {1: 13, 2: 0}
+    with Session(engine) as db:
+        assert read_stats(db, 1)["total"] == {"count": 2, "bytes": 13}
+
+
+def test_listing_etag_revalidation(client, tmp_path):
+    headers = register_and_login(client)
+    r = client.get("/files", headers=headers, query_string={"type": "py"})
+    etag = r.headers["ETag"]
+    assert etag
+
+    r = client.get("/files", headers={**headers, "If-None-Match": etag}, query_string={"type": "py"})
+    assert r.status_code == 304
+    assert r.headers["ETag"] == etag
+
+    # different query -> different validator
+    r = client.get("/files", headers={**headers, "If-None-Match": etag}, query_string={"type": "jpg"})
+    assert r.status_code == 200
+
+    f1 = tmp_path / "etag.py"
+    f1.write_text("x = 2\n", encoding="utf-8")
+    with open(f1, 'rb') as f:
+        client.post("/files", headers=headers, data={"file": (f, "etag.py")})
+    r = client.get("/files", headers={**headers, "If-None-Match": etag}, query_string={"type": "py"})
+    assert r.status_code == 200
+    assert r.headers["ETag"] != etag
+
+
+def test_image_tile_pyramid(client, tmp_path):
+    from PIL import Image
+
+    headers = register_and_login(client)
+    src = tmp_path / "big.jpg"
+    Image.new("RGB", (600, 300), (200, 30, 30)).save(src, "JPEG")
+    with open(src, 'rb') as f:
+        fid = client.post("/files", headers=headers, data={"file": (f, "big.jpg")}).get_json()["id"]
+
+    r = client.get(f"/files/{fid}/tiles", headers=headers)
+    assert r.status_code == 200
+    manifest = r.get_json()
+    assert (manifest["width"], manifest["height"]) == (600, 300)
+    assert manifest["max_level"] == 10
+    assert manifest["levels"][-1] == {"level": 10, "width": 600, "height": 300}
+    assert manifest["levels"][0] == {"level": 0, "width": 1, "height": 1}
+
+    r = client.get(f"/files/{fid}/tiles/10/2_1.jpg", headers=headers)
+    assert r.status_code == 200
+    tile = Image.open(io.BytesIO(r.data))
+    assert tile.size == (600 - 512, 300 - 256)
+
+    assert client.get(f"/files/{fid}/tiles/10/3_0.jpg", headers=headers).status_code == 404
+
+
+def test_change_feed_long_poll(client, tmp_path):
+    import threading
+
+    headers = register_and_login(client)
+    start = client.get("/files/events", headers=headers, query_string={"wait": 0}).get_json()
+    assert start["events"] == []
+
+    result = {}
+
+    def poll():
+        c = client.application.test_client()
+        result["r"] = c.get("/files/events", headers=headers, query_string={"since": start["last_id"], "wait": 10})
+
+    waiter = threading.Thread(target=poll)
+    waiter.start()
+    f1 = tmp_path / "pushed.py"
+    f1.write_text("y = 1\n", encoding="utf-8")
+    with open(f1, 'rb') as f:
+        fid = client.post("/files", headers=headers, data={"file": (f, "pushed.py")}).get_json()["id"]
+    waiter.join(5)
+    assert not waiter.is_alive()
+
+    feed = result["r"].get_json()
+    assert [(e["kind"], e["file_id"], e["name"]) for e in feed["events"]] == [("created", fid, "pushed.py")]
+
+    client.delete(f"/files/{fid}", headers=headers)
+    feed = client.get("/files/events", headers=headers, query_string={"since": feed["last_id"], "wait": 0}).get_json()
+    assert [(e["kind"], e["file_id"]) for e in feed["events"]] == [("deleted", fid)]
+
+
+def test_change_feed_inputs_and_waiter_cap(monkeypatch, make_app, login):
+    monkeypatch.setenv("EVENTS_MAX_WAITERS", "1")
+    app = make_app()
+    c = app.test_client()
+    headers = login(c)
+    for bad in ({"wait": "abc"}, {"wait": "nan"}, {"since": "x"}, {"since": "-3"}):
+        assert c.get("/files/events", headers=headers, query_string=bad).status_code == 400
+    r = c.get("/files/events", headers=headers | {"Last-Event-ID": "oops"}, query_string={"wait": 0})
+    assert r.status_code == 400
+    assert c.get("/files/events", headers=headers, query_string={"wait": -1}).status_code == 200  # clamped to 0
+
+    sse = headers | {"Accept": "text/event-stream"}
+    first = c.get("/files/events", headers=sse, buffered=False)
+    assert first.status_code == 200
+    busy = c.get("/files/events", headers=sse, buffered=False)
+    assert busy.status_code == 503 and busy.headers["Retry-After"]
+    assert c.get("/files/events", headers=headers, query_string={"wait": 0}).status_code == 200  # holds no thread
+    first.close()
+    second = c.get("/files/events", headers=sse, buffered=False)
+    assert second.status_code == 200
+    second.close()
+
+    # after an idle spell the broker starts from the newest event, not where it stopped
+    broker = app.extensions["event_broker"]
+    for i in range(3):
+        c.post("/files", headers=headers, data={"file": (io.BytesIO(b"x"), f"idle{i}.py")})
+    sub = broker.subscribe(1, 0)
+    assert broker._last_id == c.get("/files/events", headers=headers, query_string={"since": 0, "wait": 0}
+                                    ).get_json()["last_id"]
+    broker.unsubscribe(sub)
+
+
+def test_hash_first_upload(client, tmp_path):
+    import hashlib
+
+    headers = register_and_login(client)
+    body = b"instant = True\n" * 100
+    digest = hashlib.sha256(body).hexdigest()
+    check = {"name": "instant.py", "size": len(body), "sha256": digest}
+
+    r = client.post("/files/check", headers=headers, json=check)
+    assert r.status_code == 200 and r.get_json()["status"] == "upload"
+    token = r.get_json()["upload_token"]
+    r = client.post("/files", headers=headers,
+                    data={"file": (io.BytesIO(b"tampered\n"), "instant.py"), "upload_token": token})
+    assert r.status_code == 400
+    r = client.post("/files", headers=headers,
+                    data={"file": (io.BytesIO(body), "instant.py"), "upload_token": token})
+    assert r.status_code == 201 and r.get_json()["sha256"] == digest
+
+    # same content again: nothing to send
+    r = client.post("/files/check", headers=headers, json=check)
+    assert r.get_json()["status"] == "exists"
+    r = client.post("/files/check", headers=headers, json=dict(check, name="copy.py"))
+    assert r.status_code == 201 and r.get_json()["status"] == "linked"
+    fid = r.get_json()["file"]["id"]
+    assert client.get(f"/files/{fid}/download", headers=headers).data == body
+
+
+def test_check_after_reupload_sees_new_content(client):
+    import hashlib
+
+    headers = register_and_login(client)
+    first = client.post("/files", headers=headers, data={"file": (io.BytesIO(b"v1\n"), "x.py")}).get_json()
+    count = client.get("/files/stats", headers=headers).get_json()["total"]["count"]
+    second = client.post("/files", headers=headers, data={"file": (io.BytesIO(b"v2\n"), "x.py")}).get_json()
+    assert second["id"] == first["id"] and second["sha256"] == hashlib.sha256(b"v2\n").hexdigest()
+    assert client.get("/files/stats", headers=headers).get_json()["total"]["count"] == count
+
+    # the server no longer holds v1 under any name
+    old = {"name": "x.py", "size": 3, "sha256": hashlib.sha256(b"v1\n").hexdigest()}
+    assert client.post("/files/check", headers=headers, json=old).get_json()["status"] == "upload"
+    assert client.post("/files/check", headers=headers, json=dict(old, name="y.py")).get_json()["status"] == "upload"
+    new = dict(old, sha256=second["sha256"])
+    assert client.post("/files/check", headers=headers, json=new).get_json()["status"] == "exists"
+    r = client.post("/files/check", headers=headers, json=dict(new, name="y.py"))
+    assert r.get_json()["status"] == "linked" and r.get_json()["file"]["sha256"] == new["sha256"]
+    assert client.get(f"/files/{r.get_json()['file']['id']}/download", headers=headers).data == b"v2\n"
+
+
+def test_preview_served_from_memory_cache(client):
+    headers = register_and_login(client)
+    r = client.post("/files", headers=headers, data={"file": (io.BytesIO("x = 'привіт'\n".encode()), "hot.py")})
+    fid = r.get_json()["id"]
+    before = client.get("/cache/stats", headers=headers).get_json()
+    first = client.get(f"/files/{fid}/preview", headers=headers)
+    second = client.get(f"/files/{fid}/preview", headers=headers)
+    assert first.get_json() == second.get_json()
+    assert first.get_json()["content"] == "x = 'привіт'\n"
+    after = client.get("/cache/stats", headers=headers).get_json()
+    assert after["hits"] == before["hits"] + 1 and after["entries"] == before["entries"] + 1
+
+
+def test_server_side_copy_and_move(client):
+    headers = register_and_login(client)
+    client.post("/auth/register", json={"username": "bruno", "password": "pwd"})
+    r = client.post("/files", headers=headers, data={"file": (io.BytesIO(b"payload = 1\n"), "orig.py")})
+    fid = r.get_json()["id"]
+
+    r = client.post(f"/files/{fid}/copy", headers=headers, json={"name": "dup.py"})
+    assert r.status_code == 201 and r.get_json()["method"] in ("link", "reflink", "copy_file_range", "sendfile", "copy")
+    dup = r.get_json()["id"]
+    assert client.post(f"/files/{fid}/copy", headers=headers, json={"name": "dup.py"}).status_code == 409
+
+    r = client.post(f"/files/{dup}/move", headers=headers, json={"name": "renamed.py"})
+    assert r.status_code == 200 and r.get_json()["name"] == "renamed.py"
+    assert client.get(f"/files/{dup}/download", headers=headers).data == b"payload = 1\n"
+
+    count = client.get("/files/stats", headers=headers).get_json()["total"]["count"]
+    r = client.post(f"/files/{dup}/move", headers=headers, json={"to_user": "bruno"})
+    assert r.status_code == 200
+    assert client.get(f"/files/{dup}/download", headers=headers).status_code == 404
+    assert client.get("/files/stats", headers=headers).get_json()["total"]["count"] == count - 1
+    assert client.get(f"/files/{fid}/download", headers=headers).data == b"payload = 1\n"
+
+
+def test_paged_text_and_document_previews(client):
+    import zipfile
+
+    headers = register_and_login(client)
+    source = "".join(f"line_{i} = {i}\n" for i in range(25))
+    r = client.post("/files", headers=headers, data={"file": (io.BytesIO(source.encode()), "long.py")})
+    fid = r.get_json()["id"]
+    r = client.get(f"/files/{fid}/preview", headers=headers, query_string={"page": 2, "page_size": 10})
+    body = r.get_json()
+    assert body["pages"] == 3 and body["content"].splitlines()[0] == "line_10 = 10"
+
+    w = 'xmlns:w="http://schemas.openxmlformats.org/wordprocessingml/2006/main"'
+    xml = (f'<w:document {w}><w:body>'
+           '<w:p><w:r><w:t>Звіт</w:t></w:r></w:p>'
+           '<w:p><w:r><w:t>перша сторінка</w:t><w:br w:type="page"/></w:r></w:p>'
+           '<w:p><w:r><w:t>друга</w:t></w:r></w:p></w:body></w:document>')
+    docx = io.BytesIO()
+    with zipfile.ZipFile(docx, "w") as z:
+        z.writestr("word/document.xml", xml)
+    docx.seek(0)
+    r = client.post("/files", headers=headers, data={"file": (docx, "report.docx")})
+    fid = r.get_json()["id"]
+    body = client.get(f"/files/{fid}/preview", headers=headers).get_json()
+    assert body["format"] == "docx" and body["source_pages"] == 2
+    assert body["summary"] == "Звіт\nперша сторінка"
+    assert "друга" in body["content"]
+    r = client.get(f"/files/{fid}/preview", headers=headers, query_string={"page": 2, "page_size": 1})
+    assert r.get_json()["content"] == "перша сторінка"
+
+
+def test_folders_subtree_move_and_delete(client):
+    headers = register_and_login(client)
+    r = client.post("/folders", headers=headers, json={"path": "proj/src"})
+    assert r.status_code == 201 and r.get_json()["path"] == "/proj/src/"
+    assert client.post("/folders", headers=headers, json={"path": "proj/src"}).status_code == 409
+    assert client.post("/folders", headers=headers, json={"path": "../x"}).status_code == 400
+
+    r = client.post("/files", headers=headers,
+                    data={"file": (io.BytesIO(b"a = 1\n"), "main.py"), "folder": "proj/src"})
+    assert r.status_code == 201 and r.get_json()["folder"] == "/proj/src/"
+    client.post("/files", headers=headers, data={"file": (io.BytesIO(b"b = 2\n"), "notes.py"), "folder": "proj"})
+    listing = client.get("/files", headers=headers, query_string={"folder": "proj/src"}).get_json()
+    assert [f["name"] for f in listing] == ["main.py"]
+
+    usage = client.get("/folders/usage", headers=headers, query_string={"path": "proj"}).get_json()
+    assert usage == {"path": "/proj/", "files": 2, "bytes": 12, "folders": 1}
+    proj = client.get("/folders", headers=headers).get_json()["children"]
+    proj_id = next(f["id"] for f in proj if f["path"] == "/proj/")
+
+    client.post("/folders", headers=headers, json={"path": "archive"})
+    r = client.post(f"/folders/{proj_id}/move", headers=headers, json={"path": "archive"})
+    assert r.status_code == 409
+    r = client.post(f"/folders/{proj_id}/move", headers=headers, json={"path": "archive/proj"})
+    assert r.get_json() == {"path": "/archive/proj/", "folders": 2, "files": 2}
+    listing = client.get("/files", headers=headers, query_string={"folder": "archive/proj/src"}).get_json()
+    assert [f["name"] for f in listing] == ["main.py"]
+    assert client.get(f"/files/{listing[0]['id']}/download", headers=headers).data == b"a = 1\n"
+
+    count = client.get("/files/stats", headers=headers).get_json()["total"]["count"]
+    archive = client.get("/folders", headers=headers, query_string={"path": "archive"}).get_json()["folder"]
+    r = client.delete(f"/folders/{archive['id']}", headers=headers)
+    assert r.get_json()["folders"] == 3 and r.get_json()["files"] == 2
+    assert client.get("/files/stats", headers=headers).get_json()["total"]["count"] == count - 2
+    assert client.get("/folders/usage", headers=headers, query_string={"path": "archive"}).status_code == 404
+
+
+def test_filename_search(client):
+    headers = register_and_login(client)
+    for name in ("Звіт_Квартал.py", "zvit_notes.py", "REPORT_final.py"):
+        client.post("/files", headers=headers, data={"file": (io.BytesIO(b"x = 1\n"), name)})
+
+    def names(**query):
+        r = client.get("/files", headers=headers, query_string=query)
+        assert r.status_code == 200
+        return sorted(f["name"] for f in r.get_json())
+
+    assert names(name_contains="КВАРТ") == ["Звіт_Квартал.py"]
+    assert names(name_contains="звіт") == ["Звіт_Квартал.py"]
+    assert names(name_contains="ort_f") == ["REPORT_final.py"]
+    assert names(name_prefix="zv") == ["zvit_notes.py"]
+    assert names(name_prefix="report", name_contains="fin") == ["REPORT_final.py"]
+    assert names(name_contains="_q%") == []
+
+    fid = next(f["id"] for f in client.get("/files", headers=headers).get_json() if f["name"] == "zvit_notes.py")
+    client.post(f"/files/{fid}/move", headers=headers, json={"name": "minutes.py"})
+    assert names(name_contains="zvit") == []
+    assert names(name_contains="minute") == ["minutes.py"]
+    client.delete(f"/files/{fid}", headers=headers)
+    assert names(name_contains="minute") == []
+
+
+def test_archive_upload_extracts_into_folders(client):
+    import zipfile
+
+    headers = register_and_login(client)
+    body = io.BytesIO()
+    with zipfile.ZipFile(body, "w", zipfile.ZIP_DEFLATED) as z:
+        z.writestr("lib/", b"")
+        z.writestr("lib/util.py", b"def f():\n    return 1\n")
+        z.writestr("app.py", b"import lib\n")
+        z.writestr("../evil.py", b"x")
+        z.writestr("app.py", b"duplicate\n")
+    r = client.post("/files/archive", headers=headers, query_string={"folder": "bundle"}, data=body.getvalue(),
+                    content_type="application/zip")
+    assert r.status_code == 201
+    report = r.get_json()
+    assert report["files"] == 2 and report["errors"] == 1 and report["skipped"] == 1
+    assert [e["status"] for e in report["entries"]] == ["created", "created", "error", "exists"]
+    util = report["entries"][0]
+    assert util["folder"] == "/bundle/lib/" and util["id"]
+    assert client.get(f"/files/{util['id']}/download", headers=headers).data == b"def f():\n    return 1\n"
+    assert client.get("/folders/usage", headers=headers, query_string={"path": "bundle"}).get_json()["files"] == 2
+
+    bomb = io.BytesIO()
+    with zipfile.ZipFile(bomb, "w", zipfile.ZIP_DEFLATED) as z:
+        z.writestr("ok.py", b"ok = 1\n")
+        z.writestr("zeros.bin", b"\0" * (8 * 1024 * 1024))
+    r = client.post("/files/archive", headers=headers, query_string={"folder": "bomb"}, data=bomb.getvalue())
+    assert r.status_code == 413 and "ratio" in r.get_json()["message"]
+    assert [e["name"] for e in r.get_json()["entries"]] == ["ok.py"]
+
+    # a corrupt entry is not kept: its CRC is checked before the blob and row are written
+    corrupt = io.BytesIO()
+    with zipfile.ZipFile(corrupt, "w", zipfile.ZIP_STORED) as z:
+        z.writestr("first.py", b"first = 1\n")
+        z.writestr("good.py", b"print('Hello world')\n")
+    data = corrupt.getvalue().replace(b"Hello", b"Jello")
+    r = client.post("/files/archive", headers=headers, query_string={"folder": "crc"}, data=data)
+    assert r.status_code == 400 and "CRC mismatch" in r.get_json()["message"]
+    assert [e["name"] for e in r.get_json()["entries"]] == ["first.py"]
+    names = [f["name"] for f in client.get("/files", headers=headers, query_string={"folder": "crc"}).get_json()]
+    assert names == ["first.py"]
+
+    # a tarball cut off inside an entry: what came before is kept, the cut entry leaves nothing behind
+    import os
+    import tarfile
+
+    tarball = io.BytesIO()
+    with tarfile.open(fileobj=tarball, mode="w:gz") as tar:
+        for name, data in [("whole.py", b"whole = 1\n"), ("cut.bin", os.urandom(256 * 1024))]:
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            tar.addfile(info, io.BytesIO(data))
+    data = tarball.getvalue()[:128 * 1024]
+    r = client.post("/files/archive", headers=headers, query_string={"folder": "cut"}, data=data)
+    assert r.status_code == 400 and "cannot read" in r.get_json()["message"]
+    assert [e["name"] for e in r.get_json()["entries"]] == ["whole.py"]
+    listing = client.get("/files", headers=headers, query_string={"folder": "cut"}).get_json()
+    assert [f["name"] for f in listing] == ["whole.py"]
+    assert sorted(os.listdir(os.path.dirname(listing[0]["disk_path"]))) == ["whole.py"]
+
+
+def test_sparse_fields_and_lookup(client):
+    headers = register_and_login(client)
+    ids = [client.post("/files", headers=headers, data={"file": (io.BytesIO(b"x = 1\n"), f"lk{i}.py")})
+           .get_json()["id"] for i in range(3)]
+    listing = client.get("/files", headers=headers, query_string={"fields": "id,name,uploader", "name_prefix": "lk"})
+    assert listing.status_code == 200
+    assert {tuple(f) for f in listing.get_json()} == {("id", "name", "uploader")}
+    assert {f["uploader"] for f in listing.get_json()} == {"alice"}
+    r = client.get("/files", headers=headers, query_string={"fields": "id,disk_path,secret"})
+    assert r.status_code == 400 and "secret" in r.get_json()["message"]
+
+    r = client.post("/files/lookup", headers=headers, json={"ids": [ids[2], 999999, ids[0]], "fields": ["id", "size"]})
+    assert r.get_json() == {"files": [{"id": ids[2], "size": 6}, {"id": ids[0], "size": 6}], "missing": [999999]}
+    full = client.post("/files/lookup", headers=headers, json={"ids": [ids[1]]}).get_json()["files"][0]
+    assert full["name"] == "lk1.py" and "disk_path" in full and full["updated_at"]
+    assert client.post("/files/lookup", headers=headers, json={"ids": "1,2"}).status_code == 400
+    client.delete(f"/files/{ids[1]}", headers=headers)
+    assert client.post("/files/lookup", headers=headers, json={"ids": [ids[1]]}).get_json()["missing"] == [ids[1]]
+
+
+def test_batch_thumbnails_sprite_and_multipart(client, tmp_path):
+    import base64
+    from email.parser import BytesParser
+    from email.policy import HTTP
+
+    from PIL import Image
+
+    headers = register_and_login(client)
+    ids = []
+    for i, dims in enumerate([(800, 400), (300, 900), (50, 40)]):
+        buf = io.BytesIO()
+        Image.new("RGB", dims, (10 * i, 100, 200)).save(buf, "JPEG")
+        buf.seek(0)
+        ids.append(client.post("/files", headers=headers, data={"file": (buf, f"g{i}.jpg")}).get_json()["id"])
+    text_id = client.post("/files", headers=headers, data={"file": (io.BytesIO(b"x"), "g.py")}).get_json()["id"]
+
+    r = client.post("/files/thumbnails", headers=headers, json={"ids": ids + [text_id], "size": 128})
+    assert r.status_code == 200
+    body = r.get_json()
+    assert body["missing"] == [text_id] and body["errors"] == []
+    cells = {c["id"]: c for c in body["thumbnails"]}
+    assert (cells[ids[0]]["width"], cells[ids[0]]["height"]) == (128, 64)
+    assert (cells[ids[1]]["width"], cells[ids[1]]["height"]) == (43, 128)
+    assert (cells[ids[2]]["width"], cells[ids[2]]["height"]) == (50, 40)  # never enlarged
+    sheet = Image.open(io.BytesIO(base64.b64decode(body["image"].split(",", 1)[1])))
+    assert sheet.size == (body["width"], body["height"]) == (256, 256)
+    cached = Path(client.application.config["CACHE_ROOT"], "thumbs")
+    assert {p.name.split("-")[0] for p in cached.glob("*-128.jpg")} >= {str(i) for i in ids}
+
+    r = client.post("/files/thumbnails", headers=headers, json={"ids": [ids[1], ids[0]], "size": 64,
+                                                                "format": "multipart"})
+    assert r.mimetype == "multipart/mixed"
+    message = BytesParser(policy=HTTP).parsebytes(
+        f"Content-Type: {r.headers['Content-Type']}\r\n\r\n".encode() + r.data)
+    parts = list(message.iter_parts())
+    assert [p["X-File-Id"] for p in parts] == [str(ids[1]), str(ids[0])]
+    assert Image.open(io.BytesIO(parts[1].get_content())).size == (64, 32)
+
+    assert client.post("/files/thumbnails", headers=headers, json={"ids": ids, "size": 100}).status_code == 400
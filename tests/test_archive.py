@@ -0,0 +1,110 @@
+import io
+import tarfile
+import zipfile
+
+import pytest
+
+from server.archive import ArchiveError, ArchiveLimit, Limits, iter_members
+
+LIMITS = Limits(max_files=100, max_bytes=10 * 1024 * 1024, max_entry_bytes=5 * 1024 * 1024, max_ratio=50)
+
+
+class Unseekable(io.RawIOBase):
+    """A write-only sink, so zipfile has to use data descriptors like a streaming zipper."""
+
+    def __init__(self):
+        self.buffer = bytearray()
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        self.buffer += b
+        return len(b)
+
+
+def extract(data: bytes, limits: Limits = LIMITS):
+    out = []
+    for m in iter_members(io.BytesIO(data), limits):
+        body = None
+        if m.kind == "file":
+            body, size = b"", 7
+            while True:
+                chunk = m.stream.read(size)
+                if not chunk:
+                    break
+                body += chunk
+                size = -1 if size == 7 else 7  # mix small and unbounded reads
+        out.append((m.kind, m.path, body))
+    return out
+
+
+def test_streaming_zip_with_and_without_data_descriptors():
+    sink = Unseekable()
+    with zipfile.ZipFile(sink, "w", zipfile.ZIP_DEFLATED) as z:
+        z.writestr("src/", b"")
+        z.writestr("src/main.py", b"print('hi')\n" * 1000)
+        z.writestr(zipfile.ZipInfo("звіт.txt"), "дані".encode())
+    plain = io.BytesIO()
+    with zipfile.ZipFile(plain, "w", zipfile.ZIP_STORED) as z:
+        z.writestr("a.py", b"a = 1\n")
+
+    members = extract(bytes(sink.buffer))
+    assert [(k, p) for k, p, _ in members] == [("dir", "src/"), ("file", "src/main.py"), ("file", "звіт.txt")]
+    assert len(members[1][2]) == 12 * 1000 and members[2][2] == "дані".encode()
+    assert extract(plain.getvalue()) == [("file", "a.py", b"a = 1\n")]
+
+
+def test_crc_is_checked_before_the_entry_ends():
+    for compression in (zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED):
+        sink = Unseekable()  # CRC in a data descriptor after the data
+        with zipfile.ZipFile(sink, "w", compression) as z:
+            z.writestr("good.py", b"print('Hello world')\n")
+        plain = io.BytesIO()  # CRC in the local header
+        with zipfile.ZipFile(plain, "w", compression) as z:
+            z.writestr("good.py", b"print('Hello world')\n")
+        for data in (bytes(sink.buffer), plain.getvalue()):
+            if compression == zipfile.ZIP_STORED:
+                data = data.replace(b"Hello", b"Jello")
+            else:
+                at = data.index(b"good.py") + len(b"good.py") + 3
+                data = data[:at] + bytes([data[at] ^ 0x01]) + data[at + 1:]
+            stream = next(iter_members(io.BytesIO(data), LIMITS)).stream
+            with pytest.raises(ArchiveError):
+                while stream.read(4):
+                    pass
+
+
+def test_tar_gz_and_special_members():
+    buf = io.BytesIO()
+    with tarfile.open(fileobj=buf, mode="w:gz") as tar:
+        info = tarfile.TarInfo("pkg/mod.py")
+        info.size = 6
+        tar.addfile(info, io.BytesIO(b"x = 2\n"))
+        link = tarfile.TarInfo("pkg/link")
+        link.type = tarfile.SYMTYPE
+        link.linkname = "/etc/passwd"
+        tar.addfile(link)
+    assert [(k, p) for k, p, _ in extract(buf.getvalue())] == [("file", "pkg/mod.py"), ("skip", "pkg/link")]
+
+
+def test_zip_bomb_limits():
+    sink = Unseekable()
+    with zipfile.ZipFile(sink, "w", zipfile.ZIP_DEFLATED) as z:
+        z.writestr("zeros.bin", b"\0" * (4 * 1024 * 1024))
+    with pytest.raises(ArchiveLimit, match="ratio"):
+        extract(bytes(sink.buffer))
+    with pytest.raises(ArchiveLimit, match="larger"):
+        extract(bytes(sink.buffer), Limits(100, 10**9, 1024 * 1024, 10**6))
+
+    many = io.BytesIO()
+    with zipfile.ZipFile(many, "w") as z:
+        for i in range(5):
+            z.writestr(f"{i}.py", b"")
+    with pytest.raises(ArchiveLimit, match="entries"):
+        extract(many.getvalue(), Limits(3, 10**9, 10**9, 100))
+
+
+def test_not_an_archive():
+    with pytest.raises(ArchiveError):
+        extract(b"just some text, not an archive at all" * 20)
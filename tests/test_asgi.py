@@ -0,0 +1,80 @@
+import asyncio
+import io
+import json
+import os
+import time
+
+from werkzeug.datastructures import FileStorage
+from werkzeug.test import encode_multipart
+
+from server.asgi import AsyncBridge
+
+
+async def call(bridge, method, path, headers=(), chunks=(b"",), read_delay=0.0):
+    """Drive one request through the bridge; ``read_delay`` makes a slow-reading client."""
+    incoming = [{"type": "http.request", "body": c, "more_body": i < len(chunks) - 1}
+                for i, c in enumerate(chunks)]
+    done = asyncio.Event()
+    response = {"body": b""}
+
+    async def receive():
+        if incoming:
+            await asyncio.sleep(0)
+            return incoming.pop(0)
+        await done.wait()
+        return {"type": "http.disconnect"}
+
+    async def send(message):
+        if message["type"] == "http.response.start":
+            response["status"] = message["status"]
+            response["headers"] = {k.decode(): v.decode() for k, v in message["headers"]}
+        else:
+            response["body"] += message.get("body", b"")
+            if message.get("more_body"):
+                await asyncio.sleep(read_delay)
+            else:
+                done.set()
+
+    scope = {"type": "http", "method": method, "path": path, "query_string": b"", "http_version": "1.1",
+             "scheme": "http", "server": ("testserver", 80), "client": ("127.0.0.1", 1234),
+             "headers": [(k.lower().encode(), v.encode()) for k, v in headers]}
+    await bridge(scope, receive, send)
+    return response
+
+
+def test_slow_transfers_do_not_hold_threads(make_app):
+    bridge = AsyncBridge(make_app(), threads=2, spool_bytes=1024,
+                         chunk_bytes=16 * 1024, max_body=4 * 1024 * 1024)
+    payload = os.urandom(256 * 1024)
+
+    async def scenario():
+        creds = json.dumps({"username": "dora", "password": "pwd"}).encode()
+        ctype = [("Content-Type", "application/json")]
+        assert (await call(bridge, "POST", "/auth/register", ctype, [creds]))["status"] == 201
+        login = await call(bridge, "POST", "/auth/login", ctype, [creds])
+        auth = [("Authorization", "Bearer " + json.loads(login["body"])["access_token"])]
+
+        # chunked upload (no Content-Length) trickling in, spooled to disk past 1 KiB
+        boundary, body = encode_multipart({"file": FileStorage(io.BytesIO(payload), "big.bin")})
+        pieces = [body[i:i + 8192] for i in range(0, len(body), 8192)]
+        up = await call(bridge, "POST", "/files", auth + [("Content-Type", f"multipart/form-data; boundary={boundary}")],
+                        pieces)
+        assert up["status"] == 201
+        file_id = json.loads(up["body"])["id"]
+
+        # 40 slow readers on 2 threads, and a quick request still gets through meanwhile
+        downloads = [asyncio.ensure_future(call(bridge, "GET", f"/files/{file_id}/download", auth, read_delay=0.02))
+                     for _ in range(40)]
+        await asyncio.sleep(0.05)
+        started = time.monotonic()
+        listing = await call(bridge, "GET", "/files", auth)
+        quick = time.monotonic() - started
+        still_sending = sum(not d.done() for d in downloads)
+        results = await asyncio.gather(*downloads)
+        assert listing["status"] == 200 and quick < 1.0 and still_sending == 40
+        assert all(r["status"] == 200 and r["body"] == payload for r in results)
+
+        too_big = await call(bridge, "POST", "/files", auth, [b"x" * (3 * 1024 * 1024)] * 2)
+        assert too_big["status"] == 413
+
+    asyncio.run(scenario())
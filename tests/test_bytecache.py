@@ -0,0 +1,23 @@
+from server.bytecache import ByteCache
+
+
+def test_size_aware_lru_eviction():
+    cache = ByteCache(max_bytes=10, max_entry_bytes=6)
+    assert cache.put("a", b"1234")
+    assert cache.put("b", b"1234")
+    assert cache.get("a") == b"1234"  # "b" is now least recently used
+    assert cache.put("c", b"1234")
+    assert cache.get("b") is None
+    assert cache.get("a") == b"1234" and cache.get("c") == b"1234"
+    assert not cache.put("big", b"1234567")
+    stats = cache.stats()
+    assert stats["bytes"] == 8 and stats["evictions"] == 1
+    assert stats["hits"] == 3 and stats["misses"] == 1 and stats["hit_ratio"] == 0.75
+
+
+def test_disabled_cache_stores_nothing():
+    cache = ByteCache(max_bytes=0, max_entry_bytes=1024)
+    assert not cache.fits(1)
+    assert not cache.put("a", b"x")
+    assert cache.get_or_load("a", lambda: b"x") == b"x"
+    assert cache.stats()["entries"] == 0
@@ -0,0 +1,9 @@
+from server.dbbench import run
+
+
+def test_query_plans_use_their_indexes(tmp_path):
+    report = run([3000], tmp_path, repeat=1)
+    assert report["failures"] == []
+    shapes = {s["shape"]: s for s in report["sizes"][0]["shapes"]}
+    assert 0 < shapes["list_newest"]["rows"] <= 3000 // 20  # the heavy user's live files
+    assert all(s["statements"] and s["plan"] for s in shapes.values())
@@ -0,0 +1,99 @@
+import zlib
+
+import pytest
+
+from server import extract
+
+
+def _pdf(objects):
+    out = bytearray(b"%PDF-1.7\n")
+    for num, body in enumerate(objects, start=1):
+        out += f"{num} 0 obj\n".encode() + body + b"\nendobj\n"
+    out += b"trailer\n<< /Root 1 0 R >>\n%%EOF\n"
+    return bytes(out)
+
+
+def _stream(data, compress=True):
+    if compress:
+        data = zlib.compress(data)
+        return b"<< /Length %d /Filter /FlateDecode >>\nstream\n" % len(data) + data + b"\nendstream"
+    return b"<< /Length %d >>\nstream\n" % len(data) + data + b"\nendstream"
+
+
+def test_pdf_text_through_tounicode(tmp_path):
+    cmap = (b"begincmap\n1 begincodespacerange <0000> <FFFF> endcodespacerange\n"
+            b"2 beginbfchar <0001> <0421> <0002> <0442>\nendbfchar\n"
+            b"1 beginbfrange <0003> <0004> <0430>\nendbfrange\nendcmap")
+    content = b"BT /F1 12 Tf 72 720 Td <00010002> Tj 0 -14 Td [<0003> -300 <0004>] TJ ET"
+    objects = [
+        b"<< /Type /Catalog /Pages 2 0 R >>",
+        b"<< /Type /Pages /Kids [3 0 R] /Count 1 /Resources << /Font << /F1 5 0 R >> >> >>",
+        b"<< /Type /Page /Parent 2 0 R /Contents 4 0 R >>",
+        _stream(content),
+        b"<< /Type /Font /Subtype /Type0 /BaseFont /X /Encoding /Identity-H /ToUnicode 6 0 R >>",
+        _stream(cmap, compress=False),
+    ]
+    path = tmp_path / "doc.pdf"
+    path.write_bytes(_pdf(objects))
+
+    assert list(extract.pdf_pages(str(path))) == ["Ст\nа б"]
+
+    target = tmp_path / "text"
+    meta = extract.ensure_text(str(path), ".pdf", target)
+    assert meta["lines"] == 2 and meta["summary"] == "Ст\nа б"
+    assert extract.read_lines(target, 1, 5, meta["lines"]) == "а б"
+
+
+def test_hostile_pdfs_raise_extraction_error(tmp_path, monkeypatch):
+    page = [
+        b"<< /Type /Catalog /Pages 2 0 R >>",
+        b"<< /Type /Pages /Kids [3 0 R] /Count 1 >>",
+        b"<< /Type /Page /Parent 2 0 R /Contents 4 0 R >>",
+    ]
+    monkeypatch.setattr(extract, "MAX_STREAM_BYTES", 1 << 20)
+    bomb = _pdf(page + [_stream(b"0 0 Td " * (1 << 18))])
+    nested = _pdf(page + [_stream(b"[" * 20000 + b" Tj", compress=False)])
+    nested_object = _pdf(page[:2] + [b"<< /Type /Page /Kids " + b"[" * 20000 + b" >>"])
+    for name, data in [("bomb", bomb), ("nested", nested), ("nested-object", nested_object)]:
+        path = tmp_path / f"{name}.pdf"
+        path.write_bytes(data)
+        with pytest.raises(extract.ExtractionError):
+            extract.ensure_text(str(path), ".pdf", tmp_path / name)
+        assert not (tmp_path / name).exists()
+
+    # stray closers are skipped without recursing once per character
+    assert extract.Lexer(b"]" * 20000 + b" 7").token() == 7
+
+
+def _docx(path, body):
+    import zipfile
+
+    with zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED) as z:
+        z.writestr("word/document.xml", b'<w:document xmlns:w="http://schemas.openxmlformats.org/'
+                                        b'wordprocessingml/2006/main"><w:body>' + body + b"</w:body></w:document>")
+
+
+def test_malformed_docx_raises_extraction_error(tmp_path):
+    path = tmp_path / "bad.docx"
+    _docx(path, b"<w:p><w:r><w:t>unclosed</w:r></w:p>")
+    with pytest.raises(extract.ExtractionError):
+        extract.ensure_text(str(path), ".docx", tmp_path / "bad")
+    assert not (tmp_path / "bad").exists()
+
+
+def test_docx_stops_at_the_text_and_xml_budgets(tmp_path, monkeypatch):
+    path = tmp_path / "big.docx"
+    run = b"<w:r><w:t>" + b"x" * 99 + b"</w:t></w:r>"
+    _docx(path, b"<w:p>" + run * 5000 + b"</w:p>")  # one page, one paragraph, 495 000 characters
+
+    monkeypatch.setattr(extract, "MAX_CHARS", 1000)
+    pages = list(extract.docx_pages(str(path)))
+    assert len(pages) == 1 and isinstance(pages[0], extract.Truncated) and 1000 < len(pages[0]) < 1200
+    meta = extract.ensure_text(str(path), ".docx", tmp_path / "chars")
+    assert meta["truncated"] and meta["bytes"] == 1000
+
+    monkeypatch.setattr(extract, "MAX_CHARS", 10_000_000)
+    monkeypatch.setattr(extract, "MAX_XML_BYTES", 64 * 1024)
+    pages = list(extract.docx_pages(str(path)))
+    assert len(pages) == 1 and isinstance(pages[0], extract.Truncated) and len(pages[0]) < 64 * 1024
+    assert extract.ensure_text(str(path), ".docx", tmp_path / "xml")["truncated"]
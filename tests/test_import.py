@@ -0,0 +1,81 @@
+import hashlib
+import io
+import os
+
+from server.bulk_import import run_import
+from server.models import FileEntry
+
+
+def test_bulk_import_and_resume(tmp_path, make_app, login):
+    app = make_app()
+    c = app.test_client()
+    headers = login(c, "erin")
+
+    src = tmp_path / "archive"
+    (src / "a" / "b").mkdir(parents=True)
+    (src / "a" / "b" / "deep.py").write_text("print(1)\n", encoding="utf-8")
+    (src / "a" / "Звіт.py").write_text("x = 'звіт'\n", encoding="utf-8")
+    (src / "b").mkdir()
+    (src / "a" / "x.py").write_text("a = 1\n", encoding="utf-8")
+    (src / "b" / "x.py").write_text("b = 1\n", encoding="utf-8")
+    (src / "top.jpg").write_bytes(b"\xff\xd8\xff\xd9")
+    (src / "skip.tmp").write_bytes(b"ignored")
+    checkpoint = tmp_path / "import.json"
+    factory = app.extensions["db_session"].session_factory
+
+    summary = run_import(factory, app.config["UPLOAD_ROOT"], str(src), 1, checkpoint,
+                         workers=2, batch_size=2, extensions={".py", ".jpg"}, progress=lambda _m: None)
+    assert summary["files"] == 5 and summary["errors"] == 0
+
+    # the source tree becomes folders; equal names in different directories stay apart
+    listing = {(x["folder"], x["name"]): x for x in c.get("/files", headers=headers).get_json()}
+    assert set(listing) == {("/a/b/", "deep.py"), ("/a/", "Звіт.py"), ("/a/", "x.py"), ("/b/", "x.py"),
+                            ("/", "top.jpg")}
+    for folder, body in (("/a/", b"a = 1\n"), ("/b/", b"b = 1\n")):
+        r = c.get(f"/files/{listing[(folder, 'x.py')]['id']}/download", headers=headers)
+        assert r.data == body
+    tree = c.get("/folders", headers=headers, query_string={"path": "a"}).get_json()
+    assert [f["path"] for f in tree["children"]] == ["/a/b/"]
+    with factory() as db:
+        entry = db.get(FileEntry, listing[("/a/b/", "deep.py")]["id"])
+        assert entry.content_hash == hashlib.sha256(b"print(1)\n").hexdigest()
+        assert os.path.basename(os.path.dirname(entry.disk_path)) == f"_f{tree['children'][0]['id']}"
+    stats = c.get("/files/stats", headers=headers).get_json()
+    assert stats["total"] == {"count": 5, "bytes": 9 + len("x = 'звіт'\n".encode()) + 4 + 12}
+
+    # resuming after completion imports nothing; new files after the checkpoint are picked up
+    (src / "z.py").write_text("z = 1\n", encoding="utf-8")
+    summary = run_import(factory, app.config["UPLOAD_ROOT"], str(src), 1, checkpoint,
+                         workers=2, batch_size=2, extensions={".py", ".jpg"}, progress=lambda _m: None)
+    assert summary["files"] == 1
+    assert len(c.get("/files", headers=headers).get_json()) == 6
+
+
+def test_bulk_import_skips_names_already_taken(tmp_path, make_app, login):
+    app = make_app()
+    c = app.test_client()
+    headers = login(c, "erin")
+    c.post("/files", headers=headers, data={"file": (io.BytesIO(b"existing\n"), "old.py")})
+
+    src = tmp_path / "tree"
+    src.mkdir()
+    (src / "a b.py").write_text("first = 1\n", encoding="utf-8")
+    (src / "a_b.py").write_text("second = 2\n", encoding="utf-8")  # sanitizes to the same name
+    (src / "old.py").write_text("imported\n", encoding="utf-8")
+    factory = app.extensions["db_session"].session_factory
+    messages = []
+
+    summary = run_import(factory, app.config["UPLOAD_ROOT"], str(src), 1, tmp_path / "one.json",
+                         workers=2, batch_size=10, progress=messages.append)
+    assert summary["files"] == 1 and summary["skipped"] == 2
+    assert sum("name is taken" in m for m in messages) == 2
+    listing = {f["name"]: f for f in c.get("/files", headers=headers).get_json()}
+    assert sorted(listing) == ["a_b.py", "old.py"]
+    assert c.get(f"/files/{listing['a_b.py']['id']}/download", headers=headers).data == b"first = 1\n"
+    assert c.get(f"/files/{listing['old.py']['id']}/download", headers=headers).data == b"existing\n"
+
+    # a second run without the checkpoint adds nothing
+    summary = run_import(factory, app.config["UPLOAD_ROOT"], str(src), 1, tmp_path / "two.json",
+                         workers=2, batch_size=10, progress=lambda _m: None)
+    assert summary["files"] == 0 and summary["skipped"] == 3
+    assert c.get("/files/stats", headers=headers).get_json()["total"]["count"] == 2
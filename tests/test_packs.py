@@ -0,0 +1,66 @@
+import io
+import os
+
+from server.backup import create_backup, restore_snapshot
+from server.reaper import reap_tombstones, reconcile
+
+
+def test_small_files_live_in_packs(tmp_path, monkeypatch, make_app, login):
+    monkeypatch.setenv("STORAGE_PACK_MAX_KB", "4")
+    app = make_app()
+    pool = app.extensions["storage"]
+    pool.packs.pack_bytes = 200  # seal packs quickly so compaction has something to do
+    c = app.test_client()
+    headers = login(c, "gina")
+
+    def upload(name, body):
+        return c.post("/files", headers=headers, data={"file": (io.BytesIO(body), name)}).get_json()
+
+    small = [upload(f"s{i}.py", f"print({i})\r\n".encode()) for i in range(40)]
+    big = upload("big.py", b"#" * 10_000)
+    loose = [os.path.join(d, f) for d, _, files in os.walk(tmp_path / "uploads")
+             if ".packs" not in d for f in files]
+    assert loose == [big["disk_path"]]  # only the large file got an inode of its own
+    assert pool.packs.stats()["blobs"] == 40
+    assert c.get(f"/files/{small[7]['id']}/download", headers=headers).data == b"print(7)\r\n"
+    assert c.get(f"/files/{small[7]['id']}/preview", headers=headers).get_json()["content"] == "print(7)\n"
+
+    # copies share the record; rewriting a name switches between pack and loose file
+    copy = c.post(f"/files/{small[3]['id']}/copy", headers=headers, json={"name": "copy.py"}).get_json()
+    assert copy["method"] == "pack"
+    upload("s3.py", b"#" * 9_000)
+    assert not pool.packed(small[3]["disk_path"]) and os.path.isfile(small[3]["disk_path"])
+    assert c.get(f"/files/{copy['id']}/download", headers=headers).data == b"print(3)\r\n"
+    upload("big.py", b"small now")
+    assert not os.path.exists(big["disk_path"])
+    assert c.get(f"/files/{big['id']}/download", headers=headers).data == b"small now"
+
+    factory = app.extensions["db_session"].session_factory
+    pool.packs.put("orphan.py", b"nobody", "0" * 64)
+    report = reconcile(factory, app.config["UPLOAD_ROOT"], fix=True, grace_seconds=0, storage=pool)
+    assert report["dangling_count"] == 0 and report["orphan_count"] == 1 and report["removed"] == 1
+    assert pool.packs.get("orphan.py") is None
+
+    # deleting most files leaves sealed packs mostly dead; compaction rewrites them
+    for e in small[10:]:
+        c.delete(f"/files/{e['id']}", headers=headers)
+    reap_tombstones(factory, storage=pool)
+    before = pool.packs.stats()
+    result = pool.packs.compact()
+    after = pool.packs.stats()
+    assert result["packs"] > 0 and result["reclaimed_bytes"] > 0
+    assert after["pack_bytes"] < before["pack_bytes"] and after["live_bytes"] == before["live_bytes"]
+    assert sum(1 for f in os.listdir(pool.packs.root) if f.endswith(".dat")) == after["packs"]
+    for i, e in enumerate(small[:10]):
+        if i != 3:
+            assert c.get(f"/files/{e['id']}/download", headers=headers).data == f"print({i})\r\n".encode()
+
+    # backups read packed blobs and restore them as plain files
+    dest = tmp_path / "backups"
+    summary = create_backup(str(tmp_path / "app.db"), str(tmp_path / "uploads"), dest, log=lambda _m: None,
+                            storage=pool)
+    assert summary["missing"] == [] and summary["files"] == 12
+    restored = restore_snapshot(dest, summary["snapshot"], str(tmp_path / "restored.db"), str(tmp_path / "r"))
+    with open(os.path.join(restored["upload_root"], os.path.relpath(small[5]["disk_path"], tmp_path / "uploads")),
+              "rb") as f:
+        assert f.read() == b"print(5)\r\n"
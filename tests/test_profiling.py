@@ -0,0 +1,34 @@
+import json
+
+from server.profiling import ProfilingMiddleware, sign_request
+
+
+def test_disabled_by_default(monkeypatch, make_app):
+    monkeypatch.delenv("PROFILE_SECRET", raising=False)
+    monkeypatch.delenv("PROFILE_SAMPLE_RATE", raising=False)
+    app = make_app()
+    assert not isinstance(app.wsgi_app, ProfilingMiddleware)
+
+
+def test_signed_request_is_profiled(tmp_path, monkeypatch, make_app):
+    monkeypatch.setenv("PROFILE_SECRET", "s3cret")
+    monkeypatch.setenv("PROFILE_DIR", str(tmp_path / "profiles"))
+    monkeypatch.setenv("PROFILE_TRACEMALLOC", "1")
+    app = make_app()
+    c = app.test_client()
+
+    r = c.post("/auth/login", json={"username": "nobody", "password": "x"})
+    assert "X-Profile-Id" not in r.headers
+    r = c.post("/auth/login", json={"username": "nobody", "password": "x"},
+               headers={"X-Profile": sign_request("wrong", "POST", "/auth/login")})
+    assert "X-Profile-Id" not in r.headers
+
+    r = c.post("/auth/login", json={"username": "nobody", "password": "x"},
+               headers={"X-Profile": sign_request("s3cret", "POST", "/auth/login")})
+    r.close()  # the profile is written when the server closes the response body
+    profile_id = r.headers["X-Profile-Id"]
+    out = tmp_path / "profiles"
+    summary = json.loads((out / f"{profile_id}.summary.json").read_text(encoding="utf-8"))
+    assert summary["path"] == "/auth/login" and summary["status"].startswith("401")
+    assert (out / f"{profile_id}.collapsed").exists()
+    assert (out / f"{profile_id}.alloc.txt").exists()
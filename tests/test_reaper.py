@@ -0,0 +1,115 @@
+import os
+from pathlib import Path
+
+import pytest
+
+from server.models import FileEntry
+from server.reaper import _try_lock, reap_tombstones, reconcile
+
+
+@pytest.fixture
+def setup(make_app, login):
+    app = make_app()
+    app.config.update(TESTING=True)
+    c = app.test_client()
+    return app, c, login(c, "dave")
+
+
+def upload(c, headers, tmp_path, name, body=b"data"):
+    src = tmp_path / f"src-{name}"
+    src.write_bytes(body)
+    with open(src, "rb") as f:
+        return c.post("/files", headers=headers, data={"file": (f, name)}).get_json()
+
+
+def test_delete_tombstones_then_reaper_removes_blob(tmp_path, setup):
+    app, c, headers = setup
+    entry = upload(c, headers, tmp_path, "gone.py")
+
+    assert c.delete(f"/files/{entry['id']}", headers=headers).status_code == 200
+    assert Path(entry["disk_path"]).exists()  # removal is deferred
+    assert all(x["id"] != entry["id"] for x in c.get("/files", headers=headers).get_json())
+
+    factory = app.extensions["db_session"].session_factory
+    assert reap_tombstones(factory) == 1
+    assert not Path(entry["disk_path"]).exists()
+    with factory() as db:
+        assert db.get(FileEntry, entry["id"]) is None
+
+
+def test_reconcile_reports_and_fixes(tmp_path, setup):
+    app, c, headers = setup
+    kept = upload(c, headers, tmp_path, "kept.py")
+    lost = upload(c, headers, tmp_path, "lost.py")
+    os.remove(lost["disk_path"])
+    orphan = Path(kept["disk_path"]).parent / "orphan.bin"
+    orphan.write_bytes(b"x" * 7)
+
+    factory = app.extensions["db_session"].session_factory
+    report = reconcile(factory, app.config["UPLOAD_ROOT"])
+    assert report["orphan_count"] == 1 and report["orphan_bytes"] == 7
+    assert report["dangling_count"] == 1 and report["dangling"][0]["ids"] == [lost["id"]]
+    assert orphan.exists()
+
+    report = reconcile(factory, app.config["UPLOAD_ROOT"], fix=True, grace_seconds=0)
+    assert report["removed"] == 1 and report["tombstoned"] == 1
+    assert not orphan.exists()
+    names = [x["name"] for x in c.get("/files", headers=headers).get_json()]
+    assert names == ["kept.py"]
+    assert c.get("/files/stats", headers=headers).get_json()["total"]["count"] == 1
+
+
+def test_reaper_keeps_a_blob_rewritten_after_the_delete(tmp_path, setup):
+    import io
+    import time
+
+    from server.reaper import main
+
+    app, c, headers = setup
+    entry = upload(c, headers, tmp_path, "reused.py", b"old")
+    c.delete(f"/files/{entry['id']}", headers=headers)
+    main(["--reconcile"])  # report only: nothing is reaped
+    assert Path(entry["disk_path"]).exists()
+
+    # an upload reusing the path has written its blob but not committed its row yet
+    time.sleep(0.01)
+    app.extensions["storage"].write_stream(io.BytesIO(b"new"), Path(entry["disk_path"]))
+    factory = app.extensions["db_session"].session_factory
+    assert reap_tombstones(factory, storage=app.extensions["storage"]) == 1
+    assert Path(entry["disk_path"]).read_bytes() == b"new"
+
+
+def test_reaper_removes_a_tombstoned_link_whose_inode_was_cloned_later(tmp_path, setup):
+    import time
+
+    app, c, headers = setup
+    entry = upload(c, headers, tmp_path, "a.py", b"shared")
+    b = c.post(f"/files/{entry['id']}/copy", headers=headers, json={"name": "b.py"}).get_json()
+    assert b["method"] == "link"
+    c.delete(f"/files/{entry['id']}", headers=headers)
+
+    # cloning the surviving link after the delete moves the shared inode's ctime
+    time.sleep(0.01)
+    assert c.post(f"/files/{b['id']}/copy", headers=headers, json={"name": "c.py"}).status_code == 201
+    factory = app.extensions["db_session"].session_factory
+    storage = app.extensions["storage"]
+    assert reap_tombstones(factory, storage=storage) == 1
+    assert not Path(entry["disk_path"]).exists()
+    assert Path(b["disk_path"]).read_bytes() == b"shared"
+
+    # a copy onto the tombstoned path of d.py, its row not committed yet, gets an inode of its own
+    d = upload(c, headers, tmp_path, "d.py", b"old")
+    c.delete(f"/files/{d['id']}", headers=headers)
+    time.sleep(0.01)
+    assert storage.clone(b["disk_path"], Path(d["disk_path"])) != "link"
+    assert reap_tombstones(factory, storage=storage) == 1
+    assert Path(d["disk_path"]).read_bytes() == b"shared"
+
+
+def test_background_jobs_lock_admits_one_holder(tmp_path):
+    path = str(tmp_path / "cache" / ".reaper.lock")
+    holder = _try_lock(path)
+    assert holder is not None
+    assert _try_lock(path) is None  # a second worker skips the jobs
+    holder.close()  # the holder exits
+    assert _try_lock(path) is not None
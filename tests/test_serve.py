@@ -0,0 +1,44 @@
+import threading
+from types import SimpleNamespace
+
+from server.models import create_db_engine, init_db
+from server import search
+from server.serve import DriveServer, build_options, post_fork
+
+
+def test_build_options_from_env(monkeypatch):
+    monkeypatch.setenv("WEB_WORKERS", "3")
+    monkeypatch.setenv("WEB_THREADS", "4")
+    monkeypatch.setenv("WEB_MAX_REQUESTS", "100")
+    opts = build_options()
+    assert opts["workers"] == 3
+    assert opts["threads"] == 4
+    assert opts["worker_class"] == "gthread"
+    assert opts["sendfile"] is True
+    assert opts["max_requests"] == 100 and opts["max_requests_jitter"] == 10
+
+
+def test_worker_app_without_schema_init(tmp_path, make_app):
+    init_db(create_db_engine(f"sqlite:///{tmp_path / 'app.db'}"))
+
+    app = make_app(init_schema=False)
+    c = app.test_client()
+    r = c.post("/auth/register", json={"username": "carol", "password": "pwd"})
+    assert r.status_code == 201
+
+
+def test_preload_builds_the_schema_first_and_leaves_jobs_to_workers(server_env, monkeypatch):
+    monkeypatch.setenv("REAPER_INTERVAL", "3600")
+
+    def reapers():
+        return sum(t.name == "blob-reaper" for t in threading.enumerate())
+
+    before = reapers()
+
+    # gunicorn calls load() in the master before on_starting has created the schema
+    app = DriveServer({"preload_app": True}).load()
+    assert search.probe(app.extensions["db_engine"])
+    assert reapers() == before  # nothing running in the master, holding the reaper lock
+
+    post_fork(None, SimpleNamespace(app=SimpleNamespace(callable=app)))
+    assert reapers() == before + 1
@@ -0,0 +1,86 @@
+import io
+import json
+from pathlib import Path
+
+from werkzeug.test import Client
+
+from server.shards import Directory, ShardMap, ShardRouter, add_shard, rebalance
+
+
+def make_shard(tmp_path, monkeypatch, make_app, name):
+    shard = {"url": f"http://{name}.invalid", "database": f"sqlite:///{tmp_path / name / 'app.db'}",
+             "upload_root": str(tmp_path / name / "uploads")}
+    monkeypatch.setenv("SHARD_SECRET", "shard-secret")
+    return shard, make_app(tmp_path / name)
+
+
+def test_router_isolates_users_and_rebalances(tmp_path, monkeypatch, make_app):
+    shards, apps = {}, {}
+    for name in ("s0", "s1"):
+        shards[name], apps[name] = make_shard(tmp_path, monkeypatch, make_app, name)
+    (tmp_path / "shards.json").write_text(json.dumps({"shards": shards}))
+    shard_map = ShardMap(tmp_path / "shards.json")
+    directory = Directory(str(tmp_path / "directory.db"))
+    router = ShardRouter(shard_map, directory, "test-secret", "shard-secret", backends=apps)
+    c = Client(router)
+
+    # a shard refuses ids that do not come from the router
+    direct = apps["s0"].test_client().post("/auth/register", json={"username": "x", "password": "p"},
+                                           headers={"X-Shard-User-Id": "999"})
+    assert direct.status_code == 403
+
+    users = {}
+    for i in range(12):
+        name = f"user{i}"
+        assert c.post("/auth/register", json={"username": name, "password": "pwd"}).status_code == 201
+        token = c.post("/auth/login", json={"username": name, "password": "pwd"}).get_json()["access_token"]
+        headers = {"Authorization": f"Bearer {token}"}
+        entry = c.post("/files", headers=headers, data={"file": (io.BytesIO(name.encode()), "own.py"),
+                                                       "folder": "/docs"}).get_json()
+        users[name] = (directory.lookup(name), headers)
+        folder = entry["folder"]
+    assert c.post("/auth/register", json={"username": "USER0", "password": "x"}).status_code == 409
+    assert c.post("/auth/login", json={"username": "nobody", "password": "x"}).status_code == 401
+    placed = {shard_map.shard_for(owner) for owner, _ in users.values()}
+    assert placed == {"s0", "s1"}  # both shards hold users
+    for name, (owner, headers) in users.items():
+        r = c.get("/files", headers=headers)
+        assert r.headers["X-Shard"] == shard_map.shard_for(owner)
+        assert [f["name"] for f in r.get_json()] == ["own.py"]
+
+    shards["s2"], apps["s2"] = make_shard(tmp_path, monkeypatch, make_app, "s2")
+    before = {owner: shard_map.shard_for(owner) for owner, _ in users.values()}
+    cursors = {owner: c.get("/files/events", headers=h, query_string={"wait": 0}).get_json()["last_id"]
+               for owner, h in users.values()}
+    routed, save = [], shard_map.save
+
+    def observed_save():  # what a router reloading the file would see after each write
+        save()
+        routed.append({owner: ShardMap(shard_map.path).shard_for(owner) for owner in before})
+
+    monkeypatch.setattr(shard_map, "save", observed_save)
+    pinned = add_shard(shard_map, directory, "s2", shards["s2"])
+    monkeypatch.setattr(shard_map, "save", save)
+    assert routed == [before]
+    assert pinned > 0 and all(c.get("/files", headers=h).status_code == 200 for _, h in users.values())
+    moves = rebalance(shard_map)
+    assert len(moves) == pinned and not shard_map.pins and not shard_map.moving
+    for name, (owner, headers) in users.items():
+        listing = c.get("/files", headers=headers).get_json()
+        assert [(f["name"], f["folder"]) for f in listing] == [("own.py", folder)]
+        assert c.get(f"/files/{listing[0]['id']}/download", headers=headers).data == name.encode()
+    assert sum(m["to"] == "s2" for m in moves) == len(moves)
+    for m in moves:  # a moved user's feed carries on from the cursor the client held on the old shard
+        headers = next(h for owner, h in users.values() if owner == m["owner_id"])
+        got = c.get("/files/events", headers=headers, query_string={"since": cursors[m["owner_id"]], "wait": 0})
+        # either way the client re-lists: the move's bulk event, or a reset when the cursor predates this shard
+        assert got.get_json().get("reset") or [e["kind"] for e in got.get_json()["events"]] == ["bulk"]
+        c.post("/files", headers=headers, data={"file": (io.BytesIO(b"new"), "after-move.py")})
+        got = c.get("/files/events", headers=headers, query_string={"since": got.get_json()["last_id"], "wait": 0})
+        assert [(e["kind"], e["name"]) for e in got.get_json()["events"]] == [("created", "after-move.py")]
+        # a cursor past everything this shard has written is from elsewhere: start over
+        got = c.get("/files/events", headers=headers, query_string={"since": 10**6, "wait": 0}).get_json()
+        assert got["reset"] is True
+    for m in moves:  # nothing left behind on the old shard
+        left = Path(shards[m["from"]]["upload_root"]) / str(m["owner_id"])
+        assert not any(p.is_file() for p in left.rglob("*"))
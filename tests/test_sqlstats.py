@@ -0,0 +1,27 @@
+import io
+
+import pytest
+
+
+@pytest.fixture
+def client(monkeypatch, make_app):
+    monkeypatch.setenv("SQL_STATS", "1")
+    monkeypatch.setenv("SQL_EXPLAIN", "1")
+    app = make_app()
+    return app, app.test_client()
+
+
+def test_listing_query_count_is_constant_and_indexed(client, login):
+    app, c = client
+    headers = login(c, "dave")
+    counts = []
+    for i in range(6):
+        c.post("/files", headers=headers, content_type="multipart/form-data",
+               data={"file": (io.BytesIO(b"print(1)\n"), f"s{i}.py")})
+        r = c.get(f"/files?sort_by=uploader&n={i}", headers=headers)
+        assert r.status_code == 200
+        counts.append((r.headers["X-SQL-Queries"], r.headers["X-SQL-Max-Repeat"]))
+    assert len(set(counts)) == 1  # no per-row queries
+
+    scans = app.extensions["sql_stats"].scanning_plans()
+    assert [p.statement for p in scans] == []
@@ -0,0 +1,86 @@
+import io
+import os
+import shutil
+
+import pytest
+
+from server.reaper import reap_tombstones, reconcile
+
+
+@pytest.fixture
+def volume_app(tmp_path, monkeypatch, make_app, login):
+    def make(volumes):
+        monkeypatch.setenv("STORAGE_VOLUMES", os.pathsep.join(str(tmp_path / v) for v in volumes))
+        monkeypatch.setenv("STORAGE_REPLICAS", "2")
+        app = make_app()
+        c = app.test_client()
+        return app, c, login(c, "erin")
+
+    return make
+
+
+def test_replicated_blobs_survive_a_lost_volume(tmp_path, volume_app):
+    app, c, headers = volume_app(["v1", "v2", "v3"])
+    pool = app.extensions["storage"]
+    entries = [c.post("/files", headers=headers, data={"file": (io.BytesIO(f"n = {i}\n".encode()), f"f{i}.py")})
+               .get_json() for i in range(12)]
+    for e in entries:
+        copies = pool.copies(e["disk_path"])
+        assert len(copies) == 2 and len({pool._volume_of(p) for p in copies}) == 2
+    used = {pool._volume_of(p) for e in entries for p in pool.copies(e["disk_path"])}
+    assert len(used) == 3  # spread over every volume
+
+    shutil.rmtree(tmp_path / "v2")  # a failed disk
+    for i, e in enumerate(entries):
+        assert c.get(f"/files/{e['id']}/download", headers=headers).data == f"n = {i}\n".encode()
+
+    factory = app.extensions["db_session"].session_factory
+    report = reconcile(factory, app.config["UPLOAD_ROOT"], storage=pool)
+    assert report["dangling_count"] == 0 and report["orphan_count"] == 0
+    assert c.delete(f"/files/{entries[0]['id']}", headers=headers).status_code == 200
+    assert reap_tombstones(factory, storage=pool) == 1
+    assert pool.copies(entries[0]["disk_path"]) == []
+
+
+def test_rebalance_after_adding_a_volume(volume_app):
+    app, c, headers = volume_app(["v1", "v2"])
+    entries = [c.post("/files", headers=headers, data={"file": (io.BytesIO(b"x"), f"g{i}.py")}).get_json()
+               for i in range(20)]
+    factory = app.extensions["db_session"].session_factory
+    app.extensions["storage"].rebalance(factory)
+    assert not app.extensions["storage"].needs_rebalance()
+
+    app, c, headers = volume_app(["v1", "v2", "v3"])
+    pool = app.extensions["storage"]
+    assert pool.needs_rebalance()
+    report = pool.rebalance(app.extensions["db_session"].session_factory)
+    assert report["blobs"] == 20 and report["copied"] == report["removed"] > 0 and not report["lost"]
+    assert not pool.needs_rebalance()
+    for e in entries:
+        assert sorted(pool.copies(e["disk_path"])) == sorted(pool.targets(e["disk_path"]))
+        assert c.get(f"/files/{e['id']}/download", headers=headers).data == b"x"
+
+
+def test_overwrite_while_a_volume_is_down_leaves_no_stale_copy(tmp_path, volume_app):
+    app, c, headers = volume_app(["v1", "v2", "v3"])
+    pool = app.extensions["storage"]
+    entry = c.post("/files", headers=headers, data={"file": (io.BytesIO(b"old\n"), "s.py")}).get_json()
+    down = pool._volume_of(pool.targets(entry["disk_path"])[0])
+    os.rename(down, down + ".offline")
+    c.post("/files", headers=headers, data={"file": (io.BytesIO(b"new\n"), "s.py")})
+    os.rename(down + ".offline", down)  # back, with the old version
+
+    stale = [p for p in pool.copies(entry["disk_path"]) if open(p, "rb").read() == b"old\n"]
+    assert [pool._volume_of(p) for p in stale] == [down]
+    report = pool.rebalance(app.extensions["db_session"].session_factory)
+    assert report["stale"] == 1 and report["under_replicated"] == 0
+    assert sorted(pool.copies(entry["disk_path"])) == sorted(pool.targets(entry["disk_path"]))
+    assert {open(p, "rb").read() for p in pool.copies(entry["disk_path"])} == {b"new\n"}
+
+    # with every volume up, a write removes copies left outside the targets
+    extra = next(v for v in pool.volumes if v not in map(pool._volume_of, pool.targets(entry["disk_path"])))
+    stray = os.path.join(extra, os.path.relpath(entry["disk_path"], pool.upload_root))
+    shutil.copy(pool.copies(entry["disk_path"])[0], stray)
+    c.post("/files", headers=headers, data={"file": (io.BytesIO(b"newer\n"), "s.py")})
+    assert not os.path.exists(stray)
+    assert c.get(f"/files/{entry['id']}/download", headers=headers).data == b"newer\n"
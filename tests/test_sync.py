@@ -1,9 +1,13 @@
+import io
 import os
 from pathlib import Path
+import threading
 import time
 
 import pytest
+from werkzeug.serving import make_server
 
+from client_desktop.sync import FolderSync
 from server.app import create_app
 
 
@@ -36,3 +40,66 @@ def test_basic_sync_flow(tmp_path):
     assert any(x["name"] == "sync.py" for x in items)
 
 
+
+
+def test_sync_state_survives_restart(tmp_path, monkeypatch, make_app, login):
+    app = make_app()
+    server = make_server("127.0.0.1", 0, app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    api = f"http://127.0.0.1:{server.server_port}"
+    token = login(app.test_client(), "dana")["Authorization"].removeprefix("Bearer ")
+
+    hashed = []
+    real_hash = FolderSync.get_file_hash
+    monkeypatch.setattr(FolderSync, "get_file_hash", lambda self, p: hashed.append(p) or real_hash(self, p))
+    try:
+        local = tmp_path / "local"
+        (local / "pkg").mkdir(parents=True)
+        for i in range(5):
+            (local / "pkg" / f"m{i}.py").write_text(f"x = {i}\n", encoding="utf-8")
+        assert FolderSync(api, token, local).sync_upload_only()["uploaded"] == 5
+
+        # a restarted client only stats the folder
+        hashed.clear()
+        assert FolderSync(api, token, local).sync_upload_only() == {"uploaded": 0, "skipped": 5, "errors": 0,
+                                                                      "files": []}
+        assert hashed == []
+        (local / "pkg" / "m2.py").write_text("x = 'changed'\n", encoding="utf-8")
+        results = FolderSync(api, token, local).sync_bidirectional()
+        assert results["uploaded"] == 1 and results["downloaded"] == 0 and hashed == [local / "pkg" / "m2.py"]
+
+        # a second folder downloads everything once
+        other = tmp_path / "other"
+        assert FolderSync(api, token, other).sync_download_only()["downloaded"] == 5
+        assert (other / "pkg" / "m2.py").read_text(encoding="utf-8") == "x = 'changed'\n"
+        hashed.clear()
+        again = FolderSync(api, token, other)
+        assert again.sync_download_only()["downloaded"] == 0
+        assert again.sync_upload_only()["uploaded"] == 0 and hashed == []
+    finally:
+        server.shutdown()
+
+
+def test_pushed_download_is_not_repeated_after_restart(tmp_path, make_app, login):
+    app = make_app()
+    server = make_server("127.0.0.1", 0, app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    api = f"http://127.0.0.1:{server.server_port}"
+    c = app.test_client()
+    headers = login(c, "eve")
+    token = headers["Authorization"].removeprefix("Bearer ")
+    try:
+        local = tmp_path / "local"
+        follower = FolderSync(api, token, local)
+        cursor = c.get("/files/events", headers=headers, query_string={"wait": 0}).get_json()["last_id"]
+        c.post("/files", headers=headers, data={"file": (io.BytesIO(b"pushed = 1\n"), "pushed.py"),
+                                               "folder": "inbox"})
+        events = c.get("/files/events", headers=headers, query_string={"since": cursor, "wait": 0}).get_json()
+        follower.iter_events = lambda since=None: iter([(e["kind"], e) for e in events["events"]])
+        follower.follow_remote_changes()
+        assert (local / "inbox" / "pushed.py").read_bytes() == b"pushed = 1\n"
+
+        # the restarted client's full comparison finds the pushed file current
+        assert FolderSync(api, token, local).sync_download_only()["downloaded"] == 0
+    finally:
+        server.shutdown()
@@ -0,0 +1,74 @@
+import io
+import struct
+import threading
+import zlib
+
+import pytest
+from PIL import Image
+
+from server import thumbs, tiles
+
+
+def _chunk(kind, data):
+    return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data))
+
+
+def _png_header(width, height):
+    """A PNG with (almost) no pixel data: enough for ``Image.open`` to report the size."""
+    ihdr = struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0)
+    return b"\x89PNG\r\n\x1a\n" + _chunk(b"IHDR", ihdr) + _chunk(b"IDAT", zlib.compress(b"")) + _chunk(b"IEND", b"")
+
+
+def test_pixel_limit_is_raised_only_for_pyramids():
+    default = Image.MAX_IMAGE_PIXELS
+    assert default < tiles.MAX_PIXELS
+    huge = _png_header(20_000, 20_000)
+
+    with tiles._open_large(io.BytesIO(huge)) as img:
+        assert img.size == (20_000, 20_000)
+    assert Image.MAX_IMAGE_PIXELS == default
+
+    with pytest.raises(Image.DecompressionBombError):
+        thumbs.render(io.BytesIO(huge), 64)
+
+
+def test_builds_of_different_targets_do_not_wait_for_each_other(tmp_path):
+    entered = threading.Event()
+
+    def build_other():
+        with tiles.building(tmp_path / "b"):
+            entered.set()
+
+    with tiles.building(tmp_path / "a"):
+        thread = threading.Thread(target=build_other)
+        thread.start()
+        assert entered.wait(5)
+    thread.join()
+    assert not tiles._builds
+
+
+def test_builds_share_a_pixel_budget(tmp_path, monkeypatch):
+    monkeypatch.setattr(tiles, "BUILD_PIXEL_BUDGET", 100)
+    entered = threading.Event()
+
+    def build(pixels):
+        with tiles.pixel_budget(pixels):
+            entered.set()
+
+    with tiles.pixel_budget(60):
+        thread = threading.Thread(target=build, args=(60,))
+        thread.start()
+        assert not entered.wait(0.2)  # 120 pixels would not fit
+    assert entered.wait(5)
+    thread.join()
+
+    build(1_000)  # larger than the whole budget: runs alone
+    assert tiles._decoding == [0]
+
+    for mode in ("RGB", "L", "P", "RGBA"):
+        source = tmp_path / f"{mode}.png"
+        Image.new(mode, (300, 200)).save(source)
+        manifest = tiles.ensure_pyramid(str(source), tmp_path / mode)
+        assert manifest["max_level"] == 9
+        with Image.open(tmp_path / mode / "9" / "1_0.jpg") as tile:
+            assert tile.mode == "RGB" and tile.size == (44, 200)